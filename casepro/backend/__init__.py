@@ -2,6 +2,66 @@ from abc import ABCMeta, abstractmethod
 from typing import Tuple
 
 
+class SyncContext(object):
+    """
+    Lookups of an org's labels and groups which are built once per sync run and shared by the syncers and the model save
+    signal handlers, rather than each of them querying all of the org's labels or groups for every synced object
+    """
+
+    def __init__(self, org):
+        self.org = org
+        self._labels_by_uuid = None
+        self._unsynced_labels = None
+        self._groups_by_uuid = None
+
+    def _load_labels(self):
+        if self._labels_by_uuid is None:
+            labels = list(self.org.labels.all())
+            for label in labels:
+                label.org = self.org
+
+            self._labels_by_uuid = {l.uuid: l for l in labels if l.uuid}
+            self._unsynced_labels = [l for l in labels if not l.is_synced]
+
+    def has_unsynced_label(self, uuid, name):
+        """
+        Gets whether there is a non-synced label with the given UUID or name
+        """
+        self._load_labels()
+
+        return any(l.uuid == uuid or l.name == name for l in self._unsynced_labels)
+
+    def get_or_create_label(self, uuid, name):
+        """
+        Gets the label with the given UUID, creating a stub if it doesn't exist and doesn't clash with a non-synced label
+        """
+        self._load_labels()
+
+        label = self._labels_by_uuid.get(uuid)
+        if not label and not any(l.name == name for l in self._unsynced_labels):
+            # another sync (e.g. a concurrent backfill shard) may be creating the same stub
+            label, created = self.org.labels.get_or_create(uuid=uuid, defaults={"name": name, "is_active": False})
+            label.org = self.org
+            self._labels_by_uuid[uuid] = label
+
+        return label
+
+    def get_or_create_group(self, uuid, name):
+        """
+        Gets the group with the given UUID, creating a stub if it doesn't exist
+        """
+        if self._groups_by_uuid is None:
+            self._groups_by_uuid = {g.uuid: g for g in self.org.groups.all()}
+
+        group = self._groups_by_uuid.get(uuid)
+        if not group:
+            # another sync (e.g. a concurrent backfill shard) may be creating the same stub
+            group, created = self.org.groups.get_or_create(uuid=uuid, defaults={"name": name, "is_active": False})
+            self._groups_by_uuid[uuid] = group
+
+        return group
+
+
 class BaseBackend(object):
     __metaclass__ = ABCMeta
 
@@ -23,7 +83,8 @@ class BaseBackend(object):
         :param org: the org
         :param datetime modified_after: pull contacts modified after this
         :param datetime modified_before: pull contacts modified before this
-        :param progress_callback: callable that will be called from time to time with number of contacts pulled
+        :param progress_callback: callable that will be called from time to time with number of contacts pulled and
+                                  the cursor from which the pull could be resumed
         :param str resume_cursor: optional cursor to resume from
         :return: tuple of the number of contacts created, updated, deleted and ignored
         """
@@ -72,7 +133,8 @@ class BaseBackend(object):
         :param datetime modified_after: pull messages modified after this
         :param datetime modified_before: pull messages modified before this
         :param bool as_handled: whether messages should be saved as already handled
-        :param progress_callback: callable that will be called from time to time with number of messages pulled
+        :param progress_callback: callable that will be called from time to time with number of messages pulled and
+                                  the cursor from which the pull could be resumed
         :param str resume_cursor: optional cursor to resume from
         :return: tuple of the number of messages created, updated, deleted and ignored
         """
@@ -0,0 +1,180 @@
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import iso8601
+from dash.orgs.models import Org
+from django_redis import get_redis_connection
+
+from django.db import connections
+
+BACKFILL_KEY = "org:%d:backfill:%s"
+
+# progress callback of the process which started a pool of shard pulling processes, inherited by them when forked
+_pool_progress_callback = None
+
+
+class Backfill(object):
+    """
+    A backfill of messages or contacts over a time window which is split into shards that can be pulled concurrently.
+    The progress of each shard, including its resume cursor, is stored in Redis so that an interrupted backfill can be
+    resumed without re-pulling the shards which already finished.
+    """
+
+    TYPE_MESSAGES = "messages"
+    TYPE_CONTACTS = "contacts"
+
+    def __init__(self, org, type, shards, as_handled=False):
+        self.org = org
+        self.type = type
+        self.shards = shards
+        self.as_handled = as_handled
+
+    @classmethod
+    def create(cls, org, type, since, until, num_shards, as_handled=False):
+        """
+        Creates a new backfill, replacing any existing backfill of the same type for the org
+        """
+        step = (until - since) / num_shards
+        bounds = [since + step * s for s in range(num_shards)] + [until]
+
+        shards = []
+        for s in range(num_shards):
+            shards.append(
+                {
+                    "since": bounds[s].isoformat(),
+                    "until": bounds[s + 1].isoformat(),
+                    "cursor": None,
+                    "done": False,
+                    "created": 0,
+                    "updated": 0,
+                    "deleted": 0,
+                    "ignored": 0,
+                }
+            )
+
+        backfill = cls(org, type, shards, as_handled)
+
+        r = get_redis_connection()
+        key = cls._get_key(org, type)
+        with r.pipeline() as pipe:
+            pipe.delete(key)
+            pipe.hset(key, "config", json.dumps({"as_handled": as_handled}))
+            pipe.hset(key, mapping={str(s): json.dumps(shard) for s, shard in enumerate(shards)})
+            pipe.execute()
+
+        return backfill
+
+    @classmethod
+    def get(cls, org, type):
+        """
+        Gets the existing backfill of the given type for the org, or none
+        """
+        stored = get_redis_connection().hgetall(cls._get_key(org, type))
+        if not stored:
+            return None
+
+        stored = {k.decode(): json.loads(v) for k, v in stored.items()}
+        config = stored.pop("config")
+        shards = [stored[str(s)] for s in range(len(stored))]
+
+        return cls(org, type, shards, config["as_handled"])
+
+    @staticmethod
+    def _get_key(org, type):
+        return BACKFILL_KEY % (org.pk, type)
+
+    def get_unfinished(self):
+        """
+        Gets the indexes of the shards which haven't finished
+        """
+        return [s for s, shard in enumerate(self.shards) if not shard["done"]]
+
+    def get_totals(self):
+        """
+        Gets the total created, updated, deleted and ignored counts across all shards
+        """
+        return tuple(sum(shard[c] for shard in self.shards) for c in ("created", "updated", "deleted", "ignored"))
+
+    def pull_shard(self, index, progress_callback=None):
+        """
+        Pulls a single shard, saving its cursor after each page synced so it can be resumed if interrupted
+        """
+        backend = self.org.get_backend()
+        shard = self.shards[index]
+        since, until = iso8601.parse_date(shard["since"]), iso8601.parse_date(shard["until"])
+
+        def progress(num, cursor):
+            # the backend gives us the cursor after each page it syncs, which might be none when it's on the last page
+            if cursor:
+                shard["cursor"] = cursor
+                self._save_shard(index)
+
+            if progress_callback:
+                progress_callback(index, num)
+
+        while not shard["done"]:
+            if self.type == self.TYPE_MESSAGES:
+                created, updated, deleted, ignored, cursor = backend.pull_messages(
+                    self.org, since, until, self.as_handled, progress, resume_cursor=shard["cursor"]
+                )
+            else:
+                created, updated, deleted, ignored, cursor = backend.pull_contacts(
+                    self.org, since, until, progress, resume_cursor=shard["cursor"]
+                )
+
+            shard["created"] += created
+            shard["updated"] += updated
+            shard["deleted"] += deleted
+            shard["ignored"] += ignored
+            shard["cursor"] = cursor
+            shard["done"] = not cursor
+
+            self._save_shard(index)
+
+        return shard
+
+    def _save_shard(self, index):
+        get_redis_connection().hset(self._get_key(self.org, self.type), str(index), json.dumps(self.shards[index]))
+
+    def pull(self, concurrency=1, progress_callback=None):
+        """
+        Pulls all unfinished shards, using a pool of forked processes if concurrency is more than one. Syncing a page is
+        as much Python work as it is waiting on the backend and the database, so threads would be limited by the GIL.
+        """
+        unfinished = self.get_unfinished()
+
+        if concurrency <= 1:
+            for index in unfinished:
+                self.pull_shard(index, progress_callback)
+            return
+
+        # forked processes mustn't share our database connections, and will open their own
+        connections.close_all()
+
+        try:
+            with ProcessPoolExecutor(
+                max_workers=concurrency,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=_init_pool_process,
+                initargs=(progress_callback,),
+            ) as executor:
+                # re-raises any exception from a shard
+                list(executor.map(_pull_shard_in_process, [(self.org.pk, self.type, i) for i in unfinished]))
+        finally:
+            # shards were updated by other processes so reload them to get their progress
+            self.shards = self.get(self.org, self.type).shards
+
+    def delete(self):
+        get_redis_connection().delete(self._get_key(self.org, self.type))
+
+
+def _init_pool_process(progress_callback):
+    global _pool_progress_callback
+    _pool_progress_callback = progress_callback
+
+
+def _pull_shard_in_process(args):
+    org_id, type, index = args
+
+    Backfill.get(Org.objects.get(pk=org_id), type).pull_shard(index, _pool_progress_callback)
@@ -0,0 +1,217 @@
+import json
+import math
+import threading
+import time
+from datetime import timedelta
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import iso8601
+import requests
+from requests.structures import CaseInsensitiveDict
+from temba_client.utils import format_iso8601
+
+from django.utils.timezone import now
+
+CONTACT_NAMES = ["Ann", "Bob", "Cat", "Dan", "Eve", "Fra", "Gus", "Hal"]
+
+
+class FakeResponse(object):
+    """
+    Response from the fake RapidPro API which quacks like a requests response
+    """
+
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.content = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.headers = CaseInsensitiveDict(headers or {})
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError("%d Error" % self.status_code, response=self)
+
+
+class FakeRapidPro(object):
+    """
+    A stand-in for the RapidPro API v2 which serves synthetic fields, groups, labels, contacts and messages. It takes the
+    place of the requests session of a PooledTembaClient, so syncing can be run and measured without a live RapidPro.
+    Contacts and messages are generated on demand from their position so large volumes don't have to be held in memory,
+    newest first and one second apart, and are served in cursor paginated pages like the real API. Optionally every nth
+    request is answered with a rate limit error, and every request can be delayed to simulate network latency. Message
+    ids start above a high base so that they don't collide with those of real messages already synced into the org.
+    """
+
+    HOST = "http://rapidpro.fake"
+
+    GROUP_UUID = "11111111-0000-0000-0000-%012d"
+    LABEL_UUID = "22222222-0000-0000-0000-%012d"
+    CONTACT_UUID = "33333333-0000-0000-0000-%012d"
+
+    MESSAGE_ID_BASE = 1_000_000_000
+
+    def __init__(
+        self,
+        num_contacts=1000,
+        num_messages=1000,
+        num_fields=10,
+        num_groups=10,
+        num_labels=10,
+        groups_per_contact=2,
+        page_size=250,
+        latency=0.0,
+        rate_limit_every=0,
+        rate_limit_wait=1,
+        message_id_base=MESSAGE_ID_BASE,
+    ):
+        self.num_contacts = num_contacts
+        self.num_messages = num_messages
+        self.num_fields = num_fields
+        self.num_groups = num_groups
+        self.num_labels = num_labels
+        self.groups_per_contact = min(groups_per_contact, num_groups)
+        self.page_size = page_size
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.rate_limit_wait = rate_limit_wait
+        self.message_id_base = message_id_base
+        self.now = now()
+
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        self.num_rate_limited = 0
+        self.num_pages = 0
+
+        self.endpoints = {
+            "fields": self._fields,
+            "groups": self._groups,
+            "labels": self._labels,
+            "contacts": self._contacts,
+            "messages": self._messages,
+        }
+
+    def request(self, method, url, headers=None, verify=None, params=None, data=None):
+        """
+        Handles a request from the client in the same way as requests.Session.request
+        """
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self.lock:
+            self.num_requests += 1
+            if self.rate_limit_every and self.num_requests % self.rate_limit_every == 0:
+                self.num_rate_limited += 1
+                return FakeResponse(429, headers={"Retry-After": str(self.rate_limit_wait)})
+
+        parsed = urlparse(url)
+        endpoint = parsed.path.split("/")[-1].replace(".json", "")
+        query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        query.update(params or {})
+
+        if method != "get" or endpoint not in self.endpoints:
+            return FakeResponse(404)
+
+        start, end, item_fn = self.endpoints[endpoint](query)
+        return self._page(url.split("?")[0], query, start, end, item_fn)
+
+    def close(self):
+        pass
+
+    def _page(self, url, query, start, end, item_fn):
+        """
+        Serves a page of the items between the given positions, with a next link containing the cursor for the
+        following page
+        """
+        offset = int(query.pop("cursor", start))
+        page_end = min(offset + self.page_size, end)
+
+        next_url = None
+        if page_end < end:
+            next_url = "%s?%s" % (url, urlencode({**query, "cursor": page_end}))
+
+        with self.lock:
+            self.num_pages += 1
+
+        return FakeResponse(200, {"next": next_url, "results": [item_fn(i) for i in range(offset, page_end)]})
+
+    def _time_bounds(self, query, count):
+        """
+        Converts the after and before params of a query into the range of positions of the items which match them
+        """
+        start, end = 0, count
+        if query.get("before"):
+            start = max(start, math.ceil((self.now - iso8601.parse_date(query["before"])).total_seconds()))
+        if query.get("after"):
+            end = min(end, math.floor((self.now - iso8601.parse_date(query["after"])).total_seconds()) + 1)
+        return start, max(start, end)
+
+    def _timestamp(self, i):
+        return format_iso8601(self.now - timedelta(seconds=i))
+
+    def _fields(self, query):
+        return 0, self.num_fields, lambda i: {"key": "field_%d" % i, "name": "Field %d" % i, "type": "text"}
+
+    def _groups(self, query):
+        def group(i):
+            return {"uuid": self.GROUP_UUID % i, "name": "Group %d" % i, "query": None, "count": self.num_contacts}
+
+        return 0, self.num_groups, group
+
+    def _labels(self, query):
+        def label(i):
+            return {"uuid": self.LABEL_UUID % i, "name": "Label %d" % i, "count": 0}
+
+        return 0, self.num_labels, label
+
+    def _contact_ref(self, i):
+        return {"uuid": self.CONTACT_UUID % i, "name": CONTACT_NAMES[i % len(CONTACT_NAMES)]}
+
+    def _contacts(self, query):
+        if query.get("deleted"):
+            return 0, 0, None
+
+        def contact(i):
+            return {
+                **self._contact_ref(i),
+                "status": "active",
+                "language": "eng",
+                "urns": ["tel:+250788%06d" % i],
+                "groups": [
+                    {"uuid": self.GROUP_UUID % g, "name": "Group %d" % g}
+                    for g in [(i + n) % self.num_groups for n in range(self.groups_per_contact)]
+                ],
+                "fields": {"field_%d" % f: ("Value %d" % i if f % 2 == 0 else None) for f in range(self.num_fields)},
+                "created_on": self._timestamp(i),
+                "modified_on": self._timestamp(i),
+            }
+
+        return self._time_bounds(query, self.num_contacts) + (contact,)
+
+    def _messages(self, query):
+        def message(i):
+            # a third of messages are labelled
+            labels = []
+            if self.num_labels and i % 3 == 0:
+                n = i % self.num_labels
+                labels.append({"uuid": self.LABEL_UUID % n, "name": "Label %d" % n})
+
+            contact_num = i % max(self.num_contacts, 1)
+
+            return {
+                "id": self.message_id_base + self.num_messages - i,
+                "contact": self._contact_ref(contact_num),
+                "urn": "tel:+250788%06d" % contact_num,
+                "direction": "in",
+                "type": "inbox",
+                "status": "handled",
+                "visibility": "visible",
+                "text": "Message number %d" % i,
+                "labels": labels,
+                "attachments": [],
+                "flow": None,
+                "created_on": self._timestamp(i),
+                "modified_on": self._timestamp(i),
+            }
+
+        return self._time_bounds(query, self.num_messages) + (message,)
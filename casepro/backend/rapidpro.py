@@ -1,16 +1,37 @@
-from typing import Tuple
-
+import json
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+from typing import Optional, Tuple
+
+import requests
+from celery.utils.log import get_task_logger
 from dash.utils import chunks, is_dict_equal
 from dash.utils.sync import BaseSyncer, SyncOutcome, sync_local_to_changes, sync_local_to_set
-
+from temba_client.base import BaseClient
+from temba_client.exceptions import (
+    TembaBadRequestError,
+    TembaConnectionError,
+    TembaHttpError,
+    TembaNoSuchObjectError,
+    TembaRateExceededError,
+    TembaTokenError,
+)
+from temba_client.v2 import TembaClient
+
+from django.conf import settings
 from django.utils.timezone import now
 
 from casepro.contacts.models import Contact, Field, Group
-from casepro.msgs.models import Label, Message, Outgoing
+from casepro.msgs.models import Label, Labelling, Message, Outgoing
 from casepro.orgs_ext.models import Flow
 from casepro.utils.email import send_raw_email
 
-from . import BaseBackend
+from . import BaseBackend, SyncContext
+
+logger = get_task_logger(__name__)
 
 # no concept of flagging in RapidPro so that is modelled with a label
 SYSTEM_LABEL_FLAGGED = "Flagged"
@@ -27,13 +48,46 @@ def remote_message_is_archived(msg):
     return msg.visibility == "archived"
 
 
-class ContactSyncer(BaseSyncer):
+class ContextSyncer(BaseSyncer):
+    """
+    Base for syncers which share a SyncContext of org lookups with the save signal handlers for the whole sync run
+    """
+
+    context_attr = None
+
+    def __init__(self, backend=None):
+        super(ContextSyncer, self).__init__(backend)
+        self.context = None
+
+    def get_context(self, org):
+        if self.context is None or self.context.org.pk != org.pk:
+            self.context = SyncContext(org)
+        return self.context
+
+    def with_context(self, remote_as_kwargs):
+        """
+        Adds the context to the kwargs of a local instance so that it's available to its save signal handlers
+        """
+        if not self.context_attr:
+            return remote_as_kwargs
+
+        return {**remote_as_kwargs, self.context_attr: self.get_context(remote_as_kwargs["org"])}
+
+    def create_local(self, remote_as_kwargs):
+        return super(ContextSyncer, self).create_local(self.with_context(remote_as_kwargs))
+
+    def update_local(self, local, remote_as_kwargs):
+        return super(ContextSyncer, self).update_local(local, self.with_context(remote_as_kwargs))
+
+
+class ContactSyncer(ContextSyncer):
     """
     Syncer for contacts
     """
 
     model = Contact
     prefetch_related = ("groups",)
+    context_attr = Contact.SAVE_CONTEXT_ATTR
 
     def local_kwargs(self, org, remote):
         # groups and fields are updated via a post save signal handler
@@ -118,7 +172,7 @@ class GroupSyncer(BaseSyncer):
         )
 
 
-class LabelSyncer(BaseSyncer):
+class LabelSyncer(ContextSyncer):
     """
     Syncer for message labels
     """
@@ -131,9 +185,8 @@ class LabelSyncer(BaseSyncer):
             return None
 
         # don't create locally if there's an non-synced label with same name or UUID
-        for l in org.labels.all():
-            if not l.is_synced and (l.name == remote.name or l.uuid == remote.uuid):
-                return None
+        if self.get_context(org).has_unsynced_label(remote.uuid, remote.name):
+            return None
 
         return {"org": org, "uuid": remote.uuid, "name": remote.name}
 
@@ -144,7 +197,7 @@ class LabelSyncer(BaseSyncer):
         return super(LabelSyncer, self).fetch_all(org).filter(is_synced=True)
 
 
-class MessageSyncer(BaseSyncer):
+class MessageSyncer(ContextSyncer):
     """
     Syncer for messages
     """
@@ -154,6 +207,7 @@ class MessageSyncer(BaseSyncer):
     remote_id_attr = "id"
     select_related = ("contact",)
     prefetch_related = ("labels",)
+    context_attr = Message.SAVE_CONTEXT_ATTR
 
     def __init__(self, backend=None, as_handled=False):
         super(MessageSyncer, self).__init__(backend)
@@ -199,6 +253,364 @@ class MessageSyncer(BaseSyncer):
     def delete_local(self, local):
         local.release()
 
+    def sync_batch(self, org, remotes):
+        """
+        Syncs a batch of remote messages (e.g. a page fetched from RapidPro) using bulk queries rather than saving each
+        message individually. Contacts and labels are resolved once for the whole batch and the end state is the same as
+        syncing each message with sync_from_remote and the message save signal handlers.
+        :param org: the org
+        :param remotes: the remote messages
+        :return: dict of counts of created, updated, deleted, ignored local messages
+        """
+        from casepro.statistics.models import DailyCount, datetime_to_date
+
+        outcome_counts = {outcome: 0 for outcome in SyncOutcome}
+
+        # if a message appears more than once in a batch, only its last state matters
+        remotes_by_id = {self.identify_remote(r): r for r in remotes}
+        outcome_counts[SyncOutcome.ignored] += len(remotes) - len(remotes_by_id)
+
+        # one lock for the whole batch, taken before reading the existing messages and held until they've been written,
+        # so that concurrent pulls (e.g. the regular sync during a backfill) can't base their changes on stale rows
+        with Message.batch_sync_lock(org):
+            existing = self.fetch_all(org).filter(**{self.local_id_attr + "__in": remotes_by_id.keys()})
+            existing = existing.select_related(*self.select_related).prefetch_related(*self.prefetch_related)
+            existing_by_id = {self.identify_local(m): m for m in existing}
+
+            to_create, to_update, to_delete = [], [], []
+
+            for identity, remote in remotes_by_id.items():
+                local = existing_by_id.get(identity)
+                remote_as_kwargs = self.local_kwargs(org, remote)
+
+                if local:
+                    local.org = org
+
+                    if remote_as_kwargs:
+                        if self.update_required(local, remote, remote_as_kwargs) or not local.is_active:
+                            to_update.append((local, remote_as_kwargs))
+                            continue
+                    elif local.is_active:
+                        to_delete.append(local)
+                        continue
+                elif remote_as_kwargs:
+                    to_create.append(remote_as_kwargs)
+                    continue
+
+                outcome_counts[SyncOutcome.ignored] += 1
+
+            all_kwargs = to_create + [kwargs for local, kwargs in to_update]
+            contacts_by_uuid = Contact.get_or_create_bulk(
+                org, [kwargs[Message.SAVE_CONTACT_ATTR] for kwargs in all_kwargs]
+            )
+            # get labels, creating stubs for any that don't exist, but only keeping those which are synced
+            context = self.get_context(org)
+            labels_by_uuid = {}
+            for kwargs in all_kwargs:
+                for uuid, name in kwargs[Message.SAVE_LABELS_ATTR]:
+                    label = context.get_or_create_label(uuid, name)
+                    if label and label.is_synced:
+                        labels_by_uuid[uuid] = label
+
+            def to_local_fields(kwargs):
+                fields = {
+                    k: v for k, v in kwargs.items() if k not in (Message.SAVE_CONTACT_ATTR, Message.SAVE_LABELS_ATTR)
+                }
+                fields["contact"] = contacts_by_uuid[kwargs[Message.SAVE_CONTACT_ATTR][0]]
+                return fields
+
+            add_to_label = defaultdict(list)
+            remove_from_label = defaultdict(list)
+
+            # create new messages with a single insert, leaving any that were created elsewhere in the meantime, and
+            # then re-read them as the ids of inserted rows aren't returned when conflicts are ignored
+            new_ids = [kwargs[self.local_id_attr] for kwargs in to_create]
+            Message.objects.bulk_create(
+                [Message(**to_local_fields(kwargs)) for kwargs in to_create], ignore_conflicts=True
+            )
+            created_by_id = {
+                self.identify_local(m): m
+                for m in Message.objects.filter(**{"org": org, self.local_id_attr + "__in": new_ids})
+            }
+            outcome_counts[SyncOutcome.ignored] += len(new_ids) - len(created_by_id)
+
+            incoming_by_day = defaultdict(int)
+
+            for kwargs in to_create:
+                msg = created_by_id.get(kwargs[self.local_id_attr])
+                if not msg:
+                    continue
+
+                incoming_by_day[datetime_to_date(msg.created_on, org)] += 1
+
+                for uuid, name in kwargs[Message.SAVE_LABELS_ATTR]:
+                    if uuid in labels_by_uuid:
+                        add_to_label[labels_by_uuid[uuid]].append(msg)
+
+            DailyCount.record_items(DailyCount.TYPE_INCOMING, incoming_by_day, org)
+
+            # update changed messages with a single update
+            update_fields = {"contact", "is_active"}
+
+            for local, kwargs in to_update:
+                for field, value in to_local_fields(kwargs).items():
+                    setattr(local, field, value)
+                    update_fields.add(field)
+                local.is_active = True
+
+                new_label_uuids = {l[0] for l in kwargs[Message.SAVE_LABELS_ATTR]}
+                cur_labels_by_uuid = {l.uuid: l for l in local.labels.all() if l.uuid}
+
+                # don't remove un-synced local labels
+                for label in cur_labels_by_uuid.values():
+                    if label.uuid not in new_label_uuids and label.is_synced:
+                        remove_from_label[label].append(local)
+
+                for uuid in new_label_uuids:
+                    if uuid not in cur_labels_by_uuid and uuid in labels_by_uuid:
+                        add_to_label[labels_by_uuid[uuid]].append(local)
+
+            update_fields -= {"org", self.local_id_attr}
+            Message.objects.bulk_update([local for local, kwargs in to_update], fields=sorted(update_fields))
+
+            for label, messages in remove_from_label.items():
+                Labelling.unlabel_messages(org, messages, [label])
+
+            for label, messages in add_to_label.items():
+                Labelling.label_messages(label, messages)
+
+            for local in to_delete:
+                self.delete_local(local)
+
+        outcome_counts[SyncOutcome.created] += len(created_by_id)
+        outcome_counts[SyncOutcome.updated] += len(to_update)
+        outcome_counts[SyncOutcome.deleted] += len(to_delete)
+        return outcome_counts
+
+
+def sync_local_to_changes_in_batches(
+    org, syncer, fetches, progress_callback=None, time_limit: int = None
+) -> Tuple[dict, Optional[str]]:
+    """
+    Equivalent of sync_local_to_changes for syncers which can sync each fetch as a batch with a sync_batch method
+
+    :param * org: the org
+    :param * syncer: the local model syncer
+    :param * fetches: an iterator returning fetches of modified remote objects
+    :param * progress_callback: callable for tracking progress - called for each fetch with number of objects fetched
+                                and the cursor from which fetching could be resumed
+    :param * time_limit: number of seconds to limit fetching too (optional)
+    :return: tuple of a dict of counts of created, updated, deleted, ignored local instances and a possible cursor if
+             fetching didn't complete
+    """
+    num_synced = 0
+    outcome_counts = {outcome: 0 for outcome in SyncOutcome}
+    resume_cursor = None
+
+    start = time.time()
+
+    for fetch in fetches:
+        for outcome, count in syncer.sync_batch(org, fetch).items():
+            outcome_counts[outcome] += count
+
+        num_synced += len(fetch)
+        if progress_callback:
+            progress_callback(num_synced, fetches.get_cursor())
+
+        if time_limit and time.time() - start > time_limit:
+            resume_cursor = fetches.get_cursor()
+            break
+
+    return outcome_counts, resume_cursor
+
+
+class PipelinedFetches(object):
+    """
+    Wraps an iterator of fetches (e.g. from iterfetches) so that the next fetches are requested by a background thread
+    while the current fetch is being synced locally. get_cursor returns the cursor for after the last fetch returned by
+    this iterator rather than after the last fetch made in the background, so resuming from it doesn't skip anything.
+    """
+
+    _END = object()
+
+    def __init__(self, fetches, depth=2):
+        self.fetches = fetches
+        self.queue = queue.Queue(maxsize=depth)
+        self.cursor = None
+        self.stopped = threading.Event()
+
+        # metrics for working out whether we're waiting on the network or on local writes
+        self.num_fetches = 0
+        self.total_depth = 0
+        self.total_wait = 0.0
+
+        self.thread = threading.Thread(target=self._prefetch, daemon=True)
+        self.thread.start()
+
+    def _prefetch(self):
+        try:
+            for fetch in self.fetches:
+                if not self._put((fetch, self.fetches.get_cursor())):
+                    return
+        except Exception as e:
+            self._put(e)
+            return
+
+        self._put(self._END)
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        depth = self.queue.qsize()
+        start = time.time()
+        item = self.queue.get()
+
+        if item is self._END:
+            raise StopIteration()
+        if isinstance(item, Exception):
+            raise item
+
+        fetch, self.cursor = item
+
+        self.num_fetches += 1
+        self.total_depth += depth
+        self.total_wait += time.time() - start
+        return fetch
+
+    def get_cursor(self):
+        return self.cursor
+
+    def get_metrics(self):
+        """
+        Gets the number of fetches returned, their average queue depth when requested, and the total seconds spent
+        waiting on fetches. A low depth and high wait time means syncing is network-bound rather than DB-bound.
+        """
+        return {
+            "fetches": self.num_fetches,
+            "avg_depth": (self.total_depth / self.num_fetches) if self.num_fetches else 0,
+            "wait_seconds": self.total_wait,
+        }
+
+    def close(self):
+        self.stopped.set()
+
+
+class SessionClient(BaseClient):
+    """
+    Replaces the request method of the base RapidPro client so that requests are made through a requests session. Sits
+    below BaseCursorClient in the MRO of PooledTembaClient so that its rate limit retrying still applies.
+    """
+
+    def _request(self, method, url, params=None, body=None):
+        kwargs = {"headers": self.headers, "verify": self.verify_ssl}
+        if body:
+            kwargs["data"] = json.dumps(body)
+        if params:
+            kwargs["params"] = params
+
+        try:
+            response = self.session.request(method, url, **kwargs)
+
+            if response.status_code == 400:
+                try:
+                    errors = response.json()
+                except ValueError:
+                    errors = {"details": [response.content]}
+                raise TembaBadRequestError(errors)
+            elif response.status_code == 403:
+                raise TembaTokenError()
+            elif response.status_code == 404:
+                raise TembaNoSuchObjectError()
+            elif response.status_code == 429:
+                retry_after = response.headers.get("retry-after")
+                raise TembaRateExceededError(int(retry_after) if retry_after else 0)
+
+            response.raise_for_status()
+
+            return response.json() if response.content else None
+        except requests.HTTPError as ex:
+            raise TembaHttpError(ex)
+        except requests.exceptions.ConnectionError:
+            raise TembaConnectionError()
+
+
+class PooledTembaClient(TembaClient, SessionClient):
+    """
+    RapidPro API client which reuses the keep-alive connections of a shared session
+    """
+
+    def __init__(self, host, token, session, user_agent=None):
+        super(PooledTembaClient, self).__init__(host, token, user_agent=user_agent)
+
+        self.credentials = (host, token)
+        self.session = session
+
+
+class TembaClientPool(object):
+    """
+    Process-level registry of RapidPro API clients, one per org, so that back-to-back backend calls for an org reuse
+    the same HTTP connections. A client is replaced if the org's host or API token changes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.clients = {}
+
+    def get(self, org, host, token):
+        with self.lock:
+            # connections can't be shared with a forked worker process
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.clients = {}
+
+            client = self.clients.get(org.id)
+            if client and client.credentials != (host, token):
+                client.session.close()
+                client = None
+
+            if not client:
+                user_agent = getattr(settings, "SITE_API_USER_AGENT", None)
+                client = PooledTembaClient(host, token, requests.Session(), user_agent=user_agent)
+                self.clients[org.id] = client
+
+            return client
+
+    def get_stats(self, org):
+        """
+        Gets the number of requests made by the org's client and the number of connections opened to make them
+        """
+        client = self.clients.get(org.id)
+        num_requests, num_connections = 0, 0
+
+        if client:
+            for adapter in client.session.adapters.values():
+                pools = adapter.poolmanager.pools
+                for pool in [pools[key] for key in pools.keys()]:
+                    num_requests += pool.num_requests
+                    num_connections += pool.num_connections
+
+        return {"requests": num_requests, "connections": num_connections, "reused": num_requests - num_connections}
+
+    def clear(self):
+        with self.lock:
+            for client in self.clients.values():
+                client.session.close()
+            self.clients = {}
+
+
+CLIENT_POOL = TembaClientPool()
+
 
 class RapidProBackend(BaseBackend):
     """
@@ -210,9 +622,32 @@ class RapidProBackend(BaseBackend):
 
     FETCH_TIME_LIMIT = 30 * 60  # 30 minutes
 
+    # how many fetches to request ahead of syncing when pulling contacts and messages (zero to fetch serially)
+    FETCH_PIPELINE_DEPTH = 2
+
+    def __init__(self, backend, client=None):
+        super(RapidProBackend, self).__init__(backend)
+
+        self.client = client  # a specific client to use instead of a pooled one, e.g. for benchmarking
+
+    def _get_client(self, org):
+        if self.client:
+            return self.client
+        if not self.backend:
+            return org.get_temba_client(api_version=2)
+
+        return CLIENT_POOL.get(org, self.backend.host or settings.SITE_API_HOST, self.backend.api_token)
+
+    def _pipelined(self, fetches):
+        return PipelinedFetches(fetches, depth=self.FETCH_PIPELINE_DEPTH) if self.FETCH_PIPELINE_DEPTH else fetches
+
     @staticmethod
-    def _get_client(org):
-        return org.get_temba_client(api_version=2)
+    def _close_pipelined(org, fetches, name):
+        if isinstance(fetches, PipelinedFetches):
+            fetches.close()
+            logger.info(f"Pipelined fetching of {name} for org #{org.id}: {fetches.get_metrics()}")
+
+        logger.info(f"RapidPro connections for org #{org.id}: {CLIENT_POOL.get_stats(org)}")
 
     @staticmethod
     def _counts(d: dict) -> Tuple[int, int, int, int]:
@@ -223,20 +658,27 @@ class RapidProBackend(BaseBackend):
 
         # all contacts created or modified in RapidPro in the time window
         active_query = client.get_contacts(after=modified_after, before=modified_before)
-        fetches = active_query.iterfetches(retry_on_rate_exceed=True, resume_cursor=resume_cursor)
+        fetches = self._pipelined(active_query.iterfetches(retry_on_rate_exceed=True, resume_cursor=resume_cursor))
 
         # all contacts deleted in RapidPro in the same time window
         deleted_query = client.get_contacts(deleted=True, after=modified_after, before=modified_before)
         deleted_fetches = deleted_query.iterfetches(retry_on_rate_exceed=True)
 
-        counts, resume_cursor = sync_local_to_changes(
-            org,
-            ContactSyncer(backend=self.backend),
-            fetches,
-            deleted_fetches,
-            progress_callback,
-            time_limit=self.FETCH_TIME_LIMIT,
-        )
+        def progress(num):
+            if progress_callback:
+                progress_callback(num, fetches.get_cursor())
+
+        try:
+            counts, resume_cursor = sync_local_to_changes(
+                org,
+                ContactSyncer(backend=self.backend),
+                fetches,
+                deleted_fetches,
+                progress,
+                time_limit=self.FETCH_TIME_LIMIT,
+            )
+        finally:
+            self._close_pipelined(org, fetches, "contacts")
 
         return self._counts(counts) + (resume_cursor,)
 
@@ -265,16 +707,18 @@ class RapidProBackend(BaseBackend):
 
         # all incoming messages created or modified in RapidPro in the time window
         query = client.get_messages(folder="incoming", after=modified_after, before=modified_before)
-        fetches = query.iterfetches(retry_on_rate_exceed=True, resume_cursor=resume_cursor)
-
-        counts, resume_cursor = sync_local_to_changes(
-            org,
-            MessageSyncer(backend=self.backend, as_handled=as_handled),
-            fetches,
-            [],
-            progress_callback,
-            time_limit=self.FETCH_TIME_LIMIT,
-        )
+        fetches = self._pipelined(query.iterfetches(retry_on_rate_exceed=True, resume_cursor=resume_cursor))
+
+        try:
+            counts, resume_cursor = sync_local_to_changes_in_batches(
+                org,
+                MessageSyncer(backend=self.backend, as_handled=as_handled),
+                fetches,
+                progress_callback,
+                time_limit=self.FETCH_TIME_LIMIT,
+            )
+        finally:
+            self._close_pipelined(org, fetches, "messages")
 
         return self._counts(counts) + (resume_cursor,)
 
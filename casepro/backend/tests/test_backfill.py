@@ -0,0 +1,188 @@
+from datetime import datetime
+from unittest.mock import ANY, call, patch
+
+from django.utils import timezone
+
+from casepro.test import BaseCasesTest
+
+from ..backfill import Backfill, _init_pool_process, _pull_shard_in_process
+
+
+class InlineExecutor(object):
+    """
+    Stands in for a process pool in tests by running each job in this process and its database transaction
+    """
+
+    def __init__(self, max_workers, mp_context, initializer, initargs):
+        initializer(*initargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def map(self, fn, *iterables):
+        return map(fn, *iterables)
+
+
+class BackfillTest(BaseCasesTest):
+    def setUp(self):
+        super(BackfillTest, self).setUp()
+
+        self.d1 = datetime(2016, 1, 1, 0, 0, tzinfo=timezone.utc)
+        self.d2 = datetime(2016, 1, 2, 0, 0, tzinfo=timezone.utc)
+        self.d3 = datetime(2016, 1, 3, 0, 0, tzinfo=timezone.utc)
+        self.d4 = datetime(2016, 1, 4, 0, 0, tzinfo=timezone.utc)
+
+    def test_create_and_get(self):
+        self.assertIsNone(Backfill.get(self.unicef, Backfill.TYPE_MESSAGES))
+
+        backfill = Backfill.create(self.unicef, Backfill.TYPE_MESSAGES, self.d1, self.d4, 3, as_handled=True)
+
+        self.assertEqual(
+            [(s["since"], s["until"]) for s in backfill.shards],
+            [
+                (self.d1.isoformat(), self.d2.isoformat()),
+                (self.d2.isoformat(), self.d3.isoformat()),
+                (self.d3.isoformat(), self.d4.isoformat()),
+            ],
+        )
+        self.assertEqual(backfill.get_unfinished(), [0, 1, 2])
+
+        backfill = Backfill.get(self.unicef, Backfill.TYPE_MESSAGES)
+        self.assertEqual(len(backfill.shards), 3)
+        self.assertTrue(backfill.as_handled)
+
+        # backfills of other types or orgs are separate
+        self.assertIsNone(Backfill.get(self.unicef, Backfill.TYPE_CONTACTS))
+        self.assertIsNone(Backfill.get(self.nyaruka, Backfill.TYPE_MESSAGES))
+
+        backfill.delete()
+
+        self.assertIsNone(Backfill.get(self.unicef, Backfill.TYPE_MESSAGES))
+
+    @patch("casepro.test.TestBackend.pull_messages")
+    def test_pull_and_resume(self, mock_pull_messages):
+        backfill = Backfill.create(self.unicef, Backfill.TYPE_MESSAGES, self.d1, self.d4, 3)
+
+        # first shard takes two calls because of the time limit, second fails
+        mock_pull_messages.side_effect = [(2, 1, 0, 0, "cursor-1"), (3, 0, 0, 1, None), ValueError("boom")]
+
+        self.assertRaises(ValueError, backfill.pull)
+
+        mock_pull_messages.assert_has_calls(
+            [
+                call(self.unicef, self.d1, self.d2, False, ANY, resume_cursor=None),
+                call(self.unicef, self.d1, self.d2, False, ANY, resume_cursor="cursor-1"),
+                call(self.unicef, self.d2, self.d3, False, ANY, resume_cursor=None),
+            ]
+        )
+        mock_pull_messages.reset_mock()
+
+        # progress of the first shard was saved
+        backfill = Backfill.get(self.unicef, Backfill.TYPE_MESSAGES)
+        self.assertEqual(backfill.get_unfinished(), [1, 2])
+        self.assertEqual(backfill.get_totals(), (5, 1, 0, 1))
+
+        # resuming only pulls the unfinished shards
+        mock_pull_messages.side_effect = [(1, 0, 0, 0, None), (4, 0, 0, 0, None)]
+
+        backfill.pull()
+
+        mock_pull_messages.assert_has_calls(
+            [
+                call(self.unicef, self.d2, self.d3, False, ANY, resume_cursor=None),
+                call(self.unicef, self.d3, self.d4, False, ANY, resume_cursor=None),
+            ]
+        )
+
+        self.assertEqual(backfill.get_unfinished(), [])
+        self.assertEqual(backfill.get_totals(), (10, 1, 0, 1))
+
+        backfill.delete()
+
+    @patch("casepro.test.TestBackend.pull_contacts")
+    def test_pull_contacts(self, mock_pull_contacts):
+        backfill = Backfill.create(self.unicef, Backfill.TYPE_CONTACTS, self.d1, self.d3, 2)
+
+        mock_pull_contacts.side_effect = [(1, 2, 3, 0, None), (4, 5, 6, 0, None)]
+
+        backfill.pull()
+
+        mock_pull_contacts.assert_has_calls(
+            [
+                call(self.unicef, self.d1, self.d2, ANY, resume_cursor=None),
+                call(self.unicef, self.d2, self.d3, ANY, resume_cursor=None),
+            ]
+        )
+        self.assertEqual(backfill.get_totals(), (5, 7, 9, 0))
+
+        backfill.delete()
+
+    @patch("casepro.test.TestBackend.pull_messages")
+    def test_pull_checkpoints_each_page(self, mock_pull_messages):
+        backfill = Backfill.create(self.unicef, Backfill.TYPE_MESSAGES, self.d1, self.d2, 1)
+        progress = []
+
+        def pull_pages(org, since, until, as_handled, progress_callback, resume_cursor):
+            progress_callback(100, "cursor-1")
+            progress_callback(200, "cursor-2")
+            raise ValueError("boom")
+
+        mock_pull_messages.side_effect = pull_pages
+
+        self.assertRaises(ValueError, backfill.pull, 1, lambda s, n: progress.append((s, n)))
+        self.assertEqual(progress, [(0, 100), (0, 200)])
+
+        # cursor of the last page synced was saved so resuming doesn't re-pull the earlier pages
+        backfill = Backfill.get(self.unicef, Backfill.TYPE_MESSAGES)
+        self.assertEqual(backfill.shards[0]["cursor"], "cursor-2")
+        self.assertEqual(backfill.get_unfinished(), [0])
+
+        mock_pull_messages.side_effect = [(1, 0, 0, 0, None)]
+        mock_pull_messages.reset_mock()
+
+        backfill.pull()
+
+        mock_pull_messages.assert_called_once_with(self.unicef, self.d1, self.d2, False, ANY, resume_cursor="cursor-2")
+        self.assertEqual(backfill.get_unfinished(), [])
+
+        backfill.delete()
+
+    @patch("casepro.backend.backfill.connections.close_all")
+    @patch("casepro.backend.backfill.ProcessPoolExecutor", InlineExecutor)
+    @patch("casepro.test.TestBackend.pull_contacts")
+    def test_pull_in_processes(self, mock_pull_contacts, mock_close_all):
+        backfill = Backfill.create(self.unicef, Backfill.TYPE_CONTACTS, self.d1, self.d3, 2)
+
+        mock_pull_contacts.side_effect = [(1, 2, 3, 0, None), (4, 5, 6, 0, None)]
+
+        backfill.pull(2)
+
+        # database connections are closed before forking, and progress made by the other processes is reloaded
+        mock_close_all.assert_called_once_with()
+        self.assertEqual(backfill.get_unfinished(), [])
+        self.assertEqual(backfill.get_totals(), (5, 7, 9, 0))
+
+        backfill.delete()
+
+    @patch("casepro.test.TestBackend.pull_contacts")
+    def test_pull_shard_in_process(self, mock_pull_contacts):
+        backfill = Backfill.create(self.unicef, Backfill.TYPE_CONTACTS, self.d1, self.d3, 2)
+        progress = []
+
+        def pull_page(org, since, until, progress_callback, resume_cursor):
+            progress_callback(10, None)
+            return 1, 0, 0, 0, None
+
+        mock_pull_contacts.side_effect = pull_page
+
+        # each process gets the org and backfill itself, and reports progress to the callback it was started with
+        _init_pool_process(lambda s, n: progress.append((s, n)))
+        _pull_shard_in_process((self.unicef.pk, Backfill.TYPE_CONTACTS, 1))
+
+        self.assertEqual(progress, [(1, 10)])
+        self.assertEqual(Backfill.get(self.unicef, Backfill.TYPE_CONTACTS).get_unfinished(), [0])
+
+        backfill.delete()
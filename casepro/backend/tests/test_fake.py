@@ -0,0 +1,113 @@
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+
+from django.core.management import CommandError, call_command
+
+from casepro.contacts.models import Contact, Field, Group
+from casepro.msgs.models import Label, Message
+from casepro.test import BaseCasesTest
+
+from ..fake import FakeRapidPro
+from ..rapidpro import PooledTembaClient, RapidProBackend
+
+
+class FakeRapidProTest(BaseCasesTest):
+    def setUp(self):
+        super(FakeRapidProTest, self).setUp()
+
+        Field.objects.all().delete()
+        Group.objects.all().delete()
+        Label.objects.all().delete()
+
+        self.fake = FakeRapidPro(
+            num_contacts=25, num_messages=40, num_fields=4, num_groups=3, num_labels=2, page_size=10
+        )
+        client = PooledTembaClient(FakeRapidPro.HOST, "token", self.fake)
+        self.backend = RapidProBackend(self.unicef.backends.get(), client=client)
+
+    def test_pull(self):
+        self.assertEqual(self.backend.pull_fields(self.unicef), (4, 0, 0, 0))
+        self.assertEqual(self.backend.pull_groups(self.unicef), (3, 0, 0, 0))
+        self.assertEqual(self.backend.pull_labels(self.unicef), (2, 0, 0, 0))
+
+        self.assertEqual(self.backend.pull_contacts(self.unicef, None, None), (25, 0, 0, 0, None))
+
+        # contacts are served in pages, with an empty page for the deleted contacts
+        self.assertEqual(self.fake.num_pages, 1 + 1 + 1 + 3 + 1)
+
+        contact = Contact.objects.get(uuid="33333333-0000-0000-0000-000000000004")
+        self.assertEqual(contact.name, "Eve")
+        self.assertEqual(contact.urns, ["tel:+250788000004"])
+        self.assertEqual({g.name for g in contact.groups.all()}, {"Group 1", "Group 2"})
+        self.assertEqual(contact.get_fields(), {"field_0": "Value 4", "field_2": "Value 4"})
+
+        self.assertEqual(self.backend.pull_messages(self.unicef, None, None), (40, 0, 0, 0, None))
+
+        message = Message.objects.get(backend_id=FakeRapidPro.MESSAGE_ID_BASE + 40)
+        self.assertEqual(message.text, "Message number 0")
+        self.assertEqual(message.contact.uuid, "33333333-0000-0000-0000-000000000000")
+        self.assertEqual({l.name for l in message.labels.all()}, {"Label 0"})
+
+        # re-syncing changes nothing
+        self.assertEqual(self.backend.pull_messages(self.unicef, None, None), (0, 0, 0, 40, None))
+
+    def test_time_window(self):
+        since = self.fake.now - timedelta(seconds=19)
+        until = self.fake.now - timedelta(seconds=10)
+
+        self.assertEqual(self.backend.pull_messages(self.unicef, since, until), (10, 0, 0, 0, None))
+
+        self.assertEqual(
+            set(Message.objects.values_list("backend_id", flat=True)),
+            set(range(FakeRapidPro.MESSAGE_ID_BASE + 21, FakeRapidPro.MESSAGE_ID_BASE + 31)),
+        )
+
+    def test_message_id_base(self):
+        # synthetic messages don't collide with real ones already synced into the org
+        self.create_message(self.unicef, 40, self.create_contact(self.unicef, "C-001", "Ann"), "Real")
+
+        self.assertEqual(self.backend.pull_messages(self.unicef, None, None), (40, 0, 0, 0, None))
+        self.assertEqual(Message.objects.get(backend_id=40).text, "Real")
+
+        # but the base can be set explicitly
+        fake = FakeRapidPro(num_contacts=5, num_messages=5, num_labels=0, message_id_base=500)
+        backend = RapidProBackend(
+            self.unicef.backends.get(), client=PooledTembaClient(FakeRapidPro.HOST, "token", fake)
+        )
+        backend.pull_messages(self.unicef, None, None)
+
+        self.assertEqual(Message.objects.filter(backend_id__gt=500, backend_id__lte=505).count(), 5)
+
+    @patch("temba_client.base.time.sleep")
+    def test_rate_limiting(self, mock_sleep):
+        self.fake.rate_limit_every = 2
+
+        self.assertEqual(self.backend.pull_messages(self.unicef, None, None), (40, 0, 0, 0, None))
+
+        # every other request was rate limited and retried after waiting
+        self.assertEqual(self.fake.num_pages, 4)
+        self.assertEqual(self.fake.num_requests, 7)
+        self.assertEqual(self.fake.num_rate_limited, 3)
+        self.assertEqual(mock_sleep.call_count, 3)
+
+    def test_syncperf_command(self):
+        def syncperf(*args):
+            out = StringIO()
+            call_command(
+                "syncperf", self.unicef.pk, "--contacts=5", "--messages=10", "--page-size=4", *args, stdout=out
+            )
+            return out.getvalue()
+
+        output = syncperf()
+        self.assertIn(" > Contacts: 5 created, 0 updated, 0 deleted, 0 ignored", output)
+        self.assertIn(" > Messages: 10 created, 0 updated, 0 deleted, 0 ignored", output)
+        self.assertIn("Rolled back synced data", output)
+        self.assertEqual(Message.objects.count(), 0)
+
+        output = syncperf("--keep")
+        self.assertNotIn("Rolled back synced data", output)
+        self.assertEqual(Message.objects.count(), 10)
+
+        with self.assertRaises(CommandError):
+            call_command("syncperf", 12345)
@@ -4,7 +4,9 @@ from unittest import skip
 from unittest.mock import call, patch
 
 from dash.orgs.models import Org
-from dash.test import MockClientQuery
+from dash.test import MockClientQuery, MockResponse
+from dash.utils.sync import SyncOutcome
+from temba_client.exceptions import TembaBadRequestError, TembaTokenError
 from temba_client.v2.types import (
     Broadcast as TembaBroadcast,
     Contact as TembaContact,
@@ -20,11 +22,70 @@ from django.utils import timezone
 from django.utils.timezone import now
 
 from casepro.contacts.models import Contact, Field, Group
-from casepro.msgs.models import Label, Message, Outgoing
+from casepro.msgs.models import Label, Labelling, Message, Outgoing
 from casepro.orgs_ext.models import Flow
+from casepro.profiles.models import Notification
+from casepro.statistics.models import DailyCount
 from casepro.test import BaseCasesTest
 
-from ..rapidpro import ContactSyncer, MessageSyncer, RapidProBackend
+from .. import SyncContext
+from ..rapidpro import (
+    ContactSyncer,
+    MessageSyncer,
+    PipelinedFetches,
+    PooledTembaClient,
+    RapidProBackend,
+    TembaClientPool,
+)
+
+
+class SyncContextTest(BaseCasesTest):
+    def test_labels(self):
+        context = SyncContext(self.unicef)
+
+        # labels are fetched once and then re-used
+        with self.assertNumQueries(1):
+            self.assertTrue(context.has_unsynced_label("L-099", "Tea"))
+            self.assertTrue(context.has_unsynced_label(self.tea.uuid, "Coffee"))
+            self.assertFalse(context.has_unsynced_label("L-001", "AIDS"))
+            self.assertEqual(context.get_or_create_label("L-001", "AIDS"), self.aids)
+
+        # label that clashes with an unsynced label isn't created
+        self.assertIsNone(context.get_or_create_label("L-099", "Tea"))
+
+        # new labels are created as stubs and then re-used
+        with self.assertNumQueries(4):
+            important = context.get_or_create_label("L-007", "Important")
+            self.assertEqual(context.get_or_create_label("L-007", "Important"), important)
+
+        self.assertEqual((important.org, important.uuid, important.is_active), (self.unicef, "L-007", False))
+
+        # a stub created by another sync since our labels were loaded is re-used rather than clashing
+        other = SyncContext(self.unicef)
+        other.has_unsynced_label("L-008", "Urgent")
+        urgent = context.get_or_create_label("L-008", "Urgent")
+
+        self.assertEqual(other.get_or_create_label("L-008", "Urgent"), urgent)
+
+    def test_groups(self):
+        context = SyncContext(self.unicef)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(context.get_or_create_group(self.males.uuid, "Males"), self.males)
+            self.assertEqual(context.get_or_create_group(self.females.uuid, "Females"), self.females)
+
+        with self.assertNumQueries(4):
+            customers = context.get_or_create_group("G-009", "Customers")
+            self.assertEqual(context.get_or_create_group("G-009", "Customers"), customers)
+
+        self.assertEqual((customers.org, customers.name, customers.is_active), (self.unicef, "Customers", False))
+
+        # a stub created by another sync since our groups were loaded is re-used rather than clashing
+        other = SyncContext(self.unicef)
+        other.get_or_create_group(self.males.uuid, "Males")
+        suppliers = context.get_or_create_group("G-010", "Suppliers")
+
+        self.assertEqual(other.get_or_create_group("G-010", "Suppliers"), suppliers)
 
 
 class ContactSyncerTest(BaseCasesTest):
@@ -355,6 +416,122 @@ class MessageSyncerTest(BaseCasesTest):
             )
         )
 
+    def test_sync_batch(self):
+        d1 = now() - timedelta(hours=2)
+        d2 = now() - timedelta(hours=1)
+
+        self.aids.watch(self.admin)
+
+        msg1 = self.create_message(self.unicef, 101, self.ann, "Hi", [self.aids, self.tea], created_on=d1)
+        msg2 = self.create_message(self.unicef, 102, self.ann, "Hello", [self.pregnancy], created_on=d1)
+        msg3 = self.create_message(self.unicef, 103, self.ann, "Unchanged", [self.aids], created_on=d1)
+        DailyCount.objects.all().delete()
+
+        def remote(id, contact, labels, visibility="visible", text="Yes", created_on=d2):
+            return TembaMessage.create(
+                id=id,
+                contact=ObjectRef.create(uuid=contact[0], name=contact[1]),
+                type="text",
+                text=text,
+                visibility=visibility,
+                labels=[ObjectRef.create(uuid=l[0], name=l[1]) for l in labels],
+                created_on=created_on,
+            )
+
+        remotes = [
+            # existing messages which have been relabelled and archived, deleted or are unchanged
+            remote(101, ("C-001", "Ann"), [("L-002", "Pregnancy"), ("L-007", "Important")], "archived", "Hi", d1),
+            remote(102, ("C-001", "Ann"), [], "deleted", "Hello", d1),
+            remote(103, ("C-001", "Ann"), [("L-001", "AIDS")], text="Unchanged", created_on=d1),
+            # new messages from an existing contact and new contacts, with existing and new labels
+            remote(104, ("C-001", "Ann"), [("L-001", "AIDS"), ("L-009", "Flagged")]),
+            remote(105, ("C-002", "Bob"), [("L-007", "Important")]),
+            remote(106, ("C-002", "Bob"), [("L-001", "AIDS"), ("L-008", "Tea")]),
+            remote(107, ("C-003", "Cat"), [], "archived"),
+        ]
+
+        counts = self.syncer.sync_batch(self.unicef, remotes)
+
+        self.assertEqual(
+            counts,
+            {SyncOutcome.created: 4, SyncOutcome.updated: 1, SyncOutcome.deleted: 1, SyncOutcome.ignored: 1},
+        )
+
+        important = Label.objects.get(org=self.unicef, uuid="L-007", name="Important", is_active=False)
+        self.assertFalse(Label.objects.filter(uuid="L-008").exists())  # conflicts with an unsynced label
+
+        bob = Contact.objects.get(org=self.unicef, uuid="C-002", name="Bob", is_stub=True)
+        cat = Contact.objects.get(org=self.unicef, uuid="C-003", name="Cat", is_stub=True)
+
+        msg1.refresh_from_db()
+        msg2.refresh_from_db()
+        msg4 = Message.objects.get(backend_id=104)
+        msg5 = Message.objects.get(backend_id=105)
+        msg6 = Message.objects.get(backend_id=106)
+        msg7 = Message.objects.get(backend_id=107)
+
+        self.assertTrue(msg1.is_archived)
+        self.assertEqual(set(msg1.labels.all()), {self.pregnancy, important, self.tea})  # unsynced label is kept
+        self.assertEqual(
+            set(Labelling.objects.filter(message=msg1).values_list("message_is_archived", flat=True)), {True}
+        )
+        self.assertFalse(msg2.is_active)
+        self.assertEqual(set(msg2.labels.all()), set())
+        self.assertEqual(set(msg3.labels.all()), {self.aids})
+
+        self.assertEqual((msg4.contact, msg4.text, msg4.is_flagged, msg4.is_archived), (self.ann, "Yes", True, False))
+        self.assertEqual(set(msg4.labels.all()), {self.aids})
+        self.assertTrue(msg4.has_labels)
+        self.assertEqual((msg5.contact, set(msg5.labels.all())), (bob, {important}))
+        self.assertEqual((msg6.contact, set(msg6.labels.all())), (bob, {self.aids}))
+        self.assertEqual((msg7.contact, msg7.is_archived, msg7.has_labels), (cat, True, False))
+
+        # watchers of labels are notified
+        self.assertEqual(
+            set(Notification.objects.filter(user=self.admin).values_list("message__backend_id", flat=True)),
+            {101, 103, 104, 106},
+        )
+
+        # and the same daily counts are recorded as the signal handlers would
+        self.assertEqual(DailyCount.get_by_org([self.unicef], DailyCount.TYPE_INCOMING).total(), 4)
+        self.assertEqual(DailyCount.get_by_label([self.aids], DailyCount.TYPE_INCOMING).total(), 1)
+        self.assertEqual(DailyCount.get_by_label([self.pregnancy], DailyCount.TYPE_INCOMING).total(), 1)
+        self.assertEqual(DailyCount.get_by_label([important], DailyCount.TYPE_INCOMING).total(), 2)
+
+        # syncing again is a no-op, except for #106 which always looks relabelled because of its unsynced label
+        self.assertEqual(
+            self.syncer.sync_batch(self.unicef, remotes[2:]),
+            {SyncOutcome.created: 0, SyncOutcome.updated: 1, SyncOutcome.deleted: 0, SyncOutcome.ignored: 4},
+        )
+        self.assertEqual(set(msg6.labels.all()), {self.aids})
+
+        # the whole batch is synced under a single lock rather than one per message
+        with patch.object(Message, "batch_sync_lock", wraps=Message.batch_sync_lock) as mock_batch_sync_lock:
+            with patch.object(self.syncer, "lock") as mock_lock:
+                self.syncer.sync_batch(self.unicef, remotes[2:])
+
+        mock_batch_sync_lock.assert_called_once_with(self.unicef)
+        self.assertNotCalled(mock_lock)
+
+        # a new message which is created elsewhere after we looked for existing ones doesn't break the batch
+        get_or_create_bulk = Contact.get_or_create_bulk
+
+        def create_elsewhere_first(org, contacts):
+            self.create_message(self.unicef, 108, bob, "Yes", [self.aids], created_on=d2)
+            return get_or_create_bulk(org, contacts)
+
+        with patch.object(Contact, "get_or_create_bulk", side_effect=create_elsewhere_first):
+            self.syncer.sync_batch(
+                self.unicef,
+                [
+                    remote(108, ("C-002", "Bob"), [("L-001", "AIDS")]),
+                    remote(109, ("C-002", "Bob"), [("L-001", "AIDS")]),
+                ],
+            )
+
+        self.assertEqual(Message.objects.filter(backend_id=108).count(), 1)
+        self.assertEqual(set(Message.objects.get(backend_id=109).labels.all()), {self.aids})
+
     def test_delete_local(self):
         local = self.create_message(self.unicef, 101, self.ann, "Yes", [self.aids], is_flagged=False)
         self.syncer.delete_local(local)
@@ -363,6 +540,120 @@ class MessageSyncerTest(BaseCasesTest):
         self.assertEqual(set(local.labels.all()), set())
 
 
+class PipelinedFetchesTest(BaseCasesTest):
+    class Fetches:
+        def __init__(self, *fetches, error=None):
+            self.fetches = list(fetches)
+            self.error = error
+            self.num_fetched = 0
+
+        def __iter__(self):
+            return self
+
+        def __next__(self):
+            if not self.fetches:
+                if self.error:
+                    raise self.error
+                raise StopIteration()
+
+            self.num_fetched += 1
+            return self.fetches.pop(0)
+
+        def get_cursor(self):
+            return "cursor-%d" % self.num_fetched if self.fetches else None
+
+    def test_iteration(self):
+        underlying = self.Fetches([1, 2], [3], [4, 5])
+        fetches = PipelinedFetches(underlying, depth=2)
+
+        self.assertIsNone(fetches.get_cursor())
+
+        # cursor is that for after the last fetch returned, even if more have been fetched in the background
+        self.assertEqual(next(fetches), [1, 2])
+        self.assertEqual(fetches.get_cursor(), "cursor-1")
+        self.assertEqual(next(fetches), [3])
+        self.assertEqual(fetches.get_cursor(), "cursor-2")
+        self.assertEqual(next(fetches), [4, 5])
+        self.assertIsNone(fetches.get_cursor())
+
+        self.assertRaises(StopIteration, next, fetches)
+
+        metrics = fetches.get_metrics()
+        self.assertEqual(metrics["fetches"], 3)
+        self.assertEqual(set(metrics.keys()), {"fetches", "avg_depth", "wait_seconds"})
+
+        fetches.close()
+
+    def test_error(self):
+        fetches = PipelinedFetches(self.Fetches([1, 2], error=ValueError("boom")), depth=2)
+
+        self.assertEqual(next(fetches), [1, 2])
+        self.assertRaises(ValueError, next, fetches)
+
+    def test_close(self):
+        underlying = self.Fetches(*[[i] for i in range(10)])
+        fetches = PipelinedFetches(underlying, depth=1)
+
+        self.assertEqual(next(fetches), [0])
+
+        # closing stops background fetching
+        fetches.close()
+        fetches.thread.join(timeout=1)
+
+        self.assertFalse(fetches.thread.is_alive())
+        self.assertLess(underlying.num_fetched, 10)
+
+
+class TembaClientPoolTest(BaseCasesTest):
+    def setUp(self):
+        super(TembaClientPoolTest, self).setUp()
+
+        self.pool = TembaClientPool()
+
+    def tearDown(self):
+        self.pool.clear()
+
+        super(TembaClientPoolTest, self).tearDown()
+
+    def test_get(self):
+        client1 = self.pool.get(self.unicef, "http://rapidpro.io", "token1")
+        self.assertIsInstance(client1, PooledTembaClient)
+        self.assertEqual(client1.root_url, "http://rapidpro.io/api/v2")
+        self.assertEqual(client1.headers["Authorization"], "Token token1")
+
+        # same client is reused for the same org and credentials
+        self.assertIs(self.pool.get(self.unicef, "http://rapidpro.io", "token1"), client1)
+
+        # but not for other orgs
+        client2 = self.pool.get(self.nyaruka, "http://rapidpro.io", "token2")
+        self.assertIsNot(client2, client1)
+
+        # or if the org's token changes
+        client3 = self.pool.get(self.unicef, "http://rapidpro.io", "token3")
+        self.assertIsNot(client3, client1)
+        self.assertEqual(client3.headers["Authorization"], "Token token3")
+
+        self.assertEqual(self.pool.get_stats(self.unicef), {"requests": 0, "connections": 0, "reused": 0})
+
+    def test_request(self):
+        client = self.pool.get(self.unicef, "http://rapidpro.io", "token1")
+
+        with patch.object(client.session, "request") as mock_request:
+            mock_request.return_value = MockResponse(200, '{"results": [], "next": null}')
+
+            self.assertEqual(client.get_labels().all(), [])
+
+            mock_request.assert_called_once_with(
+                "get", "http://rapidpro.io/api/v2/labels.json", headers=client.headers, verify=None
+            )
+
+            mock_request.return_value = MockResponse(403, "")
+            self.assertRaises(TembaTokenError, client.get_labels().all)
+
+            mock_request.return_value = MockResponse(400, '{"name": ["required"]}')
+            self.assertRaises(TembaBadRequestError, client.create_label, "")
+
+
 class RapidProBackendTest(BaseCasesTest):
     def setUp(self):
         super(RapidProBackendTest, self).setUp()
@@ -423,7 +714,7 @@ class RapidProBackendTest(BaseCasesTest):
             ),
         ]
 
-        with self.assertNumQueries(14):
+        with self.assertNumQueries(18):
             num_created, num_updated, num_deleted, num_ignored, _ = self.backend.pull_contacts(self.unicef, None, None)
 
         self.assertEqual((num_created, num_updated, num_deleted, num_ignored), (3, 0, 0, 0))
@@ -469,7 +760,7 @@ class RapidProBackendTest(BaseCasesTest):
             ),
         ]
 
-        with self.assertNumQueries(12):
+        with self.assertNumQueries(11):
             self.assertEqual(self.backend.pull_contacts(self.unicef, None, None), (0, 1, 1, 0, None))
 
         self.assertEqual(set(Contact.objects.filter(is_active=True)), {bob, ann})
@@ -501,7 +792,7 @@ class RapidProBackendTest(BaseCasesTest):
             MockClientQuery([]),
         ]
 
-        with self.assertNumQueries(4):
+        with self.assertNumQueries(3):
             self.assertEqual(self.backend.pull_contacts(self.unicef, None, None), (0, 1, 0, 0, None))
 
         self.assertEqual(set(Contact.objects.filter(is_active=True)), {bob, ann})
@@ -519,7 +810,7 @@ class RapidProBackendTest(BaseCasesTest):
             ]
         )
 
-        with self.assertNumQueries(6):
+        with self.assertNumQueries(5):
             num_created, num_updated, num_deleted, num_ignored = self.backend.pull_fields(self.unicef)
 
         self.assertEqual((num_created, num_updated, num_deleted, num_ignored), (2, 0, 0, 0))
@@ -534,7 +825,7 @@ class RapidProBackendTest(BaseCasesTest):
             ]
         )
 
-        with self.assertNumQueries(7):
+        with self.assertNumQueries(6):
             num_created, num_updated, num_deleted, num_ignored = self.backend.pull_fields(self.unicef)
 
         self.assertEqual((num_created, num_updated, num_deleted, num_ignored), (1, 1, 1, 0))
@@ -544,7 +835,7 @@ class RapidProBackendTest(BaseCasesTest):
         Field.objects.get(key="homestate", label="Homestate", value_type="S", is_active=True)
 
         # check that no changes means no updates
-        with self.assertNumQueries(4):
+        with self.assertNumQueries(3):
             num_created, num_updated, num_deleted, num_ignored = self.backend.pull_fields(self.unicef)
 
         self.assertEqual((num_created, num_updated, num_deleted, num_ignored), (0, 0, 0, 2))
@@ -561,7 +852,7 @@ class RapidProBackendTest(BaseCasesTest):
             ]
         )
 
-        with self.assertNumQueries(6):
+        with self.assertNumQueries(5):
             num_created, num_updated, num_deleted, num_ignored = self.backend.pull_groups(self.unicef)
 
         self.assertEqual((num_created, num_updated, num_deleted, num_ignored), (2, 0, 0, 0))
@@ -576,7 +867,7 @@ class RapidProBackendTest(BaseCasesTest):
             ]
         )
 
-        with self.assertNumQueries(7):
+        with self.assertNumQueries(6):
             num_created, num_updated, num_deleted, num_ignored = self.backend.pull_groups(self.unicef)
 
         self.assertEqual((num_created, num_updated, num_deleted, num_ignored), (1, 1, 1, 0))
@@ -586,7 +877,7 @@ class RapidProBackendTest(BaseCasesTest):
         Group.objects.get(uuid="G-003", name="Spammers", count=13, is_dynamic=False, is_active=True)
 
         # check that no changes means no updates
-        with self.assertNumQueries(4):
+        with self.assertNumQueries(3):
             num_created, num_updated, num_deleted, num_ignored = self.backend.pull_groups(self.unicef)
 
         self.assertEqual((num_created, num_updated, num_deleted, num_ignored), (0, 0, 0, 2))
@@ -608,7 +899,7 @@ class RapidProBackendTest(BaseCasesTest):
 
         self.unicef = Org.objects.prefetch_related("labels").get(pk=self.unicef.pk)
 
-        with self.assertNumQueries(8):
+        with self.assertNumQueries(7):
             num_created, num_updated, num_deleted, num_ignored = self.backend.pull_labels(self.unicef)
 
         self.assertEqual((num_created, num_updated, num_deleted, num_ignored), (2, 0, 0, 2))
@@ -626,7 +917,7 @@ class RapidProBackendTest(BaseCasesTest):
             ]
         )
 
-        with self.assertNumQueries(7):
+        with self.assertNumQueries(6):
             num_created, num_updated, num_deleted, num_ignored = self.backend.pull_labels(self.unicef)
 
         self.assertEqual((num_created, num_updated, num_deleted, num_ignored), (1, 1, 1, 0))
@@ -637,7 +928,7 @@ class RapidProBackendTest(BaseCasesTest):
         Label.objects.get(uuid="L-003", name="Spam", is_active=True)
 
         # check that no changes means no updates
-        with self.assertNumQueries(4):
+        with self.assertNumQueries(3):
             num_created, num_updated, num_deleted, num_ignored = self.backend.pull_labels(self.unicef)
 
         self.assertEqual((num_created, num_updated, num_deleted, num_ignored), (0, 0, 0, 2))
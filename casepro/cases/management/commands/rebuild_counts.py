@@ -0,0 +1,376 @@
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, time, timedelta
+from math import ceil
+
+from dash.orgs.models import Org
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+from django.db.models import Q
+from django.utils.timezone import now
+
+from casepro.cases.models import CaseAction, Partner
+from casepro.msgs.models import Label, Outgoing
+from casepro.statistics.models import DailyCount, DailySecondTotalCount, TotalCount, datetime_to_date
+
+DAILY = "daily"
+SECONDS = "seconds"
+
+# item types which are also counted in total counts
+TOTAL_ITEM_TYPES = (DailyCount.TYPE_REPLIES, DailyCount.TYPE_CASE_OPENED, DailyCount.TYPE_CASE_CLOSED)
+
+INCOMING_SQL = """
+SELECT (m."created_on" AT TIME ZONE %(tz)s)::date, COUNT(*)
+FROM msgs_message m
+WHERE m."org_id" = %(org)s AND m."created_on" >= %(start)s AND m."created_on" < %(end)s
+GROUP BY 1
+"""
+
+LABELLED_SQL = """
+SELECT (ml."message_created_on" AT TIME ZONE %(tz)s)::date, ml."label_id", COUNT(*)
+FROM msgs_message_labels ml
+INNER JOIN msgs_label l ON l."id" = ml."label_id"
+WHERE l."org_id" = %(org)s AND ml."message_created_on" >= %(start)s AND ml."message_created_on" < %(end)s
+GROUP BY 1, 2
+"""
+
+REPLIES_SQL = """
+SELECT (o."created_on" AT TIME ZONE %(tz)s)::date, o."created_by_id", o."partner_id", COUNT(*)
+FROM msgs_outgoing o
+WHERE o."org_id" = %(org)s AND o."activity" = ANY(%(reply_activities)s)
+    AND o."created_on" >= %(start)s AND o."created_on" < %(end)s
+GROUP BY 1, 2, 3
+"""
+
+OPENED_SQL = """
+SELECT (a."created_on" AT TIME ZONE %(tz)s)::date, a."created_by_id", a."assignee_id", COUNT(*)
+FROM cases_caseaction a
+WHERE a."org_id" = %(org)s AND a."action" = %(open)s AND a."created_on" >= %(start)s AND a."created_on" < %(end)s
+GROUP BY 1, 2, 3
+"""
+
+# only the first close of each case is counted, along with who the case was assigned to and since when at the time
+CLOSED_SQL = """
+WITH closes AS (
+    SELECT DISTINCT ON (a."case_id") a."case_id", a."created_on", a."created_by_id"
+    FROM cases_caseaction a
+    WHERE a."org_id" = %(org)s AND a."action" = %(close)s AND a."case_id" IN (
+        SELECT "case_id" FROM cases_caseaction
+        WHERE "org_id" = %(org)s AND "action" = %(close)s AND "created_on" >= %(start)s AND "created_on" < %(end)s
+    )
+    ORDER BY a."case_id", a."created_on", a."id"
+)
+SELECT
+    (cl."created_on" AT TIME ZONE %(tz)s)::date,
+    cl."created_by_id",
+    COALESCE(asg."assignee_id", c."assignee_id"),
+    EXTRACT(EPOCH FROM cl."created_on" - c."opened_on"),
+    EXTRACT(
+        EPOCH FROM cl."created_on" - CASE WHEN asg."action" = %(reassign)s THEN asg."created_on" ELSE c."opened_on" END
+    )
+FROM closes cl
+INNER JOIN cases_case c ON c."id" = cl."case_id"
+LEFT JOIN LATERAL (
+    SELECT a."action", a."assignee_id", a."created_on" FROM cases_caseaction a
+    WHERE a."case_id" = cl."case_id" AND a."action" IN (%(open)s, %(reassign)s) AND a."created_on" <= cl."created_on"
+    ORDER BY a."created_on" DESC, a."id" DESC LIMIT 1
+) asg ON TRUE
+WHERE cl."created_on" >= %(start)s AND cl."created_on" < %(end)s
+"""
+
+FIRST_REPLIES_SQL = """
+SELECT (MIN(o."created_on") AT TIME ZONE %(tz)s)::date, EXTRACT(EPOCH FROM MIN(o."created_on") - c."opened_on")
+FROM cases_case c
+INNER JOIN msgs_outgoing o ON o."case_id" = c."id" AND o."activity" = ANY(%(reply_activities)s)
+WHERE c."org_id" = %(org)s AND c."id" IN (
+    SELECT "case_id" FROM msgs_outgoing
+    WHERE "org_id" = %(org)s AND "created_on" >= %(start)s AND "created_on" < %(end)s AND "case_id" IS NOT NULL
+)
+GROUP BY c."id", c."opened_on"
+HAVING MIN(o."created_on") >= %(start)s AND MIN(o."created_on") < %(end)s
+"""
+
+# the first reply by each partner a case was assigned to, in each period it was assigned to them, unless they opened it
+FIRST_ASSIGNEE_REPLIES_SQL = """
+WITH periods AS (
+    SELECT
+        a."case_id",
+        a."action",
+        a."assignee_id",
+        a."created_on" AS "start",
+        LEAD(a."created_on") OVER (PARTITION BY a."case_id" ORDER BY a."created_on", a."id") AS "finish"
+    FROM cases_caseaction a
+    WHERE a."org_id" = %(org)s AND a."action" IN (%(open)s, %(reassign)s) AND a."case_id" IN (
+        SELECT "case_id" FROM msgs_outgoing
+        WHERE "org_id" = %(org)s AND "created_on" >= %(start)s AND "created_on" < %(end)s AND "case_id" IS NOT NULL
+    )
+)
+SELECT
+    (MIN(o."created_on") AT TIME ZONE %(tz)s)::date,
+    p."assignee_id",
+    EXTRACT(EPOCH FROM MIN(o."created_on") - CASE WHEN p."action" = %(open)s THEN c."opened_on" ELSE p."start" END)
+FROM periods p
+INNER JOIN cases_case c ON c."id" = p."case_id"
+INNER JOIN msgs_outgoing o ON o."case_id" = p."case_id" AND o."partner_id" = p."assignee_id"
+    AND o."activity" = ANY(%(reply_activities)s)
+    AND o."created_on" >= p."start" AND (p."finish" IS NULL OR o."created_on" < p."finish")
+WHERE c."opened_by_partner_id" IS DISTINCT FROM p."assignee_id"
+GROUP BY p."case_id", p."assignee_id", p."action", p."start", c."opened_on"
+HAVING MIN(o."created_on") >= %(start)s AND MIN(o."created_on") < %(end)s
+"""
+
+
+def compute_counts(org_id, since, until, incoming_since=None):
+    """
+    Computes daily counts for the given org and range of days from the source data, as a dict of (model key, day,
+    item type, scope) to (count, seconds). Runs in a worker process so uses its own database connection.
+    """
+    org = Org.objects.get(pk=org_id)
+    tz = org.timezone
+    params = {
+        "org": org_id,
+        "tz": str(tz),
+        "start": datetime.combine(since, time.min, tz),
+        "end": datetime.combine(until, time.min, tz),
+        "reply_activities": list(Outgoing.REPLY_ACTIVITIES),
+        "open": CaseAction.OPEN,
+        "reassign": CaseAction.REASSIGN,
+        "close": CaseAction.CLOSE,
+    }
+    partner_users = set(Partner.users.through.objects.filter(partner__org=org).values_list("partner_id", "user_id"))
+
+    counts = defaultdict(lambda: [0, 0])
+
+    def count(model_key, day, item_type, scope, num, seconds=0):
+        counts[(model_key, day, item_type, scope)][0] += num
+        counts[(model_key, day, item_type, scope)][1] += seconds
+
+    def user_scope(user_id):
+        return "org:%d:user:%d" % (org_id, user_id)
+
+    org_scope = "org:%d" % org_id
+
+    with connection.cursor() as cursor:
+        cursor.execute(INCOMING_SQL, params)
+        for day, num in cursor.fetchall():
+            if not incoming_since or day >= incoming_since:
+                count(DAILY, day, DailyCount.TYPE_INCOMING, org_scope, num)
+
+        cursor.execute(LABELLED_SQL, params)
+        for day, label_id, num in cursor.fetchall():
+            count(DAILY, day, DailyCount.TYPE_INCOMING, "label:%d" % label_id, num)
+
+        cursor.execute(REPLIES_SQL, params)
+        for day, user_id, partner_id, num in cursor.fetchall():
+            count(DAILY, day, DailyCount.TYPE_REPLIES, org_scope, num)
+            count(DAILY, day, DailyCount.TYPE_REPLIES, user_scope(user_id), num)
+            if partner_id:
+                count(DAILY, day, DailyCount.TYPE_REPLIES, "partner:%d" % partner_id, num)
+
+        cursor.execute(OPENED_SQL, params)
+        for day, user_id, partner_id, num in cursor.fetchall():
+            count(DAILY, day, DailyCount.TYPE_CASE_OPENED, org_scope, num)
+            count(DAILY, day, DailyCount.TYPE_CASE_OPENED, user_scope(user_id), num)
+            count(DAILY, day, DailyCount.TYPE_CASE_OPENED, "partner:%d" % partner_id, num)
+
+        cursor.execute(CLOSED_SQL, params)
+        for day, user_id, partner_id, seconds_since_open, seconds_since_assigned in cursor.fetchall():
+            count(DAILY, day, DailyCount.TYPE_CASE_CLOSED, org_scope, 1)
+            count(DAILY, day, DailyCount.TYPE_CASE_CLOSED, user_scope(user_id), 1)
+            count(DAILY, day, DailyCount.TYPE_CASE_CLOSED, "partner:%d" % partner_id, 1)
+
+            item_type = DailySecondTotalCount.TYPE_TILL_CLOSED
+            count(SECONDS, day, item_type, org_scope, 1, ceil(seconds_since_open))
+            if (partner_id, user_id) in partner_users:
+                count(SECONDS, day, item_type, "partner:%d" % partner_id, 1, ceil(seconds_since_assigned))
+
+        cursor.execute(FIRST_REPLIES_SQL, params)
+        for day, seconds in cursor.fetchall():
+            count(SECONDS, day, DailySecondTotalCount.TYPE_TILL_REPLIED, org_scope, 1, ceil(seconds))
+
+        cursor.execute(FIRST_ASSIGNEE_REPLIES_SQL, params)
+        for day, partner_id, seconds in cursor.fetchall():
+            count(SECONDS, day, DailySecondTotalCount.TYPE_TILL_REPLIED, "partner:%d" % partner_id, 1, ceil(seconds))
+
+    return {k: tuple(v) for k, v in counts.items()}
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuilds the daily, total and second total counts of an org over a range of days from its messages, "
+        "labellings, replies and case actions, and reports how far the existing counts had drifted"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("org_id", type=int, metavar="ORG", help="The org to rebuild counts for")
+        parser.add_argument("--since", type=date.fromisoformat, dest="since", help="First day to rebuild")
+        parser.add_argument("--until", type=date.fromisoformat, dest="until", help="Day to rebuild up to (exclusive)")
+        parser.add_argument("--workers", type=int, default=4, dest="workers", help="Number of worker processes")
+        parser.add_argument(
+            "--chunk-days", type=int, default=30, dest="chunk_days", help="Number of days computed by each chunk"
+        )
+        parser.add_argument(
+            "--dry-run",
+            dest="dry_run",
+            action="store_const",
+            const=True,
+            default=False,
+            help="Whether to only report drift without updating any counts",
+        )
+
+    def handle(self, *args, **options):
+        org_id = int(options["org_id"])
+        try:
+            org = Org.objects.get(pk=org_id)
+        except Org.DoesNotExist:
+            raise CommandError("No such org with id %d" % org_id)
+
+        since = options["since"] or datetime_to_date(org.created_on, org)
+        until = options["until"] or datetime_to_date(now(), org) + timedelta(days=1)
+        if since >= until:
+            raise CommandError("Since must be before until")
+
+        # days with trimmed messages no longer have the source data for their org incoming counts
+        incoming_since = None
+        if settings.TRIM_OLD_MESSAGES_DAYS:
+            incoming_since = datetime_to_date(now() - timedelta(days=settings.TRIM_OLD_MESSAGES_DAYS), org)
+
+        self.stdout.write(
+            "Rebuilding counts for org '%s' (#%d) from %s until %s..." % (org.name, org.pk, since, until)
+        )
+
+        rebuilt = self.compute(org, since, until, incoming_since, options["workers"], options["chunk_days"])
+        existing = self.get_existing(org, since, until, incoming_since)
+
+        deltas = defaultdict(dict)
+        for key in set(rebuilt.keys()) | set(existing.keys()):
+            new_count, new_seconds = rebuilt.get(key, (0, 0))
+            old_count, old_seconds = existing.get(key, (0, 0))
+            if new_count != old_count or new_seconds != old_seconds:
+                model_key, day, item_type, scope = key
+                deltas[scope][(model_key, day, item_type)] = (new_count - old_count, new_seconds - old_seconds)
+
+        self.report(rebuilt, existing, deltas)
+
+        if options["dry_run"]:
+            self.stdout.write("Dry run so no counts were updated")
+            return
+
+        for scope, scope_deltas in sorted(deltas.items()):
+            self.apply(scope, scope_deltas)
+
+        self.stdout.write("Updated counts in %d scopes" % len(deltas))
+
+    def compute(self, org, since, until, incoming_since, num_workers, chunk_days):
+        """
+        Computes the rebuilt counts in chunks of days, across a pool of worker processes if there are several
+        """
+        chunks = []
+        chunk_start = since
+        while chunk_start < until:
+            chunk_end = min(chunk_start + timedelta(days=chunk_days), until)
+            chunks.append((org.pk, chunk_start, chunk_end, incoming_since))
+            chunk_start = chunk_end
+
+        self.stdout.write(" > Computing %d chunks with %d workers..." % (len(chunks), num_workers))
+
+        rebuilt = {}
+        if num_workers > 1 and len(chunks) > 1:
+            # workers are forked so mustn't inherit our database connections
+            connections.close_all()
+
+            with ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context("fork")) as pool:
+                for chunk_counts in pool.map(compute_counts, *zip(*chunks)):
+                    rebuilt.update(chunk_counts)
+        else:
+            for chunk in chunks:
+                rebuilt.update(compute_counts(*chunk))
+
+        return rebuilt
+
+    def get_existing(self, org, since, until, incoming_since):
+        """
+        Gets the existing counts including any that are buffered, in the same form as the rebuilt counts
+        """
+        scopes = [DailyCount.encode_scope(org)]
+        scopes += [DailyCount.encode_scope(p) for p in Partner.objects.filter(org=org)]
+        scopes += [DailyCount.encode_scope(l) for l in Label.objects.filter(org=org)]
+        in_org = Q(scope__in=scopes) | Q(scope__startswith="org:%d:user:" % org.pk)
+
+        existing = defaultdict(lambda: [0, 0])
+
+        for model_key, model in ((DAILY, DailyCount), (SECONDS, DailySecondTotalCount)):
+            counts = model.objects.filter(in_org, day__gte=since, day__lt=until)
+            counts = list(counts.values("day", "item_type", "scope", "count", *model.buffer_values[1:]))
+            counts += [c for c in model.get_buffered() if since <= c["day"] < until]
+
+            for c in counts:
+                if model_key == DAILY and c["item_type"] == DailyCount.TYPE_INCOMING and c["scope"] == scopes[0]:
+                    if incoming_since and c["day"] < incoming_since:
+                        continue
+
+                values = existing[(model_key, c["day"], c["item_type"], c["scope"])]
+                values[0] += c["count"]
+                values[1] += c.get("seconds", 0)
+
+        return {k: tuple(v) for k, v in existing.items() if k[3] in scopes or k[3].startswith("org:%d:" % org.pk)}
+
+    def report(self, rebuilt, existing, deltas):
+        """
+        Prints how far the existing counts have drifted from the rebuilt counts for each model, item type and scope
+        """
+
+        def totals(counts):
+            by_key = defaultdict(int)
+            for (model_key, day, item_type, scope), (count, seconds) in counts.items():
+                by_key[(model_key, item_type, scope)] += count
+            return by_key
+
+        rebuilt_totals, existing_totals = totals(rebuilt), totals(existing)
+        num_days = 0
+
+        self.stdout.write("Drift:")
+        for model_key, item_type, scope in sorted(set(rebuilt_totals.keys()) | set(existing_totals.keys())):
+            drifted_days = {d for (m, d, t) in deltas.get(scope, {}).keys() if m == model_key and t == item_type}
+            if drifted_days:
+                num_days += len(drifted_days)
+                self.stdout.write(
+                    " > %s %s in %s: %d counted, %d rebuilt (%d days differ)"
+                    % (
+                        model_key,
+                        item_type,
+                        scope,
+                        existing_totals.get((model_key, item_type, scope), 0),
+                        rebuilt_totals.get((model_key, item_type, scope), 0),
+                        len(drifted_days),
+                    )
+                )
+
+        self.stdout.write("%d days differ across %d scopes" % (num_days, len(deltas)))
+
+    @transaction.atomic
+    def apply(self, scope, scope_deltas):
+        """
+        Brings the counts for a scope in line with the rebuilt counts by recording the differences, as if the missed
+        or extra items had been counted, so that squashing and the monthly rollup see them too
+        """
+        daily, seconds, totals = [], [], defaultdict(int)
+
+        for (model_key, day, item_type), (count, secs) in scope_deltas.items():
+            if model_key == DAILY:
+                daily.append(DailyCount(day=day, item_type=item_type, scope=scope, count=count))
+                if item_type in TOTAL_ITEM_TYPES:
+                    totals[item_type] += count
+            else:
+                seconds.append(
+                    DailySecondTotalCount(day=day, item_type=item_type, scope=scope, count=count, seconds=secs)
+                )
+
+        DailyCount.objects.bulk_create(daily)
+        DailySecondTotalCount.objects.bulk_create(seconds)
+        TotalCount.objects.bulk_create(
+            [TotalCount(item_type=t, scope=scope, count=count) for t, count in totals.items() if count]
+        )
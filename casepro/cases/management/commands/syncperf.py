@@ -0,0 +1,128 @@
+import time
+import tracemalloc
+
+from dash.orgs.models import Org
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from casepro.backend.fake import FakeRapidPro
+from casepro.backend.rapidpro import PooledTembaClient, RapidProBackend
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Benchmarks syncing of contacts and messages for an org against a fake RapidPro with synthetic data"
+
+    def add_arguments(self, parser):
+        parser.add_argument("org_id", type=int, metavar="ORG", help="The org to sync into")
+        parser.add_argument("--contacts", type=int, default=1000, dest="contacts", help="Number of contacts to sync")
+        parser.add_argument("--messages", type=int, default=1000, dest="messages", help="Number of messages to sync")
+        parser.add_argument("--fields", type=int, default=10, dest="fields", help="Number of contact fields")
+        parser.add_argument("--groups", type=int, default=10, dest="groups", help="Number of contact groups")
+        parser.add_argument("--labels", type=int, default=10, dest="labels", help="Number of message labels")
+        parser.add_argument("--page-size", type=int, default=250, dest="page_size", help="Number of items per page")
+        parser.add_argument(
+            "--latency", type=float, default=0.0, dest="latency", help="Seconds of simulated latency per request"
+        )
+        parser.add_argument(
+            "--rate-limit-every",
+            type=int,
+            default=0,
+            dest="rate_limit_every",
+            help="Respond to every nth request with a rate limit error",
+        )
+        parser.add_argument(
+            "--message-id-base",
+            type=int,
+            default=FakeRapidPro.MESSAGE_ID_BASE,
+            dest="message_id_base",
+            help="Base for the ids of synthetic messages, which must not collide with those of real messages",
+        )
+        parser.add_argument(
+            "--keep",
+            dest="keep",
+            action="store_const",
+            const=True,
+            default=False,
+            help="Whether to keep the synced data rather than rolling it back",
+        )
+
+    def handle(self, *args, **options):
+        org_id = int(options["org_id"])
+        try:
+            org = Org.objects.get(pk=org_id)
+        except Org.DoesNotExist:
+            raise CommandError("No such org with id %d" % org_id)
+
+        fake = FakeRapidPro(
+            num_contacts=options["contacts"],
+            num_messages=options["messages"],
+            num_fields=options["fields"],
+            num_groups=options["groups"],
+            num_labels=options["labels"],
+            page_size=options["page_size"],
+            latency=options["latency"],
+            rate_limit_every=options["rate_limit_every"],
+            message_id_base=options["message_id_base"],
+        )
+        client = PooledTembaClient(FakeRapidPro.HOST, "fake-token", fake)
+        backend = RapidProBackend(org.backends.filter(is_active=True, slug="rapidpro").first(), client=client)
+
+        self.stdout.write("Benchmarking sync for org '%s' (#%d)..." % (org.name, org.pk))
+
+        try:
+            with transaction.atomic():
+                self.benchmark(fake, "fields", lambda: backend.pull_fields(org))
+                self.benchmark(fake, "groups", lambda: backend.pull_groups(org))
+                self.benchmark(fake, "labels", lambda: backend.pull_labels(org))
+                self.benchmark(fake, "contacts", lambda: backend.pull_contacts(org, None, None)[:4])
+                self.benchmark(fake, "messages", lambda: backend.pull_messages(org, None, None)[:4])
+
+                if not options["keep"]:
+                    raise Rollback()
+        except Rollback:
+            self.stdout.write("Rolled back synced data")
+
+    def benchmark(self, fake, name, pull):
+        num_queries = 0
+
+        def count_queries(execute, sql, params, many, context):
+            nonlocal num_queries
+            num_queries += 1
+            return execute(sql, params, many, context)
+
+        num_pages, num_requests, num_rate_limited = fake.num_pages, fake.num_requests, fake.num_rate_limited
+
+        tracemalloc.start()
+        start = time.time()
+
+        with connection.execute_wrapper(count_queries):
+            created, updated, deleted, ignored = pull()
+
+        elapsed = time.time() - start
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        num_pages = fake.num_pages - num_pages
+        num_synced = created + updated + deleted + ignored
+
+        self.stdout.write(
+            " > %s: %d created, %d updated, %d deleted, %d ignored in %.2f secs"
+            % (name.capitalize(), created, updated, deleted, ignored, elapsed)
+        )
+        self.stdout.write(
+            "   %.1f %s/sec, %d pages, %.1f queries/page, %d requests (%d rate limited), %.1f MB peak memory"
+            % (
+                num_synced / elapsed if elapsed else 0,
+                name,
+                num_pages,
+                num_queries / num_pages if num_pages else 0,
+                fake.num_requests - num_requests,
+                fake.num_rate_limited - num_rate_limited,
+                peak_memory / (1024 * 1024),
+            )
+        )
@@ -0,0 +1,72 @@
+# Generated by Django 4.2.3 on 2026-10-18 19:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+# populates the new fields from existing case actions and replies. assignee_replied_on is the first reply by the current
+# assignee since the case was last reassigned, which is also what time till first reply by a partner is now measured by.
+# Partner counts recorded before this were measured from a partner's first ever reply on a case and from when the case
+# was first assigned to them, so rebuild_counts should be run to recompute those counts in the new way.
+SQL = """
+UPDATE cases_case c SET
+    first_reply_on = (SELECT MIN(o.created_on) FROM msgs_outgoing o WHERE o.case_id = c.id),
+    reassigned_on = (SELECT MAX(a.created_on) FROM cases_caseaction a WHERE a.case_id = c.id AND a.action = 'A'),
+    is_reopened = EXISTS (SELECT 1 FROM cases_caseaction a WHERE a.case_id = c.id AND a.action = 'R'),
+    opened_by_partner_id = (
+        SELECT p.id FROM cases_caseaction a
+        INNER JOIN cases_partner_users pu ON pu.user_id = a.created_by_id
+        INNER JOIN cases_partner p ON p.id = pu.partner_id AND p.org_id = c.org_id AND p.is_active = TRUE
+        WHERE a.case_id = c.id AND a.action = 'O'
+        ORDER BY a.created_on, p.id LIMIT 1
+    );
+
+UPDATE cases_case c SET assignee_replied_on = (
+    SELECT MIN(o.created_on) FROM msgs_outgoing o
+    WHERE o.case_id = c.id AND o.partner_id = c.assignee_id AND o.created_on >= COALESCE(c.reassigned_on, c.opened_on)
+);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("cases", "0052_alter_caseexport_created_by_alter_caseexport_org_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="case",
+            name="assignee_replied_on",
+            field=models.DateTimeField(
+                help_text="When the current assignee first replied to this case since it was assigned to them",
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="case",
+            name="first_reply_on",
+            field=models.DateTimeField(help_text="When this case was first replied to", null=True),
+        ),
+        migrations.AddField(
+            model_name="case",
+            name="is_reopened",
+            field=models.BooleanField(default=False, help_text="Whether this case has ever been reopened"),
+        ),
+        migrations.AddField(
+            model_name="case",
+            name="opened_by_partner",
+            field=models.ForeignKey(
+                help_text="The partner of the user who opened this case",
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="+",
+                to="cases.partner",
+            ),
+        ),
+        migrations.AddField(
+            model_name="case",
+            name="reassigned_on",
+            field=models.DateTimeField(help_text="When this case was last reassigned", null=True),
+        ),
+        migrations.RunSQL(SQL, ""),
+    ]
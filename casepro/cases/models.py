@@ -1,3 +1,4 @@
+from collections import defaultdict
 from enum import Enum, IntEnum
 from itertools import chain
 
@@ -13,7 +14,7 @@ from django.utils.translation import gettext_lazy as _
 
 from casepro.contacts.models import Contact
 from casepro.msgs.models import Label, Message, Outgoing
-from casepro.utils import TimelineItem
+from casepro.utils import TimelineItem, after_cursor
 from casepro.utils.export import BaseSearchExport
 
 CASE_LOCK_KEY = "org:%d:case_lock:%s"
@@ -176,6 +177,24 @@ class Case(models.Model):
 
     closed_on = models.DateTimeField(null=True, help_text="When this case was closed")
 
+    opened_by_partner = models.ForeignKey(
+        Partner,
+        null=True,
+        related_name="+",
+        on_delete=models.PROTECT,
+        help_text="The partner of the user who opened this case",
+    )
+
+    first_reply_on = models.DateTimeField(null=True, help_text="When this case was first replied to")
+
+    assignee_replied_on = models.DateTimeField(
+        null=True, help_text="When the current assignee first replied to this case since it was assigned to them"
+    )
+
+    reassigned_on = models.DateTimeField(null=True, help_text="When this case was last reassigned")
+
+    is_reopened = models.BooleanField(default=False, help_text="Whether this case has ever been reopened")
+
     watchers = models.ManyToManyField(
         User, related_name="watched_cases", help_text="Users to be notified of case activity"
     )
@@ -213,9 +232,41 @@ class Case(models.Model):
         return qs.filter(opened_on__lt=dt).filter(Q(closed_on=None) | Q(closed_on__gt=dt)).first()
 
     @classmethod
-    def search(cls, org, user, search):
+    def get_open_for_contacts_on(cls, org, contacts_and_dts):
+        """
+        Batch version of get_open_for_contact_on which fetches all candidate cases in a single query
+        :param org: the org
+        :param contacts_and_dts: list of (contact, datetime) pairs
+        :return: list of the open case or None for each pair
+        """
+        contacts_and_dts = list(contacts_and_dts)
+        if not contacts_and_dts:
+            return []
+
+        contact_ids = {c.id for c, dt in contacts_and_dts}
+        min_dt = min(dt for c, dt in contacts_and_dts)
+        max_dt = max(dt for c, dt in contacts_and_dts)
+
+        qs = cls.get_all(org).filter(contact__in=contact_ids, opened_on__lt=max_dt)
+        qs = qs.filter(Q(closed_on=None) | Q(closed_on__gt=min_dt))
+
+        cases_by_contact = defaultdict(list)
+        for case in qs.order_by("pk"):
+            cases_by_contact[case.contact_id].append(case)
+
+        def open_on(contact, dt):
+            for case in cases_by_contact[contact.id]:
+                if case.opened_on < dt and (case.closed_on is None or case.closed_on > dt):
+                    return case
+            return None
+
+        return [open_on(c, dt) for c, dt in contacts_and_dts]
+
+    @classmethod
+    def search(cls, org, user, search, cursor=None):
         """
         Search for cases
+        :param cursor: the (opened_on, id) of the last case of the previous page
         """
         folder = search.get("folder")
         assignee_id = search.get("assignee")
@@ -241,12 +292,14 @@ class Case(models.Model):
             queryset = queryset.filter(opened_on__gte=after)
         if before:
             queryset = queryset.filter(opened_on__lte=before)
+        if cursor:
+            queryset = after_cursor(queryset, cursor, "opened_on")
 
         queryset = queryset.select_related("contact", "assignee", "user_assignee")
 
         queryset = queryset.prefetch_related(Prefetch("labels", Label.objects.filter(is_active=True)))
 
-        return queryset.order_by("-opened_on")
+        return queryset.order_by("-opened_on", "-id")
 
     @classmethod
     def get_or_open(cls, org, user, message, summary, assignee, user_assignee=None, contact=None):
@@ -285,6 +338,7 @@ class Case(models.Model):
                 initial_message=message,
                 contact=contact,
                 summary=summary,
+                opened_by_partner=user.get_partner(org),
             )
 
             if message:
@@ -337,6 +391,30 @@ class Case(models.Model):
         # sort timeline by reverse chronological order
         return sorted(timeline, key=lambda item: item.get_time())
 
+    def record_reply(self, outgoing):
+        """
+        Records a reply on this case, and the time it took if it's the first reply on this case or the first reply by
+        the current assignee since the case was assigned to them. Returns whether it was each of those.
+        """
+        from casepro.statistics.models import record_case_reply_time
+
+        cases = Case.objects.filter(pk=self.pk)
+
+        is_first = cases.filter(first_reply_on=None).update(first_reply_on=outgoing.created_on) > 0
+        if is_first:
+            self.first_reply_on = outgoing.created_on
+
+        is_first_by_assignee = False
+        if outgoing.partner_id and outgoing.partner_id == self.assignee_id:
+            cases = cases.filter(assignee=self.assignee_id, assignee_replied_on=None)
+            is_first_by_assignee = cases.update(assignee_replied_on=outgoing.created_on) > 0
+            if is_first_by_assignee:
+                self.assignee_replied_on = outgoing.created_on
+
+        record_case_reply_time(self, outgoing, is_first, is_first_by_assignee)
+
+        return is_first, is_first_by_assignee
+
     def add_reply(self, message):
         message.case = self
         message.is_archived = True
@@ -359,6 +437,8 @@ class Case(models.Model):
 
     @case_action()
     def close(self, user, note=None):
+        from casepro.statistics.models import record_case_closed_time
+
         if not (self.contact.is_blocked or self.contact.is_stopped):
             self.contact.restore_groups()
 
@@ -367,10 +447,14 @@ class Case(models.Model):
         self.closed_on = action.created_on
         self.save(update_fields=("closed_on",))
 
+        # dont count any times for reopened cases
+        if not self.is_reopened:
+            record_case_closed_time(self, action, self.get_user_partner(user) == self.assignee)
+
         self.notify_watchers(action=action)
 
         # if this is first time this case has been closed, trigger the followup flow
-        if not self.actions.filter(action=CaseAction.REOPEN).exists():
+        if not self.is_reopened:
             followup = self.org.get_followup_flow()
             if followup and not (self.contact.is_blocked or self.contact.is_stopped):
                 extra = {
@@ -385,7 +469,8 @@ class Case(models.Model):
     @case_action(become_watcher=True)
     def reopen(self, user, note=None, update_contact=True):
         self.closed_on = None
-        self.save(update_fields=("closed_on",))
+        self.is_reopened = True
+        self.save(update_fields=("closed_on", "is_reopened"))
 
         action = CaseAction.create(self, user, CaseAction.REOPEN, note=note)
 
@@ -399,14 +484,16 @@ class Case(models.Model):
     def reassign(self, user, partner, note=None, user_assignee=None):
         from casepro.profiles.models import Notification
 
-        self.assignee = partner
-        self.user_assignee = user_assignee
-        self.save(update_fields=("assignee", "user_assignee"))
-
         action = CaseAction.create(
             self, user, CaseAction.REASSIGN, assignee=partner, note=note, user_assignee=user_assignee
         )
 
+        self.assignee = partner
+        self.user_assignee = user_assignee
+        self.reassigned_on = action.created_on
+        self.assignee_replied_on = None
+        self.save(update_fields=("assignee", "user_assignee", "reassigned_on", "assignee_replied_on"))
+
         self.notify_watchers(action=action)
 
         # also notify users in the assigned partner that this case has been assigned to them
@@ -466,6 +553,15 @@ class Case(models.Model):
             elif action and watcher != action.created_by:
                 Notification.new_case_action(self.org, watcher, action)
 
+    def get_user_partner(self, user):
+        """
+        Gets the partner of the given user in this case's org, only looking it up once per user for this instance
+        """
+        user_partners = self.__dict__.setdefault("_user_partners", {})
+        if user.pk not in user_partners:
+            user_partners[user.pk] = user.get_partner(self.org)
+        return user_partners[user.pk]
+
     def access_level(self, user):
         """
         A user can view a case if one of these conditions is met:
@@ -481,7 +577,7 @@ class Case(models.Model):
         if not user.is_superuser and not self.org.get_user_org_group(user):
             return AccessLevel.none
 
-        user_partner = user.get_partner(self.org)
+        user_partner = self.get_user_partner(user)
 
         if (
             user.is_superuser
@@ -10,12 +10,12 @@ from django.urls import reverse
 from django.utils import timezone
 
 from casepro.contacts.models import Contact
-from casepro.msgs.models import Label, Message, Outgoing
+from casepro.msgs.models import BackendOp, Label, Message, Outgoing
 from casepro.msgs.tasks import handle_messages
 from casepro.orgs_ext.models import Flow
 from casepro.profiles.models import ROLE_ANALYST, ROLE_MANAGER, Notification
 from casepro.test import BaseCasesTest
-from casepro.utils import datetime_to_microseconds, microseconds_to_datetime
+from casepro.utils import datetime_to_microseconds, encode_cursor, microseconds_to_datetime
 
 from .context_processors import sentry_dsn
 from .models import AccessLevel, Case, CaseAction, CaseExport, CaseFolder, Partner
@@ -76,6 +76,9 @@ class CaseTest(BaseCasesTest):
         self.assertEqual(case.summary, "Summary")
         self.assertEqual(case.opened_on, d1)
         self.assertIsNone(case.closed_on)
+        self.assertEqual(case.opened_by_partner, self.moh)
+        self.assertIsNone(case.first_reply_on)
+        self.assertFalse(case.is_reopened)
 
         actions = case.actions.order_by("pk")
         self.assertEqual(len(actions), 1)
@@ -124,6 +127,8 @@ class CaseTest(BaseCasesTest):
         Notification.objects.get(user=self.user1, type=Notification.TYPE_CASE_REPLY, message=msg3)
 
         # which will have been archived and added to the case
+        BackendOp.push(self.unicef)
+
         mock_archive_messages.assert_called_once_with(self.unicef, [msg3])
         mock_archive_messages.reset_mock()
 
@@ -198,6 +203,8 @@ class CaseTest(BaseCasesTest):
         handle_messages(self.unicef.pk)
 
         # message is not in an open case, so won't have been archived
+        BackendOp.push(self.unicef)
+
         mock_archive_messages.assert_not_called()
 
         msg4.refresh_from_db()
@@ -209,6 +216,7 @@ class CaseTest(BaseCasesTest):
 
         self.assertEqual(case.opened_on, d1)  # unchanged
         self.assertIsNone(case.closed_on)
+        self.assertTrue(case.is_reopened)
 
         actions = case.actions.order_by("pk")
         self.assertEqual(len(actions), 4)
@@ -231,6 +239,8 @@ class CaseTest(BaseCasesTest):
             case.reassign(self.user2, self.who)
 
         self.assertEqual(case.assignee, self.who)
+        self.assertEqual(case.reassigned_on, d5)
+        self.assertIsNone(case.assignee_replied_on)
 
         actions = case.actions.order_by("pk")
         self.assertEqual(len(actions), 5)
@@ -373,6 +383,48 @@ class CaseTest(BaseCasesTest):
         )
         self.assertEqual(open_case, case2)
 
+    def test_get_open_for_contacts_on(self):
+        d0 = datetime(2014, 1, 5, 0, 0, tzinfo=timezone.utc)
+        d1 = datetime(2014, 1, 10, 0, 0, tzinfo=timezone.utc)
+        d2 = datetime(2014, 1, 15, 0, 0, tzinfo=timezone.utc)
+
+        bob = self.create_contact(self.unicef, "C-002", "Bob")
+        cat = self.create_contact(self.unicef, "C-003", "Cat")
+
+        # case for Ann Jan 5th -> Jan 10th and Jan 15th -> now
+        msg1 = self.create_message(self.unicef, 123, self.ann, "Hello", created_on=d0)
+        case1 = self.create_case(self.unicef, self.ann, self.moh, msg1, opened_on=d0, closed_on=d1)
+        msg2 = self.create_message(self.unicef, 234, self.ann, "Hello again", created_on=d2)
+        case2 = self.create_case(self.unicef, self.ann, self.moh, msg2, opened_on=d2)
+
+        # case for Bob Jan 10th -> now
+        msg3 = self.create_message(self.unicef, 345, bob, "Hi", created_on=d1)
+        case3 = self.create_case(self.unicef, bob, self.moh, msg3, opened_on=d1)
+
+        def day(d):
+            return datetime(2014, 1, d, 0, 0, tzinfo=timezone.utc)
+
+        pairs = [
+            (self.ann, day(4)),
+            (self.ann, day(7)),
+            (self.ann, day(13)),
+            (self.ann, day(16)),
+            (bob, day(7)),
+            (bob, day(16)),
+            (cat, day(16)),
+        ]
+
+        with self.assertNumQueries(1):
+            open_cases = Case.get_open_for_contacts_on(self.unicef, pairs)
+
+        self.assertEqual(open_cases, [None, case1, None, case2, None, case3, None])
+
+        # should give same results as looking up each individually
+        for (contact, dt), open_case in zip(pairs, open_cases):
+            self.assertEqual(open_case, Case.get_open_for_contact_on(self.unicef, contact, dt))
+
+        self.assertEqual(Case.get_open_for_contacts_on(self.unicef, []), [])
+
     def test_get_or_open_with_user_assignee(self):
         """
         If a case is opened with the user_assignee field set, the created case should have the assigned user, and
@@ -851,6 +903,11 @@ class CaseCRUDLTest(BaseCasesTest):
         self.assertEqual(outgoing.text, "We can help")
         self.assertEqual(outgoing.created_by, self.user1)
 
+        # case records when it was first replied to, and by its assignee
+        self.case.refresh_from_db()
+        self.assertEqual(self.case.first_reply_on, outgoing.created_on)
+        self.assertEqual(self.case.assignee_replied_on, outgoing.created_on)
+
         # only user from assigned partner can reply
         self.login(self.user3)
 
@@ -1124,6 +1181,18 @@ class CaseCRUDLTest(BaseCasesTest):
                 }
             ],
         )
+        self.assertFalse(response.json["has_more"])
+        self.assertIsNone(response.json["next_cursor"])
+
+        # fetch the cases after a cursor
+        self.login(self.admin)
+
+        response = self.url_get("unicef", url, {"folder": "open", "cursor": encode_cursor(case2.opened_on, case2.pk)})
+        self.assertEqual([c["id"] for c in response.json["results"]], [self.case.pk])
+
+        # a garbage cursor is a bad request
+        response = self.url_get("unicef", url, {"folder": "open", "cursor": "xyz"})
+        self.assertEqual(response.status_code, 400)
 
     def test_watch_and_unwatch(self):
         watch_url = reverse("cases.case_watch", args=[self.case.pk])
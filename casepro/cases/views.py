@@ -2,7 +2,6 @@ from datetime import timedelta
 
 from dash.orgs.models import Org, TaskState
 from dash.orgs.views import OrgObjPermsMixin, OrgPermsMixin
-from el_pagination.paginators import LazyPaginator
 from smartmin.mixins import NonAtomicMixin
 from smartmin.views import (
     SmartCreateView,
@@ -26,9 +25,10 @@ from django.views.generic import View
 
 from casepro.contacts.models import Contact, Field
 from casepro.msgs.models import Label, Message, MessageFolder, OutgoingFolder
-from casepro.statistics.models import DailyCount, DailySecondTotalCount, TotalCount
+from casepro.statistics.models import CountQuery, DailyCount, DailySecondTotalCount, TotalCount
 from casepro.utils import (
     JSONEncoder,
+    cursor_page,
     datetime_to_microseconds,
     humanize_seconds,
     microseconds_to_datetime,
@@ -36,6 +36,7 @@ from casepro.utils import (
     str_to_bool,
 )
 from casepro.utils.export import BaseDownloadView
+from casepro.utils.views import CursorPagingMixin
 
 from .forms import PartnerCreateForm, PartnerUpdateForm
 from .models import AccessLevel, Case, CaseExport, CaseFolder, Partner
@@ -270,7 +271,7 @@ class CaseCRUDL(SmartCRUDL):
 
             return JsonResponse(case_json, encoder=JSONEncoder)
 
-    class Search(OrgPermsMixin, CaseSearchMixin, SmartTemplateView):
+    class Search(CursorPagingMixin, OrgPermsMixin, CaseSearchMixin, SmartTemplateView):
         """
         JSON endpoint for searching for cases
         """
@@ -282,19 +283,21 @@ class CaseCRUDL(SmartCRUDL):
 
             org = self.request.org
             user = self.request.user
-            page = int(self.request.GET.get("page", 1))
+            cursor = self.cursor
 
             search = self.derive_search()
-            cases = Case.search(org, user, search)
-            paginator = LazyPaginator(cases, 50)
+            cases = Case.search(org, user, search, cursor=cursor)
 
-            context["object_list"] = paginator.page(page)
-            context["has_more"] = paginator.num_pages > page
+            context["object_list"], context["has_more"], context["next_cursor"] = cursor_page(cases, 50, "opened_on")
             return context
 
         def render_to_response(self, context, **response_kwargs):
             return JsonResponse(
-                {"results": [c.as_json() for c in context["object_list"]], "has_more": context["has_more"]},
+                {
+                    "results": [c.as_json() for c in context["object_list"]],
+                    "has_more": context["has_more"],
+                    "next_cursor": context["next_cursor"],
+                },
                 encoder=JSONEncoder,
             )
 
@@ -465,31 +468,28 @@ class PartnerCRUDL(SmartCRUDL):
 
         def render_as_json(self, partners, with_activity):
             if with_activity:
-                # get reply statistics
-                replies_total = TotalCount.get_by_partner(partners, DailyCount.TYPE_REPLIES).scope_totals()
-                replies_this_month = DailyCount.get_by_partner(
-                    partners, DailyCount.TYPE_REPLIES, *month_range(0)
-                ).scope_totals()
-                replies_last_month = DailyCount.get_by_partner(
-                    partners, DailyCount.TYPE_REPLIES, *month_range(-1)
-                ).scope_totals()
-                average_referral_response_time_this_month = DailySecondTotalCount.get_by_partner(
-                    partners, DailySecondTotalCount.TYPE_TILL_REPLIED, *month_range(0)
-                )
-                average_referral_response_time_this_month = average_referral_response_time_this_month.scope_averages()
-                average_closed_this_month = DailySecondTotalCount.get_by_partner(
-                    partners, DailySecondTotalCount.TYPE_TILL_CLOSED, *month_range(0)
+                stats = (
+                    CountQuery.for_partners(partners)
+                    .total("replies_total", TotalCount, DailyCount.TYPE_REPLIES)
+                    .total("replies_this_month", DailyCount, DailyCount.TYPE_REPLIES, *month_range(0))
+                    .total("replies_last_month", DailyCount, DailyCount.TYPE_REPLIES, *month_range(-1))
+                    .average(
+                        "average_referral_response_time_this_month",
+                        DailySecondTotalCount,
+                        DailySecondTotalCount.TYPE_TILL_REPLIED,
+                        *month_range(0),
+                    )
+                    .average(
+                        "average_closed_this_month",
+                        DailySecondTotalCount,
+                        DailySecondTotalCount.TYPE_TILL_CLOSED,
+                        *month_range(0),
+                    )
+                    .total("cases_total", TotalCount, DailyCount.TYPE_CASE_OPENED)
+                    .total("cases_opened_this_month", DailyCount, DailyCount.TYPE_CASE_OPENED, *month_range(0))
+                    .total("cases_closed_this_month", DailyCount, DailyCount.TYPE_CASE_CLOSED, *month_range(0))
+                    .fetch()
                 )
-                average_closed_this_month = average_closed_this_month.scope_averages()
-
-                # get cases statistics
-                cases_total = TotalCount.get_by_partner(partners, DailyCount.TYPE_CASE_OPENED).scope_totals()
-                cases_opened_this_month = DailyCount.get_by_partner(
-                    partners, DailyCount.TYPE_CASE_OPENED, *month_range(0)
-                ).scope_totals()
-                cases_closed_this_month = DailyCount.get_by_partner(
-                    partners, DailyCount.TYPE_CASE_CLOSED, *month_range(0)
-                ).scope_totals()
 
             def as_json(partner):
                 obj = partner.as_json()
@@ -497,20 +497,20 @@ class PartnerCRUDL(SmartCRUDL):
                     obj.update(
                         {
                             "replies": {
-                                "this_month": replies_this_month.get(partner, 0),
-                                "last_month": replies_last_month.get(partner, 0),
-                                "total": replies_total.get(partner, 0),
+                                "this_month": stats["replies_this_month"].get(partner, 0),
+                                "last_month": stats["replies_last_month"].get(partner, 0),
+                                "total": stats["replies_total"].get(partner, 0),
                                 "average_referral_response_time_this_month": humanize_seconds(
-                                    average_referral_response_time_this_month.get(partner, 0)
+                                    stats["average_referral_response_time_this_month"].get(partner, 0)
                                 ),
                             },
                             "cases": {
                                 "average_closed_this_month": humanize_seconds(
-                                    average_closed_this_month.get(partner, 0)
+                                    stats["average_closed_this_month"].get(partner, 0)
                                 ),
-                                "opened_this_month": cases_opened_this_month.get(partner, 0),
-                                "closed_this_month": cases_closed_this_month.get(partner, 0),
-                                "total": cases_total.get(partner, 0),
+                                "opened_this_month": stats["cases_opened_this_month"].get(partner, 0),
+                                "closed_this_month": stats["cases_closed_this_month"].get(partner, 0),
+                                "total": stats["cases_total"].get(partner, 0),
                             },
                         }
                     )
@@ -556,7 +556,7 @@ class BaseInboxView(OrgPermsMixin, SmartTemplateView):
         context["allow_case_without_message"] = getattr(settings, "SITE_ALLOW_CASE_WITHOUT_MESSAGE", False)
         context["user_must_reply_with_faq"] = org and not user.is_anonymous and user.must_use_faq()
         context["site_contact_display"] = getattr(settings, "SITE_CONTACT_DISPLAY", "name")
-        context["search_text_days"] = Message.SEARCH_BY_TEXT_DAYS
+        context["search_text_days"] = settings.SEARCH_BY_TEXT_DAYS
         return context
 
 
@@ -1,14 +1,37 @@
 from dash.orgs.models import Org
+from dateutil.relativedelta import relativedelta
 
 from django.core.management.base import BaseCommand, CommandError
 from django.utils import timezone
 
+from casepro.backend.backfill import Backfill
+
 
 class Command(BaseCommand):
     help = "Pulls all contacts, groups and fields from the backend for the specified org"
 
     def add_arguments(self, parser):
         parser.add_argument("org_id", type=int, metavar="ORG", help="The org to pull contacts for")
+        parser.add_argument(
+            "--days", type=int, default=0, dest="days", help="Maximum age of contact changes to pull in days"
+        )
+        parser.add_argument(
+            "--weeks", type=int, default=0, dest="weeks", help="Maximum age of contact changes to pull in weeks"
+        )
+        parser.add_argument(
+            "--shards", type=int, default=1, dest="shards", help="Number of time windows to split the pull into"
+        )
+        parser.add_argument(
+            "--concurrency", type=int, default=0, dest="concurrency", help="Number of shards to pull at once"
+        )
+        parser.add_argument(
+            "--resume",
+            dest="resume",
+            action="store_const",
+            const=True,
+            default=False,
+            help="Whether to resume the unfinished shards of a previously interrupted pull",
+        )
 
     def handle(self, *args, **options):
         org_id = int(options["org_id"])
@@ -17,37 +40,83 @@ class Command(BaseCommand):
         except Org.DoesNotExist:
             raise CommandError("No such org with id %d" % org_id)
 
-        prompt = """You have requested to pull all contacts, groups and fields for org '%s' (#%d). Are you sure you want to do this?
+        days, weeks = options["days"], options["weeks"]
+        shards, concurrency, resume = options["shards"], options["concurrency"], options["resume"]
+
+        if resume:
+            backfill = Backfill.get(org, Backfill.TYPE_CONTACTS)
+            if not backfill:
+                raise CommandError("No previous pull to resume for org #%d" % org.pk)
+
+            description = "resume pulling contacts for org '%s' (#%d), from %s to %s (%d of %d shards)" % (
+                org.name,
+                org.pk,
+                backfill.shards[0]["since"],
+                backfill.shards[-1]["until"],
+                len(backfill.get_unfinished()),
+                len(backfill.shards),
+            )
+        else:
+            if shards > 1 and not (days or weeks):
+                raise CommandError("Must provide at least one of --days or --weeks to pull in shards")
+            if shards < 1:
+                raise CommandError("Must have at least one shard")
+
+            now = timezone.now()
+            since = (now - relativedelta(days=days, weeks=weeks)) if (days or weeks) else None
+            backfill = None
+
+            if since:
+                description = "pull contacts, groups and fields for org '%s' (#%d), changed since %s" % (
+                    org.name,
+                    org.pk,
+                    since.strftime("%b %d, %Y %H:%M"),
+                )
+            else:
+                description = "pull all contacts, groups and fields for org '%s' (#%d)" % (org.name, org.pk)
+
+        prompt = """You have requested to %s. Are you sure you want to do this?
 
 Type 'yes' to continue, or 'no' to cancel: """ % (
-            org.name,
-            org.pk,
+            description
         )
 
         if input(prompt).lower() != "yes":
             self.stdout.write("Operation cancelled")
             return
 
-        def progress_callback(num_synced):
-            self.stdout.write(" > Synced %d contacts..." % num_synced)
+        def progress_callback(shard, num_synced):
+            self.stdout.write(" > Synced %d contacts in shard %d..." % (num_synced, shard + 1))
 
         backend = org.get_backend()
 
-        created, updated, deleted, ignored = backend.pull_fields(org)
+        if not resume:
+            created, updated, deleted, ignored = backend.pull_fields(org)
 
-        self.stdout.write(
-            "Finished field pull (%d created, %d updated, %d deleted, %d ignored)"
-            % (created, updated, deleted, ignored)
-        )
+            self.stdout.write(
+                "Finished field pull (%d created, %d updated, %d deleted, %d ignored)"
+                % (created, updated, deleted, ignored)
+            )
 
-        created, updated, deleted, ignored = backend.pull_groups(org)
+            created, updated, deleted, ignored = backend.pull_groups(org)
 
-        self.stdout.write(
-            "Finished group pull (%d created, %d updated, %d deleted, %d ignored)"
-            % (created, updated, deleted, ignored)
-        )
+            self.stdout.write(
+                "Finished group pull (%d created, %d updated, %d deleted, %d ignored)"
+                % (created, updated, deleted, ignored)
+            )
+
+        if backfill or since:
+            if not backfill:
+                backfill = Backfill.create(org, Backfill.TYPE_CONTACTS, since, now, shards)
+
+            backfill.pull(concurrency or len(backfill.shards), progress_callback)
+            backfill.delete()
 
-        created, updated, deleted, ignored = backend.pull_contacts(org, None, timezone.now(), progress_callback)
+            created, updated, deleted, ignored = backfill.get_totals()
+        else:
+            created, updated, deleted, ignored, _ = backend.pull_contacts(
+                org, None, now, lambda num, cursor: progress_callback(0, num)
+            )
 
         self.stdout.write(
             "Finished contact pull (%d created, %d updated, %d deleted, %d ignored)"
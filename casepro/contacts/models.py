@@ -261,6 +261,7 @@ class Contact(models.Model):
     DISPLAY_ANON = "uuid"
 
     SAVE_GROUPS_ATTR = "__data__groups"
+    SAVE_CONTEXT_ATTR = "__data__context"
 
     org = models.ForeignKey(Org, verbose_name=_("Organization"), related_name="contacts", on_delete=models.PROTECT)
 
@@ -297,6 +298,8 @@ class Contact(models.Model):
     def __init__(self, *args, **kwargs):
         if self.SAVE_GROUPS_ATTR in kwargs:
             setattr(self, self.SAVE_GROUPS_ATTR, kwargs.pop(self.SAVE_GROUPS_ATTR))
+        if self.SAVE_CONTEXT_ATTR in kwargs:
+            setattr(self, self.SAVE_CONTEXT_ATTR, kwargs.pop(self.SAVE_CONTEXT_ATTR))
 
         super(Contact, self).__init__(*args, **kwargs)
 
@@ -313,6 +316,35 @@ class Contact(models.Model):
 
             return contact
 
+    @classmethod
+    def get_or_create_bulk(cls, org, contact_refs):
+        """
+        Batch version of get_or_create which gets existing contacts or creates stub contacts for many (uuid, name)
+        pairs at once, e.g. all the contacts of a page of synced messages
+        :param org: the org
+        :param contact_refs: the (uuid, name) pairs
+        :return: map of uuid to contact
+        """
+        names_by_uuid = {}
+        for uuid, name in contact_refs:
+            names_by_uuid.setdefault(uuid, name)
+        if not names_by_uuid:
+            return {}
+
+        contacts_by_uuid = {c.uuid: c for c in cls.objects.filter(org=org, uuid__in=names_by_uuid.keys())}
+        missing = [uuid for uuid in names_by_uuid.keys() if uuid not in contacts_by_uuid]
+
+        if missing:
+            # ignore conflicts in case another process created any of these contacts since we looked
+            cls.objects.bulk_create(
+                [cls(org=org, uuid=uuid, name=names_by_uuid[uuid], is_stub=True) for uuid in missing],
+                ignore_conflicts=True,
+            )
+
+            contacts_by_uuid.update({c.uuid: c for c in cls.objects.filter(org=org, uuid__in=missing)})
+
+        return contacts_by_uuid
+
     @classmethod
     def get_or_create_from_urn(cls, org, urn, name=None):
         """
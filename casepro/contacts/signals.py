@@ -1,7 +1,7 @@
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 
-from .models import Contact
+from .models import Contact, Group
 
 
 @receiver(post_save, sender=Contact)
@@ -9,10 +9,13 @@ def update_contact_groups(sender, instance, created, **kwargs):
     """
     Save signal handler to update the contact groups when groups are specified as attribute on the contact object
     """
+    from casepro.backend import SyncContext
+
     if not hasattr(instance, Contact.SAVE_GROUPS_ATTR):
         return
 
-    org = instance.org
+    # use the context of the sync run if there is one
+    context = getattr(instance, Contact.SAVE_CONTEXT_ATTR, None) or SyncContext(instance.org)
 
     new_groups_by_uuid = {g[0]: g[1] for g in getattr(instance, Contact.SAVE_GROUPS_ATTR)}
 
@@ -27,18 +30,22 @@ def update_contact_groups(sender, instance, created, **kwargs):
     add_to_by_uuid = {uuid: name for uuid, name in new_groups_by_uuid.items() if uuid not in cur_groups_by_uuid.keys()}
 
     if add_to_by_uuid:
-        org_groups = {g.uuid: g for g in org.groups.all()}
-
-        # create any groups that don't exist
-        add_to_groups = []
-        for uuid, name in add_to_by_uuid.items():
-            existing = org_groups.get(uuid)
-            if not existing:
-                # create stub
-                existing = org.groups.create(uuid=uuid, name=name, is_active=False)
-
-            add_to_groups.append(existing)
+        # get groups, creating stubs for any that don't exist
+        add_to_groups = [context.get_or_create_group(uuid, name) for uuid, name in add_to_by_uuid.items()]
 
         instance.groups.add(*add_to_groups)
 
     delattr(instance, Contact.SAVE_GROUPS_ATTR)
+
+    if hasattr(instance, Contact.SAVE_CONTEXT_ATTR):
+        delattr(instance, Contact.SAVE_CONTEXT_ATTR)
+
+
+@receiver(post_save, sender=Group)
+def invalidate_compiled_rules(sender, instance, **kwargs):
+    """
+    Save signal handler to invalidate any compiled rules which might have a stale copy of the group, or be missing it
+    """
+    from casepro.rules.models import Rule
+
+    Rule.bump_version(instance.org_id)
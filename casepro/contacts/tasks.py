@@ -19,7 +19,7 @@ def pull_contacts(org, since, until, prev_results):
 
     groups_created, groups_updated, groups_deleted, ignored = backend.pull_groups(org)
 
-    def progress(num):  # pragma: no cover
+    def progress(num, cursor):  # pragma: no cover
         logger.debug(f" > Synced {num} contacts for org #{org.id}")
 
     cursor = None
@@ -109,7 +109,7 @@ class ContactTest(BaseCasesTest):
             contact.save()
 
         # check removing a group and adding new ones
-        with self.assertNumQueries(6):
+        with self.assertNumQueries(12):
             setattr(contact, "__data__groups", [("G-002", "Spammers"), ("G-003", "Boffins")])
             contact.save()
 
@@ -215,6 +215,36 @@ class ContactTest(BaseCasesTest):
                 },
             )
 
+    def test_get_or_create_bulk(self):
+        # one existing contact and two new ones, one of which appears twice
+        with self.assertNumQueries(3):
+            contacts = Contact.get_or_create_bulk(
+                self.unicef,
+                [
+                    ("7b7dd838-4947-4e85-9b5c-0e8b1794080b", "Annie"),
+                    ("C-002", "Bob"),
+                    ("C-003", "Cat"),
+                    ("C-002", "Bobby"),
+                ],
+            )
+
+        self.assertEqual(set(contacts.keys()), {"7b7dd838-4947-4e85-9b5c-0e8b1794080b", "C-002", "C-003"})
+        self.assertEqual(contacts["7b7dd838-4947-4e85-9b5c-0e8b1794080b"], self.ann)
+
+        bob = Contact.objects.get(org=self.unicef, uuid="C-002", name="Bob", is_stub=True)
+        cat = Contact.objects.get(org=self.unicef, uuid="C-003", name="Cat", is_stub=True)
+        self.assertEqual(contacts["C-002"], bob)
+        self.assertEqual(contacts["C-003"], cat)
+
+        # all exist now so only need one query
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                Contact.get_or_create_bulk(self.unicef, [("C-002", "Bob"), ("C-003", None)]),
+                {"C-002": bob, "C-003": cat},
+            )
+
+        self.assertEqual(Contact.get_or_create_bulk(self.unicef, []), {})
+
     @patch("casepro.test.TestBackend.resolve_urn")
     def test_get_or_create_from_urn(self, mock_resolve_urn):
         """
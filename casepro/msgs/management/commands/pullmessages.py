@@ -4,6 +4,8 @@ from dateutil.relativedelta import relativedelta
 from django.core.management.base import BaseCommand, CommandError
 from django.utils import timezone
 
+from casepro.backend.backfill import Backfill
+
 
 class Command(BaseCommand):
     help = "Pulls and labels messages from the backend for the specified org"
@@ -22,6 +24,20 @@ class Command(BaseCommand):
             default=False,
             help="Whether messages should be saved as already handled",
         )
+        parser.add_argument(
+            "--shards", type=int, default=1, dest="shards", help="Number of time windows to split the pull into"
+        )
+        parser.add_argument(
+            "--concurrency", type=int, default=0, dest="concurrency", help="Number of shards to pull at once"
+        )
+        parser.add_argument(
+            "--resume",
+            dest="resume",
+            action="store_const",
+            const=True,
+            default=False,
+            help="Whether to resume the unfinished shards of a previously interrupted pull",
+        )
 
     def handle(self, *args, **options):
         org_id = int(options["org_id"])
@@ -31,29 +47,53 @@ class Command(BaseCommand):
             raise CommandError("No such org with id %d" % org_id)
 
         days, weeks, as_handled = options["days"], options["weeks"], options["as_handled"]
-
-        if not (days or weeks):
-            raise CommandError("Must provide at least one of --days or --weeks")
-
-        now = timezone.now()
-        since = now - relativedelta(days=days, weeks=weeks)
-
-        prompt = """You have requested to pull and label messages for org '%s' (#%d), since %s. Are you sure you want to do this?
+        shards, concurrency, resume = options["shards"], options["concurrency"], options["resume"]
+
+        if resume:
+            backfill = Backfill.get(org, Backfill.TYPE_MESSAGES)
+            if not backfill:
+                raise CommandError("No previous pull to resume for org #%d" % org.pk)
+
+            description = "resume pulling messages for org '%s' (#%d), from %s to %s (%d of %d shards)" % (
+                org.name,
+                org.pk,
+                backfill.shards[0]["since"],
+                backfill.shards[-1]["until"],
+                len(backfill.get_unfinished()),
+                len(backfill.shards),
+            )
+        else:
+            if not (days or weeks):
+                raise CommandError("Must provide at least one of --days or --weeks")
+            if shards < 1:
+                raise CommandError("Must have at least one shard")
+
+            now = timezone.now()
+            since = now - relativedelta(days=days, weeks=weeks)
+            backfill = None
+            description = "pull and label messages for org '%s' (#%d), since %s" % (
+                org.name,
+                org.pk,
+                since.strftime("%b %d, %Y %H:%M"),
+            )
+
+        prompt = """You have requested to %s. Are you sure you want to do this?
 
 DO NOT RUN THIS COMMAND WHILST BACKGROUND SYNCING IS RUNNING
 
 Type 'yes' to continue, or 'no' to cancel: """ % (
-            org.name,
-            org.pk,
-            since.strftime("%b %d, %Y %H:%M"),
+            description
         )
 
         if input(prompt).lower() != "yes":
             self.stdout.write("Operation cancelled")
             return
 
-        def progress_callback(num_synced):
-            self.stdout.write(" > Synced %d messages..." % num_synced)
+        if not backfill:
+            backfill = Backfill.create(org, Backfill.TYPE_MESSAGES, since, now, shards, as_handled)
+
+        def progress_callback(shard, num_synced):
+            self.stdout.write(" > Synced %d messages in shard %d..." % (num_synced, shard + 1))
 
         backend = org.get_backend()
 
@@ -64,7 +104,10 @@ Type 'yes' to continue, or 'no' to cancel: """ % (
             % (created, updated, deleted, ignored)
         )
 
-        created, updated, deleted, ignored = backend.pull_messages(org, since, now, as_handled, progress_callback)
+        backfill.pull(concurrency or len(backfill.shards), progress_callback)
+        backfill.delete()
+
+        created, updated, deleted, ignored = backfill.get_totals()
 
         self.stdout.write(
             "Finished message pull (%d created, %d updated, %d deleted, %d ignored)"
@@ -0,0 +1,52 @@
+# Generated by Django 4.2.3 on 2026-10-18 19:09
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("orgs", "0031_alter_orgbackend_index_together"),
+        ("msgs", "0069_alter_outgoing_backend_id"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="BackendOp",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                (
+                    "op",
+                    models.CharField(
+                        choices=[
+                            ("F", "Flag"),
+                            ("N", "Un-flag"),
+                            ("L", "Label"),
+                            ("U", "Remove Label"),
+                            ("A", "Archive"),
+                            ("R", "Restore"),
+                        ],
+                        max_length=1,
+                    ),
+                ),
+                ("created_on", models.DateTimeField(default=django.utils.timezone.now)),
+                ("attempts", models.IntegerField(default=0)),
+                ("retry_on", models.DateTimeField(null=True)),
+                ("label", models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to="msgs.label")),
+                (
+                    "message",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, related_name="backend_ops", to="msgs.message"
+                    ),
+                ),
+                (
+                    "org",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.PROTECT, related_name="backend_ops", to="orgs.org"
+                    ),
+                ),
+            ],
+        ),
+    ]
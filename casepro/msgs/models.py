@@ -1,24 +1,34 @@
+import heapq
+from collections import defaultdict
 from datetime import timedelta
 from enum import Enum
+from itertools import groupby
 
+from celery.utils.log import get_task_logger
 from dash.orgs.models import Org
-from dash.utils import get_obj_cacheable
+from dash.utils import chunks, get_obj_cacheable
 from django_redis import get_redis_connection
 
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.contrib.postgres.indexes import GinIndex, OpClass
 from django.core.exceptions import PermissionDenied
-from django.db import models
-from django.db.models import Index, Prefetch, Q
+from django.db import connection, models, transaction
+from django.db.models import F, Index, Prefetch, Q
+from django.db.models.functions import Upper
 from django.utils.timesince import timesince
 from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
 
 from casepro.contacts.models import Contact, Field
-from casepro.utils import get_language_name, json_encode
+from casepro.utils import after_cursor, get_language_name, json_encode
 from casepro.utils.export import BaseSearchExport
 
+logger = get_task_logger(__name__)
+
 LABEL_LOCK_KEY = "lock:label:%d:%s"
 MESSAGE_LOCK_KEY = "lock:message:%d:%d"
+MESSAGE_BATCH_SYNC_LOCK_KEY = "lock:message-batch-sync:%d"
 MESSAGE_LOCK_SECONDS = 300
 
 
@@ -95,6 +105,8 @@ class Label(models.Model):
 
                 rule.delete()
 
+        Rule.bump_version(self.org_id)
+
     def get_tests(self):
         return self.rule.get_tests() if self.rule else []
 
@@ -151,6 +163,8 @@ class Label(models.Model):
         return user in self.watchers.all()
 
     def release(self):
+        from casepro.rules.models import Rule
+
         rule = self.rule
 
         self.rule = None
@@ -160,6 +174,8 @@ class Label(models.Model):
         if rule:
             rule.delete()
 
+        Rule.bump_version(self.org_id)
+
     def as_json(self, full=True):
         result = {"id": self.pk, "name": self.name}
 
@@ -305,6 +321,10 @@ class Labelling(models.Model):
 
     message_created_on = models.DateTimeField()
 
+    INSERT_BATCH_SIZE = 1000  # rows per insert, keeping each statement well under Postgres's 65535 param limit
+
+    SEARCH_PAGE_SIZE = 100  # labellings read per label at a time when searching without a limit
+
     @classmethod
     def create(cls, label, message):
         return cls(
@@ -315,6 +335,149 @@ class Labelling(models.Model):
             message_is_archived=message.is_archived,
         )
 
+    @classmethod
+    def label_messages(cls, label, messages):
+        """
+        Applies the given label to all of the given messages which don't already have it, with batched inserts
+        :param label: the label
+        :param messages: the messages
+        :return: the messages which were newly labelled
+        """
+        from casepro.profiles.models import Notification
+        from casepro.statistics.models import DailyCount, datetime_to_date
+
+        messages = list(messages)
+        if not messages:
+            return []
+
+        added_ids = set()
+        with connection.cursor() as cursor:
+            for batch in chunks(messages, cls.INSERT_BATCH_SIZE):
+                sql = """
+                    INSERT INTO %s("label_id", "message_id", "message_is_archived", "message_is_flagged", "message_created_on")
+                    VALUES %s ON CONFLICT DO NOTHING RETURNING "message_id"
+                """ % (
+                    cls._meta.db_table,
+                    ", ".join(["(%s, %s, %s, %s, %s)"] * len(batch)),
+                )
+                params = []
+                for msg in batch:
+                    params += [label.id, msg.id, msg.is_archived, msg.is_flagged, msg.created_on]
+
+                cursor.execute(sql, params)
+                added_ids.update(row[0] for row in cursor.fetchall())
+
+        added = [m for m in messages if m.id in added_ids]
+
+        # record a single daily count delta per day rather than one per message
+        counts_by_day = defaultdict(int)
+        for msg in added:
+            counts_by_day[datetime_to_date(msg.created_on, label.org)] += 1
+
+        DailyCount.record_items(DailyCount.TYPE_INCOMING, counts_by_day, label)
+
+        # notify all users who watch this label
+        watchers = User.objects.filter(watched_labels=label).distinct()
+        Notification.new_message_labellings(label.org, watchers, messages)
+
+        return added
+
+    @classmethod
+    def unlabel_messages(cls, org, messages, labels=None):
+        """
+        Removes the given labels (or all labels if none given) from all of the given messages, in a single delete
+        :param org: the org
+        :param messages: the messages
+        :param labels: the labels to remove, or None to remove all labels
+        :return: the removed labellings as a list of (label, message, day) tuples
+        """
+        from casepro.statistics.models import DailyCount, datetime_to_date
+
+        message_ids = [m.id for m in messages]
+        if not message_ids or labels is not None and not labels:
+            return []
+
+        sql = 'DELETE FROM %s WHERE "message_id" = ANY(%%s)' % cls._meta.db_table
+        params = [message_ids]
+        if labels is not None:
+            sql += ' AND "label_id" = ANY(%s)'
+            params.append([l.id for l in labels])
+        sql += ' RETURNING "label_id", "message_id", "message_created_on"'
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            removed = cursor.fetchall()
+
+        if not removed:
+            return []
+
+        if labels is not None:
+            labels_by_id = {l.id: l for l in labels}
+        else:
+            labels_by_id = Label.objects.in_bulk({label_id for label_id, message_id, created_on in removed})
+
+        messages_by_id = {m.id: m for m in messages}
+        removed = [
+            (labels_by_id[label_id], messages_by_id[message_id], datetime_to_date(created_on, org))
+            for label_id, message_id, created_on in removed
+        ]
+
+        # record a single negative daily count per day and label rather than one per labelling
+        counts = defaultdict(int)
+        for label, message, day in removed:
+            counts[(day, label)] += 1
+
+        DailyCount.record_removals(DailyCount.TYPE_INCOMING, counts)
+
+        return removed
+
+    @classmethod
+    def search_messages(cls, labels, cursor=None, limit=None, **filtering):
+        """
+        Gets the ids of the most recent handled messages with any of the given labels, with a k-way merge of keyset
+        reads of each label's labellings. Those reads only filter on labelling fields so they can be answered from
+        the label's partial index, and unhandled messages are left out as the merged labellings are consumed.
+        :param labels: the labels
+        :param cursor: the (created_on, id) of the last message of the previous page
+        :param limit: the maximum number of message ids to return
+        :param filtering: filters on the labelling fields
+        :return: the message ids ordered by most recent first
+        """
+        labels = list(labels)
+        if not labels:
+            return []
+
+        page_size = limit or cls.SEARCH_PAGE_SIZE
+        queryset = cls.objects.filter(**filtering).order_by("-message_created_on", "-message_id")
+
+        def read_label(label):
+            label_cursor = cursor
+            while True:
+                page = queryset.filter(label=label)
+                if label_cursor:
+                    page = after_cursor(page, label_cursor, "message_created_on", id_field="message_id")
+
+                page = list(page.values_list("message_created_on", "message_id")[:page_size])
+                yield from page
+
+                if len(page) < page_size:
+                    return
+                label_cursor = page[-1]
+
+        # messages with several of the labels come out of the merge together so are de-duplicated by grouping
+        merged = heapq.merge(*[read_label(label) for label in labels], reverse=True)
+        merged = (message_id for (created_on, message_id), _ in groupby(merged))
+
+        message_ids = []
+        for batch in chunks(merged, page_size):
+            handled = set(Message.objects.filter(id__in=batch, is_handled=True).values_list("id", flat=True))
+            message_ids += [message_id for message_id in batch if message_id in handled]
+
+            if limit is not None and len(message_ids) >= limit:
+                return message_ids[:limit]
+
+        return message_ids
+
     class Meta:
         db_table = "msgs_message_labels"
         unique_together = ("message", "label")
@@ -352,11 +515,10 @@ class Message(models.Model):
 
     SAVE_CONTACT_ATTR = "__data__contact"
     SAVE_LABELS_ATTR = "__data__labels"
+    SAVE_CONTEXT_ATTR = "__data__context"
 
     TIMELINE_TYPE = "I"
 
-    SEARCH_BY_TEXT_DAYS = 90
-
     org = models.ForeignKey(Org, related_name="incoming_messages", on_delete=models.PROTECT)
 
     # identifier of the message on the backend
@@ -397,6 +559,8 @@ class Message(models.Model):
             setattr(self, self.SAVE_CONTACT_ATTR, kwargs.pop(self.SAVE_CONTACT_ATTR))
         if self.SAVE_LABELS_ATTR in kwargs:
             setattr(self, self.SAVE_LABELS_ATTR, kwargs.pop(self.SAVE_LABELS_ATTR))
+        if self.SAVE_CONTEXT_ATTR in kwargs:
+            setattr(self, self.SAVE_CONTEXT_ATTR, kwargs.pop(self.SAVE_CONTEXT_ATTR))
 
         super(Message, self).__init__(*args, **kwargs)
 
@@ -409,9 +573,15 @@ class Message(models.Model):
         return get_redis_connection().lock(MESSAGE_LOCK_KEY % (org.pk, backend_id), timeout=60)
 
     @classmethod
-    def search(cls, org, user, search, modified_after=None, all=False):
+    def batch_sync_lock(cls, org):
+        return get_redis_connection().lock(MESSAGE_BATCH_SYNC_LOCK_KEY % org.pk, timeout=300)
+
+    @classmethod
+    def search(cls, org, user, search, modified_after=None, all=False, cursor=None, limit=None):
         """
         Search for messages
+        :param cursor: the (created_on, id) of the last message of the previous page
+        :param limit: the page size, if messages are to be fetched a page at a time
         """
         folder = search.get("folder")
         label_id = search.get("label")
@@ -429,7 +599,7 @@ class Message(models.Model):
         # track what we need to filter on by where is can be found in the database
         msg_filtering = {}
         lbl_filtering = {}
-        ordering = ("-created_on",)
+        ordering = ("-created_on", "-id")
 
         # if this is a refresh we want everything with new actions and locks
         if modified_after:
@@ -450,7 +620,8 @@ class Message(models.Model):
 
         if text:
             msg_filtering["text__icontains"] = text
-            msg_filtering["created_on__gt"] = now() - timedelta(days=cls.SEARCH_BY_TEXT_DAYS)
+            if settings.SEARCH_BY_TEXT_DAYS:
+                msg_filtering["created_on__gt"] = now() - timedelta(days=settings.SEARCH_BY_TEXT_DAYS)
         if contact_id:
             msg_filtering["contact__id"] = contact_id
         if after and not modified_after:
@@ -461,6 +632,9 @@ class Message(models.Model):
         # only show non-deleted handled messages
         msgs = org.incoming_messages.filter(is_active=True, is_handled=True).order_by(*ordering)
 
+        if cursor and not modified_after:
+            msgs = after_cursor(msgs, cursor, "created_on")
+
         # handle views that don't require filtering by any labels
         if folder == MessageFolder.unlabelled:
             return (
@@ -480,16 +654,9 @@ class Message(models.Model):
         # if we're only filtering on things on the labelling table..
         if not msg_filtering and not all:
             lbl_filtering = {f"message_{k}": v for k, v in lbl_filtering.items()}
-            message_ids = set()
+            message_ids = Labelling.search_messages(labels, cursor, limit, **lbl_filtering)
 
-            for label in labels:
-                message_ids.update(
-                    Labelling.objects.filter(label=label, **lbl_filtering)
-                    .order_by("-message_created_on")
-                    .values_list("message_id", flat=True)[:1000]
-                )
-
-            return Message.objects.filter(id__in=message_ids, is_handled=True).order_by("-created_on")
+            return Message.objects.filter(id__in=message_ids).order_by("-created_on", "-id")
 
         msg_filtering["has_labels"] = True
         msgs = msgs.filter(labels__in=list(labels))
@@ -545,27 +712,13 @@ class Message(models.Model):
         """
         Removes the given labels from this message
         """
-        from casepro.statistics.models import DailyCount, datetime_to_date
-
-        existing_labellings = Labelling.objects.filter(message=self, label__in=labels).select_related("label")
-
-        day = datetime_to_date(self.created_on, self.org)
-        for labelling in existing_labellings:
-            DailyCount.record_removal(day, DailyCount.TYPE_INCOMING, labelling.label)
-
-        Labelling.objects.filter(id__in=[l.id for l in existing_labellings]).delete()
+        Labelling.unlabel_messages(self.org, [self], labels)
 
     def clear_labels(self):
         """
         Removes all labels from this message
         """
-        from casepro.statistics.models import DailyCount, datetime_to_date
-
-        day = datetime_to_date(self.created_on, self.org)
-        for label in self.labels.all():
-            DailyCount.record_removal(day, DailyCount.TYPE_INCOMING, label)
-
-        Labelling.objects.filter(message=self).delete()
+        Labelling.unlabel_messages(self.org, [self])
 
     def update_labels(self, user, labels):
         """
@@ -604,11 +757,9 @@ class Message(models.Model):
     def bulk_flag(org, user, messages):
         messages = list(messages)
         if messages:
-            org.incoming_messages.filter(org=org, pk__in=[m.pk for m in messages]).update(
-                is_flagged=True, modified_on=now()
-            )
+            changed = Message._update_state(org, messages, is_flagged=True)
 
-            org.get_backend().flag_messages(org, messages)
+            BackendOp.queue(org, MessageAction.FLAG, changed)
 
             MessageAction.create(org, user, messages, MessageAction.FLAG)
 
@@ -616,11 +767,9 @@ class Message(models.Model):
     def bulk_unflag(org, user, messages):
         messages = list(messages)
         if messages:
-            org.incoming_messages.filter(org=org, pk__in=[m.pk for m in messages]).update(
-                is_flagged=False, modified_on=now()
-            )
+            changed = Message._update_state(org, messages, is_flagged=False)
 
-            org.get_backend().unflag_messages(org, messages)
+            BackendOp.queue(org, MessageAction.UNFLAG, changed)
 
             MessageAction.create(org, user, messages, MessageAction.UNFLAG)
 
@@ -628,13 +777,12 @@ class Message(models.Model):
     def bulk_label(org, user, messages, label):
         messages = list(messages)
         if messages:
-            for msg in messages:
-                msg.label(label)
+            added = Labelling.label_messages(label, messages)
 
             org.incoming_messages.filter(org=org, pk__in=[m.pk for m in messages]).update(modified_on=now())
 
             if label.is_synced:
-                org.get_backend().label_messages(org, messages, label)
+                BackendOp.queue(org, MessageAction.LABEL, added, label)
 
             MessageAction.create(org, user, messages, MessageAction.LABEL, label)
 
@@ -642,13 +790,12 @@ class Message(models.Model):
     def bulk_unlabel(org, user, messages, label):
         messages = list(messages)
         if messages:
-            for msg in messages:
-                msg.unlabel(label)
+            removed = Labelling.unlabel_messages(org, messages, [label])
 
             org.incoming_messages.filter(org=org, pk__in=[m.pk for m in messages]).update(modified_on=now())
 
             if label.is_synced:
-                org.get_backend().unlabel_messages(org, messages, label)
+                BackendOp.queue(org, MessageAction.UNLABEL, [m for l, m, day in removed], label)
 
             MessageAction.create(org, user, messages, MessageAction.UNLABEL, label)
 
@@ -656,11 +803,9 @@ class Message(models.Model):
     def bulk_archive(org, user, messages):
         messages = list(messages)
         if messages:
-            org.incoming_messages.filter(org=org, pk__in=[m.pk for m in messages]).update(
-                is_archived=True, modified_on=now()
-            )
+            changed = Message._update_state(org, messages, is_archived=True)
 
-            org.get_backend().archive_messages(org, messages)
+            BackendOp.queue(org, MessageAction.ARCHIVE, changed)
 
             MessageAction.create(org, user, messages, MessageAction.ARCHIVE)
 
@@ -668,14 +813,25 @@ class Message(models.Model):
     def bulk_restore(org, user, messages):
         messages = list(messages)
         if messages:
-            org.incoming_messages.filter(org=org, pk__in=[m.pk for m in messages]).update(
-                is_archived=False, modified_on=now()
-            )
+            changed = Message._update_state(org, messages, is_archived=False)
 
-            org.get_backend().restore_messages(org, messages)
+            BackendOp.queue(org, MessageAction.RESTORE, changed)
 
             MessageAction.create(org, user, messages, MessageAction.RESTORE)
 
+    @staticmethod
+    def _update_state(org, messages, **state):
+        """
+        Updates the given state fields of the given messages, returning those whose state actually changed, as only
+        those need the change pushing to the backend
+        """
+        queryset = org.incoming_messages.filter(org=org, pk__in=[m.pk for m in messages])
+        changed_ids = set(queryset.exclude(**state).values_list("pk", flat=True))
+
+        queryset.update(**state, modified_on=now())
+
+        return [m for m in messages if m.pk in changed_ids]
+
     def as_json(self):
         """
         Prepares this message for JSON serialization
@@ -695,6 +851,12 @@ class Message(models.Model):
     def __str__(self):
         return self.text if self.text else self.pk
 
+    class Meta:
+        indexes = (
+            # trigram index on the same expression as case insensitive contains lookups, for searches by text
+            GinIndex(OpClass(Upper("text"), name="gin_trgm_ops"), name="msgs_message_text_trgm"),
+        )
+
 
 class MessageAction(models.Model):
     """
@@ -747,6 +909,190 @@ class MessageAction(models.Model):
         }
 
 
+class BackendOp(models.Model):
+    """
+    A pending operation on a message which is queued to be pushed to the backend asynchronously, so that requests and
+    tasks don't have to wait on the backend. Operations are merged into batches and opposing operations cancelled out
+    before being pushed.
+    """
+
+    BACKEND_METHODS = {
+        MessageAction.FLAG: "flag_messages",
+        MessageAction.UNFLAG: "unflag_messages",
+        MessageAction.LABEL: "label_messages",
+        MessageAction.UNLABEL: "unlabel_messages",
+        MessageAction.ARCHIVE: "archive_messages",
+        MessageAction.RESTORE: "restore_messages",
+    }
+
+    OPPOSITES = {
+        MessageAction.FLAG: MessageAction.UNFLAG,
+        MessageAction.UNFLAG: MessageAction.FLAG,
+        MessageAction.LABEL: MessageAction.UNLABEL,
+        MessageAction.UNLABEL: MessageAction.LABEL,
+        MessageAction.ARCHIVE: MessageAction.RESTORE,
+        MessageAction.RESTORE: MessageAction.ARCHIVE,
+    }
+
+    BATCH_SIZE = 99  # same as RapidProBackend.BATCH_SIZE
+    READ_BATCH_SIZE = 5000
+    MAX_ATTEMPTS = 10
+    RETRY_BASE_SECONDS = 30
+    RETRY_MAX_SECONDS = 60 * 60
+
+    org = models.ForeignKey(Org, related_name="backend_ops", on_delete=models.PROTECT)
+
+    op = models.CharField(max_length=1, choices=MessageAction.ACTION_CHOICES)
+
+    message = models.ForeignKey(Message, related_name="backend_ops", on_delete=models.CASCADE)
+
+    label = models.ForeignKey(Label, null=True, on_delete=models.CASCADE)
+
+    created_on = models.DateTimeField(default=now)
+
+    attempts = models.IntegerField(default=0)
+
+    retry_on = models.DateTimeField(null=True)
+
+    @classmethod
+    def queue(cls, org, op, messages, label=None):
+        """
+        Queues an operation on the given messages, which will be pushed to the backend once the current transaction
+        has committed
+        """
+        from .tasks import push_backend_ops
+
+        if not messages:
+            return
+
+        now_ = now()
+        cls.objects.bulk_create([cls(org=org, op=op, message=m, label=label, created_on=now_) for m in messages])
+
+        transaction.on_commit(lambda: push_backend_ops.delay(org.pk))
+
+    @classmethod
+    def get_backlog(cls, org):
+        """
+        Gets the number of operations waiting to be pushed for the given org
+        """
+        return cls.objects.filter(org=org).count()
+
+    @classmethod
+    def push(cls, org):
+        """
+        Pushes all due operations for the given org to the backend, reading them in batches so that a large backlog
+        isn't loaded into memory all at once
+        :return: tuple of the number of operations pushed, cancelled and failed
+        """
+        backend = org.get_backend()
+        num_pushed, num_cancelled, num_failed = 0, 0, 0
+
+        # chains which are waiting or failed, so any of their later operations in later batches have to wait too
+        held = set()
+        last_id = 0
+
+        while True:
+            ops = list(
+                cls.objects.filter(org=org, id__gt=last_id)
+                .select_related("message", "label")
+                .order_by("id")[: cls.READ_BATCH_SIZE]
+            )
+            if not ops:
+                break
+
+            last_id = ops[-1].id
+
+            pushed, cancelled, failed = cls._push_ops(org, backend, ops, held)
+            num_pushed += pushed
+            num_cancelled += cancelled
+            num_failed += failed
+
+        return num_pushed, num_cancelled, num_failed
+
+    @classmethod
+    def _push_ops(cls, org, backend, ops, held):
+        """
+        Pushes a batch of operations, adding the keys of any chains which have to wait to the given held set
+        """
+        num_pushed, num_cancelled, num_failed = 0, 0, 0
+
+        # group operations by message, label and type of operation, e.g. all flags and un-flags of a message
+        chains = defaultdict(list)
+        for op in ops:
+            chains[(op.message_id, op.label_id, min(op.op, cls.OPPOSITES[op.op]))].append(op)
+
+        # resolve each chain to the single operation which actually needs pushing, if any
+        ops_by_batch = defaultdict(list)
+        for key, chain in chains.items():
+            # if any operation in a chain is waiting to be retried, the whole chain has to wait
+            if key in held or any(op.retry_on and op.retry_on > now() for op in chain):
+                held.add(key)
+                continue
+
+            effective = cls._resolve_chain(chain)
+            if effective:
+                ops_by_batch[(effective.op, effective.label)].append((key, chain))
+            else:
+                cls.objects.filter(id__in=[op.id for op in chain]).delete()
+                num_cancelled += len(chain)
+
+        for (op, label), batch_chains in ops_by_batch.items():
+            batch_chains = sorted(batch_chains, key=lambda c: c[1][0].message_id)
+
+            for chunk in chunks(batch_chains, cls.BATCH_SIZE):
+                chain_ops = [op for key, chain in chunk for op in chain]
+                messages = [chain[-1].message for key, chain in chunk]
+                args = (org, messages, label) if label else (org, messages)
+
+                try:
+                    getattr(backend, cls.BACKEND_METHODS[op])(*args)
+
+                    cls.objects.filter(id__in=[o.id for o in chain_ops]).delete()
+                    num_pushed += len(chain_ops)
+                except Exception as e:
+                    logger.exception(e)
+
+                    cls._retry_later(chain_ops)
+                    num_failed += len(chain_ops)
+                    held.update(key for key, chain in chunk)
+
+        return num_pushed, num_cancelled, num_failed
+
+    @classmethod
+    def _resolve_chain(cls, chain):
+        """
+        Resolves a chain of operations of the same type on the same message, e.g. label, un-label, label, to the single
+        operation that needs pushing, or none if they cancel each other out
+        """
+        # drop consecutive duplicates, e.g. label, label
+        alternating = [op for o, op in enumerate(chain) if o == 0 or op.op != chain[o - 1].op]
+
+        # an even number of alternating operations cancel each other out, which only holds because operations are only
+        # queued for messages whose state actually changed, so each one undoes the one before it
+        return alternating[-1] if len(alternating) % 2 == 1 else None
+
+    @classmethod
+    def _retry_later(cls, ops):
+        """
+        Schedules the given failed operations to be retried with a backoff based on each one's own number of attempts,
+        giving up on those which have been attempted too many times
+        """
+        ops_by_attempts = defaultdict(list)
+        for op in ops:
+            ops_by_attempts[op.attempts + 1].append(op)
+
+        for attempts, attempt_ops in ops_by_attempts.items():
+            if attempts >= cls.MAX_ATTEMPTS:
+                logger.error(f"Giving up on {len(attempt_ops)} backend operations after {attempts} attempts")
+                cls.objects.filter(id__in=[o.id for o in attempt_ops]).delete()
+                continue
+
+            delay = min(cls.RETRY_BASE_SECONDS * 2 ** (attempts - 1), cls.RETRY_MAX_SECONDS)
+            cls.objects.filter(id__in=[o.id for o in attempt_ops]).update(
+                attempts=F("attempts") + 1, retry_on=now() + timedelta(seconds=delay)
+            )
+
+
 class Outgoing(models.Model):
     """
     An outgoing message (i.e. broadcast) sent by a user
@@ -761,8 +1107,6 @@ class Outgoing(models.Model):
 
     TIMELINE_TYPE = "O"
 
-    SEARCH_BY_TEXT_DAYS = 90
-
     org = models.ForeignKey(Org, related_name="outgoing_messages", on_delete=models.PROTECT)
 
     partner = models.ForeignKey("cases.Partner", null=True, related_name="outgoing_messages", on_delete=models.PROTECT)
@@ -827,7 +1171,7 @@ class Outgoing(models.Model):
         if not contact and not urn:  # pragma: no cover
             raise ValueError("Message must have a recipient")
 
-        msg = cls.objects.create(
+        msg = cls(
             org=org,
             partner=user.get_partner(org),
             activity=activity,
@@ -839,6 +1183,12 @@ class Outgoing(models.Model):
             created_by=user,
         )
 
+        with transaction.atomic():
+            if case:
+                case.record_reply(msg)
+
+            msg.save()
+
         if push:
             org.get_backend().push_outgoing(org, [msg])
 
@@ -849,7 +1199,11 @@ class Outgoing(models.Model):
         return org.outgoing_messages.filter(activity__in=cls.REPLY_ACTIVITIES)
 
     @classmethod
-    def search(cls, org, user, search):
+    def search(cls, org, user, search, cursor=None):
+        """
+        Search for outgoing messages
+        :param cursor: the (created_on, id) of the last message of the previous page
+        """
         text = search.get("text")
         contact_id = search.get("contact")
 
@@ -860,19 +1214,21 @@ class Outgoing(models.Model):
             queryset = queryset.filter(partner=partner)
 
         if text:
-            queryset = queryset.filter(
-                text__icontains=text, created_on__gt=now() - timedelta(days=cls.SEARCH_BY_TEXT_DAYS)
-            )
+            queryset = queryset.filter(text__icontains=text)
+            if settings.SEARCH_BY_TEXT_DAYS:
+                queryset = queryset.filter(created_on__gt=now() - timedelta(days=settings.SEARCH_BY_TEXT_DAYS))
 
         if contact_id:
             queryset = queryset.filter(contact__pk=contact_id)
+        if cursor:
+            queryset = after_cursor(queryset, cursor, "created_on")
 
         queryset = queryset.prefetch_related("partner", "contact", "case__assignee", "created_by__profile")
 
-        return queryset.order_by("-created_on")
+        return queryset.order_by("-created_on", "-id")
 
     @classmethod
-    def search_replies(cls, org, user, search):
+    def search_replies(cls, org, user, search, cursor=None):
         partner_id = search.get("partner")
         after = search.get("after")
         before = search.get("before")
@@ -890,11 +1246,13 @@ class Outgoing(models.Model):
             queryset = queryset.filter(created_on__gte=after)
         if before:
             queryset = queryset.filter(created_on__lte=before)
+        if cursor:
+            queryset = after_cursor(queryset, cursor, "created_on")
 
         queryset = queryset.select_related("contact", "case__assignee", "created_by__profile")
         queryset = queryset.prefetch_related("reply_to__labels")
 
-        return queryset.order_by("-created_on")
+        return queryset.order_by("-created_on", "-id")
 
     def is_reply(self):
         return self.activity in self.REPLY_ACTIVITIES
@@ -926,6 +1284,9 @@ class Outgoing(models.Model):
     def __str__(self):
         return self.text
 
+    class Meta:
+        indexes = (GinIndex(OpClass(Upper("text"), name="gin_trgm_ops"), name="msgs_outgoing_text_trgm"),)
+
 
 class MessageExport(BaseSearchExport):
     """
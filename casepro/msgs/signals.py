@@ -10,6 +10,16 @@ def update_label_uuid(sender, instance, **kwargs):
         instance.org.get_backend().push_label(instance.org, instance)
 
 
+@receiver(post_save, sender=Label)
+def invalidate_compiled_rules(sender, instance, **kwargs):
+    """
+    Save signal handler to invalidate any compiled rules which might have a stale copy of the label
+    """
+    from casepro.rules.models import Rule
+
+    Rule.bump_version(instance.org_id)
+
+
 @receiver(pre_save, sender=Message)
 def update_message_contact(sender, instance, **kwargs):
     from casepro.contacts.models import Contact
@@ -27,10 +37,13 @@ def update_message_labels(sender, instance, created, **kwargs):
     """
     Save signal handler to update the message labels when labels are specified as attribute on the message object
     """
+    from casepro.backend import SyncContext
+
     if not hasattr(instance, Message.SAVE_LABELS_ATTR):
         return
 
-    org = instance.org
+    # use the context of the sync run if there is one
+    context = getattr(instance, Message.SAVE_CONTEXT_ATTR, None) or SyncContext(instance.org)
 
     new_labels_by_uuid = {l[0]: l[1] for l in getattr(instance, Message.SAVE_LABELS_ATTR)}
 
@@ -49,20 +62,16 @@ def update_message_labels(sender, instance, created, **kwargs):
     # add this message to any labels not in the current set
     add_to_by_uuid = {uuid: name for uuid, name in new_labels_by_uuid.items() if uuid not in cur_labels_by_uuid.keys()}
     if add_to_by_uuid:
-        org_labels_by_uuid = {l.uuid: l for l in org.labels.all()}
-        org_unsynced_names = {l.name for l in org.labels.all() if not l.is_synced}
-
-        # create any labels that don't exist
+        # get labels, creating stubs for any that don't exist
         add_to_labels = []
         for uuid, name in add_to_by_uuid.items():
-            label = org_labels_by_uuid.get(uuid)
-            if not label and name not in org_unsynced_names:
-                # create stub
-                label = org.labels.create(uuid=uuid, name=name, is_active=False)
-
+            label = context.get_or_create_label(uuid, name)
             if label and label.is_synced:
                 add_to_labels.append(label)
 
         instance.label(*add_to_labels)
 
     delattr(instance, Message.SAVE_LABELS_ATTR)
+
+    if hasattr(instance, Message.SAVE_CONTEXT_ATTR):
+        delattr(instance, Message.SAVE_CONTEXT_ATTR)
@@ -18,11 +18,13 @@ from casepro.profiles.models import Notification
 from casepro.rules.models import Rule
 from casepro.utils import parse_csv
 
-from .models import FAQ, Label, Message, MessageAction, MessageExport, Outgoing, ReplyExport
+from .models import FAQ, BackendOp, Label, Message, MessageAction, MessageExport, Outgoing, ReplyExport
 
 logger = get_task_logger(__name__)
 
 TRIM_TASK_MAX_SECONDS = 8 * 60 * 60  # 8 hours
+HANDLE_TASK_MAX_SECONDS = 30 * 60  # 30 minutes
+HANDLE_BATCH_SIZE = 1000
 
 
 @org_task("message-pull", lock_timeout=2 * 60 * 60)
@@ -38,7 +40,7 @@ def pull_messages(org, since, until, prev_results):
 
     labels_created, labels_updated, labels_deleted, ignored = backend.pull_labels(org)
 
-    def progress(num):  # pragma: no cover
+    def progress(num, cursor):  # pragma: no cover
         logger.debug(f" > Synced {num} messages for org #{org.id}")
 
     cursor = None
@@ -73,24 +75,41 @@ def pull_messages(org, since, until, prev_results):
     }
 
 
-@org_task("message-handle", lock_timeout=12 * 60 * 60)
+@org_task("message-handle", lock_timeout=60 * 60)
 def handle_messages(org):
-    backend = org.get_backend()
+    """
+    Handles new unhandled messages for an org in batches, committing each batch as it goes so that a large backlog
+    doesn't have to be processed in one go. Stops once the time limit is reached and leaves the remainder for the next
+    run.
+    """
+    started_on = timezone.now()
 
-    case_replies = []
+    num_handled = 0
+    num_case_replies = 0
     num_rules_matched = 0
     ignored_with_ticket = 0
+    last_id = 0
+    compiled_rules = None
 
     # fetch all unhandled messages who now have full contacts
     unhandled = Message.get_unhandled(org).filter(contact__is_stub=False)
-    unhandled = list(unhandled.select_related("contact").prefetch_related("contact__groups"))
+    unhandled = unhandled.select_related("contact").prefetch_related("contact__groups").order_by("id")
+
+    while True:
+        batch = list(unhandled.filter(id__gt=last_id)[:HANDLE_BATCH_SIZE])
+        if not batch:
+            last_id = None
+            break
 
-    if unhandled:
-        rules = Rule.get_all(org)
-        rule_processor = Rule.BatchProcessor(org, rules)
+        if compiled_rules is None:
+            compiled_rules = Rule.get_compiled(org)
 
-        for msg in unhandled:
-            open_case = Case.get_open_for_contact_on(org, msg.contact, msg.created_on)
+        case_replies = []
+        rule_processor = Rule.BatchProcessor(org, compiled_rules)
+
+        open_cases = Case.get_open_for_contacts_on(org, [(msg.contact, msg.created_on) for msg in batch])
+
+        for msg, open_case in zip(batch, open_cases):
             has_ticket = msg.contact.has_rapidpro_ticket()
 
             # only apply rules if there isn't a currently open case for this contact or open ticket in RapidPro
@@ -106,20 +125,51 @@ def handle_messages(org):
 
         # archive messages which are case replies on the backend
         if case_replies:
-            backend.archive_messages(org, case_replies)
+            BackendOp.queue(org, MessageAction.ARCHIVE, case_replies)
 
         rule_processor.apply_actions()
 
         # mark all of these messages as handled
-        Message.objects.filter(pk__in=[m.pk for m in unhandled]).update(is_handled=True, modified_on=timezone.now())
+        Message.objects.filter(pk__in=[m.pk for m in batch]).update(is_handled=True, modified_on=timezone.now())
 
-    return {
-        "handled": len(unhandled),
+        num_handled += len(batch)
+        num_case_replies += len(case_replies)
+        last_id = batch[-1].id
+
+        logger.debug(f" > Handled {num_handled} messages for org #{org.id}")
+
+        # task is only allowed to run for a certain amount of time
+        if (timezone.now() - started_on).total_seconds() > HANDLE_TASK_MAX_SECONDS:
+            break
+
+    results = {
+        "handled": num_handled,
         "rules_matched": num_rules_matched,
-        "case_replies": len(case_replies),
+        "case_replies": num_case_replies,
         "ignored_with_ticket": ignored_with_ticket,
     }
 
+    # if we stopped early, record how far we got - the next run will pick up the remaining unhandled messages
+    if last_id:
+        results["resume"] = {"after_id": last_id}
+
+    return results
+
+
+@org_task("backend-push", lock_timeout=60 * 60)
+def push_backend_ops(org):
+    """
+    Pushes queued message operations (flagging, labelling, archiving etc) for an org to the backend
+    """
+    num_pushed, num_cancelled, num_failed = BackendOp.push(org)
+
+    return {
+        "pushed": num_pushed,
+        "cancelled": num_cancelled,
+        "failed": num_failed,
+        "backlog": BackendOp.get_backlog(org),
+    }
+
 
 @shared_task
 def message_export(export_id):
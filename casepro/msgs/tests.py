@@ -1,4 +1,4 @@
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from unittest.mock import ANY, call, patch
 
 from dash.orgs.models import TaskState
@@ -15,11 +15,13 @@ from casepro.contacts.models import Contact, Group
 from casepro.msgs.views import ImportTask
 from casepro.profiles.models import Notification
 from casepro.rules.models import ContainsTest, FieldTest, GroupsTest, Quantifier, WordCountTest
+from casepro.statistics.models import DailyCount, DailySecondTotalCount, datetime_to_date
 from casepro.statistics.tasks import squash_counts
 from casepro.test import BaseCasesTest
 
 from .models import (
     FAQ,
+    BackendOp,
     Label,
     Labelling,
     Message,
@@ -30,7 +32,7 @@ from .models import (
     OutgoingFolder,
     ReplyExport,
 )
-from .tasks import faq_csv_import, handle_messages, pull_messages, trim_old_messages
+from .tasks import faq_csv_import, handle_messages, pull_messages, push_backend_ops, trim_old_messages
 
 faq_good_import = b"""Parent ID,Parent Language,Parent Question,Parent Answer,Labels,afr ID,afr Question,afr Answer,bla ID,bla Question,bla Answer
 ,eng,Can I drink tea while pregnant?,"Yes, but avoid too much caffeine","Tea, Pregnancy",,Kan ek tee drink tydens swangerskap?,"Ja, maar beperk jou kaffein inname",,Xtea Xpregnant?,Xyes
@@ -981,7 +983,7 @@ class MessageTest(BaseCasesTest):
             message.save()
 
         # check removing a label and adding new ones
-        with self.assertNumQueries(11):
+        with self.assertNumQueries(16):
             setattr(message, "__data__labels", [("L-002", "Feedback"), ("L-003", "Important")])
             message.save()
 
@@ -1119,8 +1121,32 @@ class MessageTest(BaseCasesTest):
         # by contact in the inbox
         assert_search(self.admin, {"folder": MessageFolder.inbox, "contact": bob.pk}, [msg8, msg6])
 
-        # by text (won't include really old message)
+        # by text
         assert_search(self.admin, {"folder": MessageFolder.inbox, "text": "hello"}, [msg8, msg7, msg6, msg5])
+        assert_search(self.admin, {"folder": MessageFolder.unlabelled, "text": "old"}, [msg12])
+
+        # searches by text can be limited to recent messages
+        with override_settings(SEARCH_BY_TEXT_DAYS=90):
+            assert_search(self.admin, {"folder": MessageFolder.unlabelled, "text": "old"}, [])
+
+        # restricted partner searches are merged across their labels a page at a time
+        inbox = {"folder": MessageFolder.inbox}
+        self.assertEqual(list(Message.search(self.unicef, self.user1, inbox, limit=3)), [msg8, msg7, msg6])
+        self.assertEqual(
+            list(Message.search(self.unicef, self.user1, inbox, cursor=(msg7.created_on, msg7.pk), limit=3)),
+            [msg6, msg5],
+        )
+        self.assertEqual(
+            list(Message.search(self.unicef, self.admin, inbox, cursor=(msg7.created_on, msg7.pk))), [msg6, msg5]
+        )
+
+        # messages with several labels are only included once
+        msg6.label(self.aids)
+        self.assertEqual(list(Message.search(self.unicef, self.user1, inbox, limit=2)), [msg8, msg7])
+        self.assertEqual(
+            list(Message.search(self.unicef, self.user1, inbox, cursor=(msg7.created_on, msg7.pk), limit=2)),
+            [msg6, msg5],
+        )
         assert_search(self.admin, {"folder": MessageFolder.inbox, "text": "LO 5"}, [msg5])
 
         # check combining text searches with other date based searching
@@ -1139,6 +1165,8 @@ class MessageTest(BaseCasesTest):
 
         self.msg1.update_labels(self.user1, [self.pregnancy, ebola])
 
+        BackendOp.push(self.unicef)
+
         mock_label_messages.assert_called_once_with(self.unicef, [self.msg1], ebola)
         mock_unlabel_messages.assert_called_once_with(self.unicef, [self.msg1], self.aids)
 
@@ -1162,6 +1190,8 @@ class MessageTest(BaseCasesTest):
 
         Message.bulk_flag(self.unicef, self.user1, [self.msg2, self.msg3])
 
+        BackendOp.push(self.unicef)
+
         mock_flag_messages.assert_called_once_with(self.unicef, [self.msg2, self.msg3])
 
         action = MessageAction.objects.get()
@@ -1177,7 +1207,10 @@ class MessageTest(BaseCasesTest):
 
         Message.bulk_unflag(self.unicef, self.user1, [self.msg3, self.msg4])
 
-        mock_unflag_messages.assert_called_once_with(self.unicef, [self.msg3, self.msg4])
+        BackendOp.push(self.unicef)
+
+        # only the message which was actually flagged needs unflagging in the backend
+        mock_unflag_messages.assert_called_once_with(self.unicef, [self.msg4])
 
         action = MessageAction.objects.get()
         self.assertEqual(action.action, MessageAction.UNFLAG)
@@ -1206,10 +1239,164 @@ class MessageTest(BaseCasesTest):
         # try with synced label
         Message.bulk_label(self.unicef, self.user1, [self.msg1, self.msg2], self.aids)
 
-        mock_label_messages.assert_called_once_with(self.unicef, [self.msg1, self.msg2], self.aids)
+        BackendOp.push(self.unicef)
+
+        # msg1 already had the label so only msg2 needs labelling in the backend
+        mock_label_messages.assert_called_once_with(self.unicef, [self.msg2], self.aids)
 
         self.assertEqual(self.aids.messages.count(), 2)
 
+    def test_label_messages(self):
+        self.create_test_messages()
+        self.aids.watch(self.admin)
+        self.aids.watch(self.user1)
+
+        msg6 = self.create_message(
+            self.unicef, 106, self.ann, "Yesterday", created_on=datetime(2016, 1, 1, 10, tzinfo=timezone.utc)
+        )
+
+        DailyCount.objects.all().delete()
+
+        # msg1 already has the label so only the others are labelled
+        with self.assertNumQueries(5):
+            added = Labelling.label_messages(self.aids, [self.msg1, self.msg2, self.msg4, msg6])
+
+        self.assertEqual(added, [self.msg2, self.msg4, msg6])
+        self.assertEqual(set(self.aids.messages.all()), {self.msg1, self.msg2, self.msg4, msg6})
+
+        self.msg4.refresh_from_db()
+        self.assertTrue(self.msg4.has_labels)
+        self.assertTrue(Labelling.objects.get(message=self.msg4, label=self.aids).message_is_flagged)
+
+        # daily counts are recorded as a single row per day
+        self.assertEqual(
+            set(DailyCount.objects.values_list("day", "item_type", "scope", "count")),
+            {
+                (datetime_to_date(self.msg2.created_on, self.unicef), "I", "label:%d" % self.aids.pk, 2),
+                (date(2016, 1, 1), "I", "label:%d" % self.aids.pk, 1),
+            },
+        )
+
+        # watchers are notified of all the messages
+        self.assertEqual(Notification.objects.filter(type=Notification.TYPE_MESSAGE_LABELLING).count(), 8)
+
+        # labelling again is a no-op which doesn't re-notify
+        self.assertEqual(Labelling.label_messages(self.aids, [self.msg2, msg6]), [])
+        self.assertEqual(Notification.objects.filter(type=Notification.TYPE_MESSAGE_LABELLING).count(), 8)
+
+        self.assertEqual(Labelling.label_messages(self.aids, []), [])
+
+        # large numbers of messages are inserted in batches
+        self.aids.unwatch(self.admin)
+        self.aids.unwatch(self.user1)
+        Labelling.objects.all().delete()
+
+        with patch.object(Labelling, "INSERT_BATCH_SIZE", 2):
+            with self.assertNumQueries(4):
+                added = Labelling.label_messages(self.aids, [self.msg1, self.msg2, self.msg4, msg6])
+
+        self.assertEqual(added, [self.msg1, self.msg2, self.msg4, msg6])
+        self.assertEqual(set(self.aids.messages.all()), {self.msg1, self.msg2, self.msg4, msg6})
+
+    def test_unlabel_messages(self):
+        self.create_test_messages()
+
+        msg6 = self.create_message(
+            self.unicef,
+            106,
+            self.ann,
+            "Yesterday",
+            [self.aids, self.tea],
+            created_on=datetime(2016, 1, 1, 10, tzinfo=timezone.utc),
+        )
+
+        DailyCount.objects.all().delete()
+        today = datetime_to_date(self.msg1.created_on, self.unicef)
+
+        # remove specific labels
+        with self.assertNumQueries(2):
+            removed = Labelling.unlabel_messages(
+                self.unicef, [self.msg1, self.msg2, msg6], [self.aids, self.pregnancy]
+            )
+
+        self.assertEqual(
+            set(removed),
+            {(self.aids, self.msg1, today), (self.pregnancy, self.msg1, today), (self.aids, msg6, date(2016, 1, 1))},
+        )
+        self.assertEqual(set(self.msg1.labels.all()), {self.tea})
+        self.assertEqual(set(msg6.labels.all()), {self.tea})
+
+        # remove all labels
+        with self.assertNumQueries(3):
+            removed = Labelling.unlabel_messages(self.unicef, [self.msg1, msg6])
+
+        self.assertEqual(set(removed), {(self.tea, self.msg1, today), (self.tea, msg6, date(2016, 1, 1))})
+        self.assertEqual(Labelling.objects.count(), 0)
+
+        msg6.refresh_from_db()
+        self.assertFalse(msg6.has_labels)
+
+        # negative counts are recorded as a single row per day and label
+        self.assertEqual(
+            set(DailyCount.objects.values_list("day", "scope", "count")),
+            {
+                (today, "label:%d" % self.aids.pk, -1),
+                (today, "label:%d" % self.pregnancy.pk, -1),
+                (today, "label:%d" % self.tea.pk, -1),
+                (date(2016, 1, 1), "label:%d" % self.aids.pk, -1),
+                (date(2016, 1, 1), "label:%d" % self.tea.pk, -1),
+            },
+        )
+
+        # nothing left to remove
+        with self.assertNumQueries(1):
+            self.assertEqual(Labelling.unlabel_messages(self.unicef, [self.msg1, msg6]), [])
+
+        self.assertEqual(Labelling.unlabel_messages(self.unicef, [self.msg1], []), [])
+        self.assertEqual(Labelling.unlabel_messages(self.unicef, []), [])
+
+    def test_search_messages(self):
+        def create(backend_id, minutes, labels, **kwargs):
+            created_on = datetime(2016, 1, 1, 10, minutes, tzinfo=timezone.utc)
+            kwargs["is_handled"] = kwargs.get("is_handled", True)
+            return self.create_message(
+                self.unicef, backend_id, self.ann, "Hi", labels, created_on=created_on, **kwargs
+            )
+
+        msg1 = create(101, 1, [self.aids])
+        msg2 = create(102, 2, [self.aids, self.pregnancy])
+        msg3 = create(103, 3, [self.pregnancy])
+        msg4 = create(104, 4, [self.aids], is_handled=False)
+        msg5 = create(105, 5, [self.pregnancy], is_archived=True)
+        msg6 = create(106, 6, [self.aids, self.pregnancy])
+
+        labels = [self.aids, self.pregnancy]
+
+        self.assertEqual(Labelling.search_messages([]), [])
+
+        # messages with several of the labels are only returned once, and unhandled messages are left out
+        self.assertEqual(Labelling.search_messages(labels), [msg6.id, msg5.id, msg3.id, msg2.id, msg1.id])
+        self.assertEqual(Labelling.search_messages([self.aids]), [msg6.id, msg2.id, msg1.id])
+
+        # filtering is only on labelling fields
+        self.assertEqual(
+            Labelling.search_messages(labels, message_is_archived=False), [msg6.id, msg3.id, msg2.id, msg1.id]
+        )
+
+        # a page reads no more than the limit of labellings for each label, then checks which messages are handled
+        with self.assertNumQueries(3):
+            self.assertEqual(Labelling.search_messages(labels, limit=2), [msg6.id, msg5.id])
+
+        # later pages read from the cursor, reading more if some of the labellings were for unhandled messages
+        with self.assertNumQueries(6):
+            self.assertEqual(
+                Labelling.search_messages(labels, cursor=(msg5.created_on, msg5.id), limit=2), [msg3.id, msg2.id]
+            )
+
+        self.assertEqual(Labelling.search_messages(labels, cursor=(msg2.created_on, msg2.id), limit=2), [msg1.id])
+        self.assertEqual(Labelling.search_messages(labels, cursor=(msg1.created_on, msg1.id), limit=2), [])
+        self.assertNotIn(msg4.id, Labelling.search_messages(labels, limit=10))
+
     @patch("casepro.test.TestBackend.unlabel_messages")
     def test_bulk_unlabel(self, mock_unlabel_messages):
         self.create_test_messages()
@@ -1230,7 +1417,10 @@ class MessageTest(BaseCasesTest):
         # try with synced label
         Message.bulk_unlabel(self.unicef, self.user1, [self.msg1, self.msg2], self.aids)
 
-        mock_unlabel_messages.assert_called_once_with(self.unicef, [self.msg1, self.msg2], self.aids)
+        BackendOp.push(self.unicef)
+
+        # msg2 didn't have the label so only msg1 needs unlabelling in the backend
+        mock_unlabel_messages.assert_called_once_with(self.unicef, [self.msg1], self.aids)
 
         self.assertEqual(self.aids.messages.count(), 0)
 
@@ -1240,6 +1430,8 @@ class MessageTest(BaseCasesTest):
 
         Message.bulk_archive(self.unicef, self.user1, [self.msg1, self.msg2])
 
+        BackendOp.push(self.unicef)
+
         mock_archive_messages.assert_called_once_with(self.unicef, [self.msg1, self.msg2])
 
         action = MessageAction.objects.get()
@@ -1255,7 +1447,10 @@ class MessageTest(BaseCasesTest):
 
         Message.bulk_restore(self.unicef, self.user1, [self.msg2, self.msg3])
 
-        mock_restore_messages.assert_called_once_with(self.unicef, [self.msg2, self.msg3])
+        BackendOp.push(self.unicef)
+
+        # only the message which was actually archived needs restoring in the backend
+        mock_restore_messages.assert_called_once_with(self.unicef, [self.msg3])
 
         action = MessageAction.objects.get()
         self.assertEqual(action.action, MessageAction.RESTORE)
@@ -1395,38 +1590,40 @@ class MessageCRUDLTest(BaseCasesTest):
     def test_search_paging(self):
         url = reverse("msgs.message_search")
 
-        # log in as a non-administrator
-        self.login(self.user1)
-
         for m in range(101):
             self.create_message(self.unicef, 101 + m, self.bob, f"Message #{m}", [self.aids], is_handled=True)
 
-        # request first page of inbox (i.e. labelled) messages
-        t0 = now()
-        response = self.url_get(
-            "unicef", url, {"folder": "inbox", "text": "", "page": 1, "after": "", "before": format_iso8601(t0)}
-        )
-        self.assertEqual(len(response.json["results"]), 50)
-        self.assertEqual(response.json["results"][0]["id"], 201)
-        self.assertEqual(response.json["results"][49]["id"], 152)
-        self.assertTrue(response.json["has_more"])
-
-        # and second page...
-        response = self.url_get(
-            "unicef", url, {"folder": "inbox", "text": "", "page": 2, "after": "", "before": format_iso8601(t0)}
-        )
-        self.assertEqual(len(response.json["results"]), 50)
-        self.assertEqual(response.json["results"][0]["id"], 151)
-        self.assertEqual(response.json["results"][49]["id"], 102)
-        self.assertTrue(response.json["has_more"])
-
-        # and last page...
-        response = self.url_get(
-            "unicef", url, {"folder": "inbox", "text": "", "page": 3, "after": "", "before": format_iso8601(t0)}
-        )
-        self.assertEqual(len(response.json["results"]), 1)
-        self.assertEqual(response.json["results"][0]["id"], 101)
-        self.assertFalse(response.json["has_more"])
+        def get_pages(user):
+            self.login(user)
+
+            t0 = now()
+            pages = []
+            cursor = None
+            while True:
+                params = {"folder": "inbox", "text": "", "after": "", "before": format_iso8601(t0)}
+                if cursor:
+                    params["cursor"] = cursor
+                response = self.url_get("unicef", url, params)
+                pages.append([m["id"] for m in response.json["results"]])
+                cursor = response.json["next_cursor"]
+
+                self.assertEqual(response.json["has_more"], cursor is not None)
+                if not cursor:
+                    return pages
+
+        # a restricted partner reads a page of labellings per label at a time
+        pages = get_pages(self.user1)
+        self.assertEqual([len(p) for p in pages], [50, 50, 1])
+        self.assertEqual((pages[0][0], pages[0][49]), (201, 152))
+        self.assertEqual((pages[1][0], pages[1][49]), (151, 102))
+        self.assertEqual(pages[2], [101])
+
+        # an admin pages through the folder index
+        self.assertEqual(get_pages(self.admin), pages)
+
+        # a tampered or stale cursor is a bad request rather than a server error
+        response = self.url_get("unicef", url, {"folder": "inbox", "cursor": "xyz"})
+        self.assertEqual(response.status_code, 400)
 
     def test_get_lock(self):
         msg = self.create_message(self.unicef, 101, self.ann, "Normal", [self.aids, self.pregnancy])
@@ -1508,36 +1705,48 @@ class MessageCRUDLTest(BaseCasesTest):
         response = self.url_post_json("unicef", get_url("flag"), {"messages": [102, 103]})
 
         self.assertEqual(response.status_code, 204)
+
+        BackendOp.push(self.unicef)
         mock_flag_messages.assert_called_once_with(self.unicef, [msg2, msg3])
         self.assertEqual(Message.objects.filter(is_flagged=True).count(), 2)
 
         response = self.url_post_json("unicef", get_url("unflag"), {"messages": [102]})
 
         self.assertEqual(response.status_code, 204)
+
+        BackendOp.push(self.unicef)
         mock_unflag_messages.assert_called_once_with(self.unicef, [msg2])
         self.assertEqual(Message.objects.filter(is_flagged=True).count(), 1)
 
         response = self.url_post_json("unicef", get_url("archive"), {"messages": [102]})
 
         self.assertEqual(response.status_code, 204)
+
+        BackendOp.push(self.unicef)
         mock_archive_messages.assert_called_once_with(self.unicef, [msg2])
         self.assertEqual(Message.objects.filter(is_archived=True).count(), 2)
 
         response = self.url_post_json("unicef", get_url("restore"), {"messages": [103]})
 
         self.assertEqual(response.status_code, 204)
+
+        BackendOp.push(self.unicef)
         mock_restore_messages.assert_called_once_with(self.unicef, [msg3])
         self.assertEqual(Message.objects.filter(is_archived=True).count(), 1)
 
         response = self.url_post_json("unicef", get_url("label"), {"messages": [103], "label": self.aids.pk})
 
         self.assertEqual(response.status_code, 204)
+
+        BackendOp.push(self.unicef)
         mock_label_messages.assert_called_once_with(self.unicef, [msg3], self.aids)
         self.assertEqual(Message.objects.filter(labels=self.aids).count(), 2)
 
         response = self.url_post_json("unicef", get_url("unlabel"), {"messages": [103], "label": self.aids.pk})
 
         self.assertEqual(response.status_code, 204)
+
+        BackendOp.push(self.unicef)
         mock_unlabel_messages.assert_called_once_with(self.unicef, [msg3], self.aids)
         self.assertEqual(Message.objects.filter(labels=self.aids).count(), 1)
 
@@ -1554,6 +1763,8 @@ class MessageCRUDLTest(BaseCasesTest):
         response = self.url_post_json("unicef", url, {"labels": [self.pregnancy.pk]})
         self.assertEqual(response.status_code, 204)
 
+        BackendOp.push(self.unicef)
+
         mock_label_messages.assert_called_once_with(self.unicef, [msg1], self.pregnancy)
         mock_unlabel_messages.assert_called_once_with(self.unicef, [msg1], self.aids)
 
@@ -1635,6 +1846,171 @@ class MessageCRUDLTest(BaseCasesTest):
         self.assertEqual(response.json["actions"][1]["created_by"]["id"], self.user1.pk)
 
 
+class BackendOpTest(BaseCasesTest):
+    def setUp(self):
+        super(BackendOpTest, self).setUp()
+
+        self.ann = self.create_contact(self.unicef, "C-001", "Ann")
+        self.msg1 = self.create_message(self.unicef, 101, self.ann, "Hello")
+        self.msg2 = self.create_message(self.unicef, 102, self.ann, "Hi")
+        self.msg3 = self.create_message(self.unicef, 103, self.ann, "Bonjour")
+
+    @patch("casepro.test.TestBackend.flag_messages")
+    @patch("casepro.test.TestBackend.unflag_messages")
+    @patch("casepro.test.TestBackend.label_messages")
+    @patch("casepro.test.TestBackend.unlabel_messages")
+    def test_push(self, mock_unlabel_messages, mock_label_messages, mock_unflag_messages, mock_flag_messages):
+        # msg1 is flagged, unflagged and flagged again, msg2 is flagged and unflagged, msg3 is flagged twice
+        BackendOp.queue(self.unicef, MessageAction.FLAG, [self.msg1, self.msg2, self.msg3])
+        BackendOp.queue(self.unicef, MessageAction.UNFLAG, [self.msg1, self.msg2])
+        BackendOp.queue(self.unicef, MessageAction.FLAG, [self.msg1, self.msg3])
+
+        # msg1 is labelled with two labels, msg2 is labelled and unlabelled
+        BackendOp.queue(self.unicef, MessageAction.LABEL, [self.msg1, self.msg2], self.aids)
+        BackendOp.queue(self.unicef, MessageAction.LABEL, [self.msg1], self.pregnancy)
+        BackendOp.queue(self.unicef, MessageAction.UNLABEL, [self.msg2], self.aids)
+
+        # ops for other orgs are left alone
+        nic = self.create_contact(self.nyaruka, "C-101", "Nic")
+        msg4 = self.create_message(self.nyaruka, 201, nic, "Hola")
+        BackendOp.queue(self.nyaruka, MessageAction.FLAG, [msg4])
+
+        self.assertEqual(BackendOp.get_backlog(self.unicef), 11)
+
+        self.assertEqual(BackendOp.push(self.unicef), (7, 4, 0))
+
+        mock_flag_messages.assert_called_once_with(self.unicef, [self.msg1, self.msg3])
+        mock_label_messages.assert_has_calls(
+            [call(self.unicef, [self.msg1], self.aids), call(self.unicef, [self.msg1], self.pregnancy)], any_order=True
+        )
+        self.assertNotCalled(mock_unflag_messages)
+        self.assertNotCalled(mock_unlabel_messages)
+
+        self.assertEqual(BackendOp.get_backlog(self.unicef), 0)
+        self.assertEqual(BackendOp.get_backlog(self.nyaruka), 1)
+
+        # nothing left to push
+        self.assertEqual(BackendOp.push(self.unicef), (0, 0, 0))
+
+    @patch("casepro.test.TestBackend.archive_messages")
+    def test_push_in_batches(self, mock_archive_messages):
+        BackendOp.queue(self.unicef, MessageAction.ARCHIVE, [self.msg1, self.msg2, self.msg3])
+
+        with patch.object(BackendOp, "BATCH_SIZE", 2):
+            self.assertEqual(BackendOp.push(self.unicef), (3, 0, 0))
+
+        mock_archive_messages.assert_has_calls(
+            [call(self.unicef, [self.msg1, self.msg2]), call(self.unicef, [self.msg3])]
+        )
+
+    @patch("casepro.test.TestBackend.flag_messages")
+    @patch("casepro.test.TestBackend.unflag_messages")
+    @patch("casepro.test.TestBackend.archive_messages")
+    @patch("casepro.test.TestBackend.restore_messages")
+    def test_push_reading_in_batches(
+        self, mock_restore_messages, mock_archive_messages, mock_unflag_messages, mock_flag_messages
+    ):
+        mock_restore_messages.side_effect = ValueError("DOH")
+
+        BackendOp.queue(self.unicef, MessageAction.FLAG, [self.msg1, self.msg2, self.msg3])
+        BackendOp.queue(self.unicef, MessageAction.UNFLAG, [self.msg1])
+        BackendOp.queue(self.unicef, MessageAction.RESTORE, [self.msg2, self.msg3])
+        BackendOp.queue(self.unicef, MessageAction.ARCHIVE, [self.msg3])
+
+        # chains which span batches are pushed in order, and those which fail hold back their later ops
+        with patch.object(BackendOp, "READ_BATCH_SIZE", 2):
+            self.assertEqual(BackendOp.push(self.unicef), (4, 0, 2))
+
+        mock_flag_messages.assert_has_calls(
+            [call(self.unicef, [self.msg1, self.msg2]), call(self.unicef, [self.msg3])]
+        )
+        mock_unflag_messages.assert_called_once_with(self.unicef, [self.msg1])
+        self.assertNotCalled(mock_archive_messages)
+
+        self.assertEqual(BackendOp.get_backlog(self.unicef), 3)
+
+    @patch("casepro.test.TestBackend.restore_messages")
+    def test_push_with_errors(self, mock_restore_messages):
+        mock_restore_messages.side_effect = ValueError("DOH")
+
+        BackendOp.queue(self.unicef, MessageAction.RESTORE, [self.msg1, self.msg2])
+
+        self.assertEqual(BackendOp.push(self.unicef), (0, 0, 2))
+
+        # ops are kept and retried after a backoff
+        op1, op2 = BackendOp.objects.order_by("id")
+        self.assertEqual(op1.attempts, 1)
+        self.assertGreater(op1.retry_on, timezone.now() + timedelta(seconds=25))
+
+        # so aren't pushed again straight away
+        self.assertEqual(BackendOp.push(self.unicef), (0, 0, 0))
+        self.assertEqual(mock_restore_messages.call_count, 1)
+
+        # ...but are once they're due
+        BackendOp.objects.update(retry_on=timezone.now())
+
+        self.assertEqual(BackendOp.push(self.unicef), (0, 0, 2))
+
+        op1, op2 = BackendOp.objects.order_by("id")
+        self.assertEqual(op1.attempts, 2)
+        self.assertGreater(op1.retry_on, timezone.now() + timedelta(seconds=55))
+
+        # a new op on the same message has to wait for the ops ahead of it
+        BackendOp.queue(self.unicef, MessageAction.ARCHIVE, [self.msg1])
+
+        self.assertEqual(BackendOp.push(self.unicef), (0, 0, 0))
+        self.assertEqual(BackendOp.get_backlog(self.unicef), 3)
+
+        # failing ops are eventually dropped, and the restore and archive of msg1 cancel each other out
+        BackendOp.objects.update(attempts=BackendOp.MAX_ATTEMPTS - 1, retry_on=timezone.now())
+
+        self.assertEqual(BackendOp.push(self.unicef), (0, 2, 1))
+        self.assertEqual(BackendOp.get_backlog(self.unicef), 0)
+
+    @patch("casepro.test.TestBackend.restore_messages")
+    def test_push_with_errors_and_different_attempts(self, mock_restore_messages):
+        mock_restore_messages.side_effect = ValueError("DOH")
+
+        BackendOp.queue(self.unicef, MessageAction.RESTORE, [self.msg1, self.msg2, self.msg3])
+        BackendOp.objects.filter(message=self.msg2).update(attempts=3)
+        BackendOp.objects.filter(message=self.msg3).update(attempts=BackendOp.MAX_ATTEMPTS - 1)
+
+        # ops which fail together are still retried and given up on according to their own attempts
+        self.assertEqual(BackendOp.push(self.unicef), (0, 0, 3))
+        mock_restore_messages.assert_called_once_with(self.unicef, [self.msg1, self.msg2, self.msg3])
+
+        op1, op2 = BackendOp.objects.order_by("id")
+        self.assertEqual((op1.message, op1.attempts), (self.msg1, 1))
+        self.assertEqual((op2.message, op2.attempts), (self.msg2, 4))
+        self.assertGreater(op2.retry_on, op1.retry_on + timedelta(seconds=150))
+
+    @patch("casepro.test.TestBackend.flag_messages")
+    @patch("casepro.test.TestBackend.unflag_messages")
+    @patch("casepro.test.TestBackend.label_messages")
+    @patch("casepro.test.TestBackend.unlabel_messages")
+    def test_push_after_changes_which_change_nothing(
+        self, mock_unlabel_messages, mock_label_messages, mock_unflag_messages, mock_flag_messages
+    ):
+        self.msg1.label(self.aids)
+        Message.objects.filter(pk=self.msg1.pk).update(is_flagged=True)
+
+        # labelling and flagging a message which is already labelled and flagged changes nothing, so isn't queued
+        Message.bulk_label(self.unicef, self.admin, [self.msg1], self.aids)
+        Message.bulk_flag(self.unicef, self.admin, [self.msg1])
+        self.assertEqual(BackendOp.get_backlog(self.unicef), 0)
+
+        # so undoing them afterwards isn't cancelled out and is pushed
+        Message.bulk_unlabel(self.unicef, self.admin, [self.msg1], self.aids)
+        Message.bulk_unflag(self.unicef, self.admin, [self.msg1])
+
+        self.assertEqual(BackendOp.push(self.unicef), (2, 0, 0))
+
+        mock_unlabel_messages.assert_called_once_with(self.unicef, [self.msg1], self.aids)
+        mock_unflag_messages.assert_called_once_with(self.unicef, [self.msg1])
+        self.assertNotCalled(mock_label_messages)
+        self.assertNotCalled(mock_flag_messages)
+
+
 class MessageExportCRUDLTest(BaseCasesTest):
     @override_settings(CELERY_TASK_ALWAYS_EAGER=True, CELERY_TASK_EAGER_PROPAGATES=True)
     def test_create_and_read(self):
@@ -1770,6 +2146,38 @@ class OutgoingTest(BaseCasesTest):
         self.assertEqual(out.case, case)
         self.assertEqual(out.created_by, self.user1)
 
+        # the reply is recorded on the case
+        case.refresh_from_db()
+        self.assertEqual(case.first_reply_on, out.created_on)
+        self.assertEqual(case.assignee_replied_on, out.created_on)
+
+        # and counted as the first reply on the case and the first reply by its assignee
+        self.assertEqual(DailySecondTotalCount.get_by_org([self.unicef], "A").total(), 1)
+        self.assertEqual(DailySecondTotalCount.get_by_partner([self.moh], "A").total(), 1)
+
+        Outgoing.create_case_reply(self.unicef, self.user1, "Still here", case)
+
+        case.refresh_from_db()
+        self.assertEqual(case.first_reply_on, out.created_on)
+        self.assertEqual(DailySecondTotalCount.get_by_org([self.unicef], "A").total(), 1)
+        self.assertEqual(DailySecondTotalCount.get_by_partner([self.moh], "A").total(), 1)
+
+        # but saving an outgoing message by itself doesn't touch its case
+        case2 = self.create_case(
+            self.unicef, self.bob, self.moh, self.create_message(self.unicef, 102, self.bob, "Hi")
+        )
+        Outgoing.objects.create(
+            org=self.unicef,
+            activity=Outgoing.CASE_REPLY,
+            text="Hi",
+            contact=self.bob,
+            case=case2,
+            created_by=self.user1,
+        )
+
+        case2.refresh_from_db()
+        self.assertIsNone(case2.first_reply_on)
+
     @patch("casepro.test.TestBackend.push_outgoing")
     def test_create_forwards(self, mock_push_outgoing):
         self.create_message(self.unicef, 101, self.ann, "Hello")
@@ -1812,6 +2220,13 @@ class OutgoingTest(BaseCasesTest):
         # by text
         assert_search(self.admin, {"folder": OutgoingFolder.sent, "text": "LO 5"}, [out5])
 
+        with override_settings(SEARCH_BY_TEXT_DAYS=90):
+            assert_search(self.admin, {"folder": OutgoingFolder.sent, "text": "LO 5"}, [out5])
+
+            out5.created_on = now() - relativedelta(days=91)
+            out5.save(update_fields=("created_on",))
+            assert_search(self.admin, {"folder": OutgoingFolder.sent, "text": "LO 5"}, [])
+
         # by contact
         assert_search(self.admin, {"folder": OutgoingFolder.sent, "contact": self.ann.pk}, [out2, out1])
 
@@ -1923,6 +2338,29 @@ class OutgoingCRUDLTest(BaseCasesTest):
                 }
             ],
         )
+        self.assertFalse(response.json["has_more"])
+        self.assertIsNone(response.json["next_cursor"])
+
+        # results are paged with cursors, with messages sent at the same time ordered by id
+        t1 = now()
+        bulk = [
+            self.create_outgoing(self.unicef, self.admin, 301 + o, "B", "Bulk", self.ann, created_on=t1)
+            for o in range(50)
+        ]
+
+        self.login(self.admin)
+
+        response = self.url_get("unicef", url, {"folder": "sent"})
+        self.assertEqual([m["id"] for m in response.json["results"]], [o.pk for o in reversed(bulk)])
+        self.assertTrue(response.json["has_more"])
+
+        response = self.url_get("unicef", url, {"folder": "sent", "cursor": response.json["next_cursor"]})
+        self.assertEqual([m["id"] for m in response.json["results"]], [out2.pk, out1.pk])
+        self.assertFalse(response.json["has_more"])
+        self.assertIsNone(response.json["next_cursor"])
+
+        response = self.url_get("unicef", url, {"folder": "sent", "cursor": "xyz"})
+        self.assertEqual(response.status_code, 400)
 
     def test_search_replies(self):
         url = reverse("msgs.outgoing_search_replies")
@@ -1977,6 +2415,9 @@ class OutgoingCRUDLTest(BaseCasesTest):
             ],
         )
 
+        response = self.url_get("unicef", url, {"cursor": "xyz"})
+        self.assertEqual(response.status_code, 400)
+
 
 class ReplyExportCRUDLTest(BaseCasesTest):
     @override_settings(CELERY_TASK_ALWAYS_EAGER=True, CELERY_TASK_EAGER_PROPAGATES=True)
@@ -2254,8 +2695,10 @@ class TasksTest(BaseCasesTest):
         self.assertEqual(set(msg2.labels.all()), {self.aids})
         self.assertEqual(set(msg3.labels.all()), {self.pregnancy})
 
+        BackendOp.push(self.unicef)
+
         mock_label_messages.assert_has_calls(
-            [call(self.unicef, {msg1, msg2}, self.aids), call(self.unicef, {msg3}, self.pregnancy)], any_order=True
+            [call(self.unicef, [msg1, msg2], self.aids), call(self.unicef, [msg3], self.pregnancy)], any_order=True
         )
 
         # check msg 5 was added to the case and archived
@@ -2279,6 +2722,66 @@ class TasksTest(BaseCasesTest):
             {"handled": 0, "case_replies": 0, "rules_matched": 0, "ignored_with_ticket": 0},
         )
 
+    @patch("casepro.msgs.tasks.HANDLE_BATCH_SIZE", 2)
+    @patch("casepro.test.TestBackend.label_messages")
+    def test_handle_messages_in_batches(self, mock_label_messages):
+        ann = self.create_contact(self.unicef, "C-001", "Ann")
+        fra = self.create_contact(self.unicef, "C-002", "Fra", is_stub=True)
+
+        msg1 = self.create_message(self.unicef, 101, ann, "What is aids?")
+        msg2 = self.create_message(self.unicef, 102, fra, "HIV")
+        msg3 = self.create_message(self.unicef, 103, ann, "Can I catch Hiv?")
+        msg4 = self.create_message(self.unicef, 104, ann, "I think I'm pregnant")
+        msg5 = self.create_message(self.unicef, 105, ann, "Hello")
+
+        # first run runs out of time after the first batch
+        with patch("casepro.msgs.tasks.HANDLE_TASK_MAX_SECONDS", -1):
+            handle_messages(self.unicef.pk)
+
+        self.assertEqual(set(Message.objects.filter(is_handled=True)), {msg1, msg3})
+        self.assertEqual(set(msg1.labels.all()), {self.aids})
+        self.assertEqual(set(msg3.labels.all()), {self.aids})
+
+        task_state = self.unicef.get_task_state("message-handle")
+        self.assertEqual(
+            task_state.get_last_results(),
+            {
+                "handled": 2,
+                "case_replies": 0,
+                "rules_matched": 2,
+                "ignored_with_ticket": 0,
+                "resume": {"after_id": msg3.id},
+            },
+        )
+
+        # next run picks up the remaining messages
+        handle_messages(self.unicef.pk)
+
+        self.assertEqual(set(Message.objects.filter(is_handled=True)), {msg1, msg3, msg4, msg5})
+        self.assertEqual(set(Message.objects.filter(is_handled=False)), {msg2})  # stub contact
+        self.assertEqual(set(msg4.labels.all()), {self.pregnancy})
+
+        task_state = self.unicef.get_task_state("message-handle")
+        self.assertEqual(
+            task_state.get_last_results(),
+            {"handled": 2, "case_replies": 0, "rules_matched": 1, "ignored_with_ticket": 0},
+        )
+
+    @patch("casepro.test.TestBackend.flag_messages")
+    def test_push_backend_ops(self, mock_flag_messages):
+        ann = self.create_contact(self.unicef, "C-001", "Ann")
+        msg1 = self.create_message(self.unicef, 101, ann, "Hello")
+        msg2 = self.create_message(self.unicef, 102, ann, "Hi")
+
+        BackendOp.queue(self.unicef, MessageAction.FLAG, [msg1, msg2])
+
+        push_backend_ops(self.unicef.pk)
+
+        mock_flag_messages.assert_called_once_with(self.unicef, [msg1, msg2])
+
+        task_state = TaskState.objects.get(org=self.unicef, task_key="backend-push")
+        self.assertEqual(task_state.get_last_results(), {"pushed": 2, "cancelled": 0, "failed": 0, "backlog": 0})
+
     def test_trim_old_messages(self):
         ann = self.create_contact(self.unicef, "C-001", "Ann")
         nic = self.create_contact(self.nyaruka, "C-002", "Nic")
@@ -3,7 +3,6 @@ from collections import defaultdict
 
 import iso639
 from dash.orgs.views import OrgObjPermsMixin, OrgPermsMixin
-from el_pagination.paginators import LazyPaginator
 from smartmin.csv_imports.models import ImportTask
 from smartmin.mixins import NonAtomicMixin
 from smartmin.views import (
@@ -28,8 +27,9 @@ from django.utils.translation import gettext_lazy as _
 
 from casepro.rules.mixins import RuleFormMixin
 from casepro.statistics.models import DailyCount
-from casepro.utils import JSONEncoder, month_range, str_to_bool
+from casepro.utils import JSONEncoder, cursor_page, month_range, str_to_bool
 from casepro.utils.export import BaseDownloadView
+from casepro.utils.views import CursorPagingMixin
 
 from .forms import FaqForm, LabelForm
 from .models import FAQ, Label, Message, MessageExport, MessageFolder, Outgoing, OutgoingFolder, ReplyExport
@@ -204,23 +204,25 @@ class MessageCRUDL(SmartCRUDL):
     actions = ("search", "lock", "action", "label", "bulk_reply", "forward", "history")
     model = Message
 
-    class Search(OrgPermsMixin, MessageSearchMixin, SmartTemplateView):
+    class Search(CursorPagingMixin, OrgPermsMixin, MessageSearchMixin, SmartTemplateView):
         """
         JSON endpoint for fetching incoming messages
         """
 
         page_size = 50
 
-        def get_messages(self, search, last_refresh=None):
+        def get_messages(self, search, last_refresh=None, cursor=None, limit=None):
             org = self.request.org
             user = self.request.user
-            queryset = Message.search(org, user, search, modified_after=last_refresh, all=False)
+            queryset = Message.search(
+                org, user, search, modified_after=last_refresh, all=False, cursor=cursor, limit=limit
+            )
             return queryset.prefetch_related("contact", "labels", "case__assignee", "case__user_assignee")
 
         def get_context_data(self, **kwargs):
             context = super(MessageCRUDL.Search, self).get_context_data(**kwargs)
 
-            page = int(self.request.GET.get("page", 1))
+            cursor = self.cursor
             last_refresh = self.request.GET.get("last_refresh")
 
             search = self.derive_search()
@@ -232,12 +234,13 @@ class MessageCRUDL(SmartCRUDL):
                 # don't use paging for these messages
                 context["object_list"] = list(messages)
                 context["has_more"] = False
+                context["next_cursor"] = None
             else:
-                messages = self.get_messages(search)
-                paginator = LazyPaginator(messages, per_page=self.page_size)
+                messages = self.get_messages(search, cursor=cursor, limit=self.page_size + 1)
 
-                context["object_list"] = paginator.page(page)
-                context["has_more"] = paginator.num_pages > page
+                context["object_list"], context["has_more"], context["next_cursor"] = cursor_page(
+                    messages, self.page_size, "created_on"
+                )
 
             return context
 
@@ -250,7 +253,10 @@ class MessageCRUDL(SmartCRUDL):
 
                 results.append(msg)
 
-            return JsonResponse({"results": results, "has_more": context["has_more"]}, encoder=JSONEncoder)
+            return JsonResponse(
+                {"results": results, "has_more": context["has_more"], "next_cursor": context["next_cursor"]},
+                encoder=JSONEncoder,
+            )
 
     class Lock(OrgPermsMixin, SmartTemplateView):
         """
@@ -451,7 +457,7 @@ class OutgoingCRUDL(SmartCRUDL):
     actions = ("search", "search_replies")
     model = Outgoing
 
-    class Search(OrgPermsMixin, SmartTemplateView):
+    class Search(CursorPagingMixin, OrgPermsMixin, SmartTemplateView):
         """
         JSON endpoint for fetching outgoing messages
         """
@@ -468,23 +474,27 @@ class OutgoingCRUDL(SmartCRUDL):
 
             org = self.request.org
             user = self.request.user
-            page = int(self.request.GET.get("page", 1))
+            cursor = self.cursor
 
             search = self.derive_search()
-            messages = Outgoing.search(org, user, search)
-            paginator = LazyPaginator(messages, per_page=50)
+            messages = Outgoing.search(org, user, search, cursor=cursor)
 
-            context["object_list"] = paginator.page(page)
-            context["has_more"] = paginator.num_pages > page
+            context["object_list"], context["has_more"], context["next_cursor"] = cursor_page(
+                messages, 50, "created_on"
+            )
             return context
 
         def render_to_response(self, context, **response_kwargs):
             return JsonResponse(
-                {"results": [m.as_json() for m in context["object_list"]], "has_more": context["has_more"]},
+                {
+                    "results": [m.as_json() for m in context["object_list"]],
+                    "has_more": context["has_more"],
+                    "next_cursor": context["next_cursor"],
+                },
                 encoder=JSONEncoder,
             )
 
-    class SearchReplies(OrgPermsMixin, ReplySearchMixin, SmartTemplateView):
+    class SearchReplies(CursorPagingMixin, OrgPermsMixin, ReplySearchMixin, SmartTemplateView):
         """
         JSON endpoint to fetch replies made by users
         """
@@ -492,14 +502,12 @@ class OutgoingCRUDL(SmartCRUDL):
         def get(self, request, *args, **kwargs):
             org = self.request.org
             user = self.request.user
-            page = int(self.request.GET.get("page", 1))
+            cursor = self.cursor
 
             search = self.derive_search()
-            items = Outgoing.search_replies(org, user, search).exclude(reply_to=None)
+            items = Outgoing.search_replies(org, user, search, cursor=cursor).exclude(reply_to=None)
 
-            paginator = LazyPaginator(items, 50)
-            outgoing = paginator.page(page)
-            has_more = paginator.num_pages > page
+            outgoing, has_more, next_cursor = cursor_page(items, 50, "created_on")
 
             def as_json(msg):
                 delay = (msg.created_on - msg.reply_to.created_on).total_seconds()
@@ -519,7 +527,10 @@ class OutgoingCRUDL(SmartCRUDL):
                 )
                 return obj
 
-            return JsonResponse({"results": [as_json(o) for o in outgoing], "has_more": has_more}, encoder=JSONEncoder)
+            return JsonResponse(
+                {"results": [as_json(o) for o in outgoing], "has_more": has_more, "next_cursor": next_cursor},
+                encoder=JSONEncoder,
+            )
 
 
 class ReplyExportCRUDL(SmartCRUDL):
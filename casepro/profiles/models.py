@@ -122,6 +122,30 @@ class Notification(models.Model):
     def new_message_labelling(cls, org, user, message):
         return cls.objects.get_or_create(org=org, user=user, type=cls.TYPE_MESSAGE_LABELLING, message=message)
 
+    @classmethod
+    def new_message_labellings(cls, org, users, messages):
+        """
+        Bulk version of new_message_labelling which creates notifications for each user and message, skipping any
+        which already exist
+        """
+        users = list(users)
+        if not users or not messages:
+            return
+
+        existing = cls.objects.filter(
+            org=org, type=cls.TYPE_MESSAGE_LABELLING, user__in=users, message__in=messages
+        ).values_list("user_id", "message_id")
+        existing = set(existing)
+
+        cls.objects.bulk_create(
+            [
+                cls(org=org, user=user, type=cls.TYPE_MESSAGE_LABELLING, message=message)
+                for user in users
+                for message in messages
+                if (user.id, message.id) not in existing
+            ]
+        )
+
     @classmethod
     def new_case_assignment(cls, org, user, case_action):
         return cls.objects.get_or_create(org=org, user=user, type=cls.TYPE_CASE_ASSIGNMENT, case_action=case_action)
@@ -10,7 +10,7 @@ from django.utils.translation import gettext_lazy as _
 from casepro.cases.mixins import PartnerPermsMixin
 from casepro.cases.models import Partner
 from casepro.orgs_ext.mixins import OrgFormMixin
-from casepro.statistics.models import DailyCount, TotalCount
+from casepro.statistics.models import CountQuery, DailyCount, TotalCount
 from casepro.utils import month_range, str_to_bool
 
 from .forms import OrgUserForm, PartnerUserForm, UserForm
@@ -334,21 +334,16 @@ class UserCRUDL(SmartCRUDL):
 
             # get reply statistics
             if with_activity:
-                replies_total = TotalCount.get_by_user(org, users, DailyCount.TYPE_REPLIES).scope_totals()
-                replies_this_month = DailyCount.get_by_user(
-                    org, users, DailyCount.TYPE_REPLIES, *month_range(0)
-                ).scope_totals()
-                replies_last_month = DailyCount.get_by_user(
-                    org, users, DailyCount.TYPE_REPLIES, *month_range(-1)
-                ).scope_totals()
-
-                cases_total = TotalCount.get_by_user(org, users, DailyCount.TYPE_CASE_OPENED).scope_totals()
-                cases_opened_this_month = DailyCount.get_by_user(
-                    org, users, DailyCount.TYPE_CASE_OPENED, *month_range(0)
-                ).scope_totals()
-                cases_closed_this_month = DailyCount.get_by_user(
-                    org, users, DailyCount.TYPE_CASE_CLOSED, *month_range(0)
-                ).scope_totals()
+                stats = (
+                    CountQuery.for_users(org, users)
+                    .total("replies_total", TotalCount, DailyCount.TYPE_REPLIES)
+                    .total("replies_this_month", DailyCount, DailyCount.TYPE_REPLIES, *month_range(0))
+                    .total("replies_last_month", DailyCount, DailyCount.TYPE_REPLIES, *month_range(-1))
+                    .total("cases_total", TotalCount, DailyCount.TYPE_CASE_OPENED)
+                    .total("cases_opened_this_month", DailyCount, DailyCount.TYPE_CASE_OPENED, *month_range(0))
+                    .total("cases_closed_this_month", DailyCount, DailyCount.TYPE_CASE_CLOSED, *month_range(0))
+                    .fetch()
+                )
 
             def as_json(user):
                 obj = user.as_json(full=True, org=org)
@@ -356,14 +351,14 @@ class UserCRUDL(SmartCRUDL):
                     obj.update(
                         {
                             "replies": {
-                                "this_month": replies_this_month.get(user, 0),
-                                "last_month": replies_last_month.get(user, 0),
-                                "total": replies_total.get(user, 0),
+                                "this_month": stats["replies_this_month"].get(user, 0),
+                                "last_month": stats["replies_last_month"].get(user, 0),
+                                "total": stats["replies_total"].get(user, 0),
                             },
                             "cases": {
-                                "opened_this_month": cases_opened_this_month.get(user, 0),
-                                "closed_this_month": cases_closed_this_month.get(user, 0),
-                                "total": cases_total.get(user, 0),
+                                "opened_this_month": stats["cases_opened_this_month"].get(user, 0),
+                                "closed_this_month": stats["cases_closed_this_month"].get(user, 0),
+                                "total": stats["cases_total"].get(user, 0),
                             },
                         }
                     )
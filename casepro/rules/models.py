@@ -2,22 +2,26 @@ import json
 from abc import ABCMeta, abstractmethod
 from collections import defaultdict
 from enum import Enum
+from uuid import uuid4
 
 import regex
-from celery.utils.log import get_task_logger
 from dash.orgs.models import Org
 from dash.utils import get_obj_cacheable
+from django_redis import get_redis_connection
 
 from django.db import models
 from django.utils.translation import gettext_lazy as _
 
 from casepro.contacts.models import Group
-from casepro.msgs.models import Label, Message
+from casepro.msgs.models import BackendOp, Label, Labelling, Message, MessageAction
 from casepro.utils import json_encode, normalize
 
 KEYWORD_REGEX = regex.compile(r"^\w[\w\- ]*\w$", flags=regex.UNICODE | regex.V0)
+WORD_RUN_REGEX = regex.compile(r"\w+", flags=regex.UNICODE | regex.V0)
 
-logger = get_task_logger(__name__)
+RULES_VERSION_KEY = "org:%d:rules_version"
+
+COMPILED_RULES_BY_ORG = {}  # per-process cache of each org's compiled rules and the version they were compiled at
 
 
 class Quantifier(Enum):
@@ -61,6 +65,120 @@ class Quantifier(Enum):
         return str(self.text)
 
 
+class KeywordMatcher(object):
+    """
+    Finds which of a set of keywords occur as whole words in a text in a single pass. Valid keywords are compiled into a
+    character trie which is walked from the start of each word in the normalized text, so the cost of matching doesn't
+    grow with the number of keywords. Any invalid keywords are still searched for individually with a regex.
+    """
+
+    END = None  # trie key for the keyword which terminates at a node
+
+    def __init__(self, keywords):
+        self.trie = {}
+        self.irregular = []
+
+        for keyword in {normalize(k) for k in keywords}:
+            if ContainsTest.is_valid_keyword(keyword):
+                node = self.trie
+                for char in keyword:
+                    node = node.setdefault(char, {})
+                node[self.END] = keyword
+            else:
+                self.irregular.append(keyword)
+
+    @classmethod
+    def for_rules(cls, rules):
+        """
+        Creates a matcher for all the keywords used by contains tests in the given rules
+        """
+        keywords = []
+        for rule in rules:
+            for test in rule.get_tests():
+                if isinstance(test, ContainsTest):
+                    keywords += test.keywords
+        return cls(keywords)
+
+    def find_all(self, text):
+        """
+        Returns the set of keywords found in the given text
+        """
+        text = normalize(text)
+        found = set()
+
+        if self.trie:
+            runs = [m.span() for m in WORD_RUN_REGEX.finditer(text)]
+            run_ends = {end for start, end in runs}
+
+            for start, end in runs:
+                node = self.trie
+                for pos in range(start, len(text)):
+                    node = node.get(text[pos])
+                    if node is None:
+                        break
+
+                    keyword = node.get(self.END)
+                    if keyword is not None and (pos + 1) in run_ends:
+                        found.add(keyword)
+
+        for keyword in self.irregular:
+            if regex.search(r"\b" + keyword + r"\b", text, flags=regex.UNICODE | regex.V0):
+                found.add(keyword)
+
+        return found
+
+
+class RuleIndex(object):
+    """
+    A compiled set of rules. Rules are indexed by the keys (keywords, group ids or field values) of one of their tests
+    which a message must have for that test to match, so each message is only evaluated against the rules it could
+    possibly match. Rules with no such test (e.g. only NONE quantifiers or word counts) are candidates for every message.
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.keyword_matcher = KeywordMatcher.for_rules(self.rules)
+
+        # rules are indexed by their position in the list of rules
+        self.rules_by_key = defaultdict(set)
+        self.unindexed_rules = set()
+
+        for r, rule in enumerate(self.rules):
+            for test in rule.get_tests():
+                keys = test.get_index_keys()
+                if keys is not None:
+                    for key in keys:
+                        self.rules_by_key[key].add(r)
+                    break
+            else:
+                self.unindexed_rules.add(r)
+
+            rule.get_actions()  # ensure actions are deserialized too
+
+    @staticmethod
+    def get_message_keys(message, found_keywords):
+        """
+        Gets the keys of the given message which rules are indexed by
+        """
+        keys = [("keyword", k) for k in found_keywords]
+        keys += [("group", g.pk) for g in message.contact.groups.all()]
+
+        if message.contact.fields:
+            keys += [("field", k, normalize(v or "")) for k, v in message.contact.fields.items()]
+
+        return keys
+
+    def get_candidate_rules(self, message, found_keywords):
+        """
+        Gets the rules which could match the given message, in their original order
+        """
+        candidates = set(self.unindexed_rules)
+        for key in self.get_message_keys(message, found_keywords):
+            candidates.update(self.rules_by_key.get(key, ()))
+
+        return [self.rules[r] for r in sorted(candidates)]
+
+
 class DeserializationContext(object):
     """
     Context object passed to all test or action from_json methods
@@ -106,11 +224,19 @@ class Test(object):
         pass
 
     @abstractmethod
-    def matches(self, message):
+    def matches(self, message, found_keywords=None):
         """
-        Subclasses must implement this to return a boolean.
+        Subclasses must implement this to return a boolean. Callers evaluating many tests against the same message can
+        pass the set of keywords found in the message text by a KeywordMatcher to avoid searching the text again.
         """
 
+    def get_index_keys(self):
+        """
+        Gets the keys of which a message must have at least one for this test to match (see Rule.BatchProcessor), or
+        None if this test can match messages regardless of their keys.
+        """
+        return None
+
     def __eq__(self, other):  # pragma: no cover
         return other and self.TYPE == other.TYPE
 
@@ -140,16 +266,23 @@ class ContainsTest(Test):
         quoted_keywords = ['"%s"' % w for w in self.keywords]
         return "message contains %s %s" % (str(self.quantifier), ", ".join(quoted_keywords))
 
-    def matches(self, message):
-        text = normalize(message.text)
+    def matches(self, message, found_keywords=None):
+        if found_keywords is None:
+            found_keywords = KeywordMatcher(self.keywords).find_all(message.text)
 
         def keyword_check(w):
-            return lambda: bool(regex.search(r"\b" + w + r"\b", text, flags=regex.UNICODE | regex.V0))
+            return lambda: w in found_keywords
 
         checks = [keyword_check(keyword) for keyword in self.keywords]
 
         return self.quantifier.evaluate(checks)
 
+    def get_index_keys(self):
+        if self.quantifier == Quantifier.NONE or not self.keywords:
+            return None
+
+        return [("keyword", k) for k in self.keywords]
+
     @classmethod
     def is_valid_keyword(cls, keyword):
         return KEYWORD_REGEX.match(keyword)
@@ -183,7 +316,7 @@ class WordCountTest(Test):
     def get_description(self):
         return "message has at least %d words" % self.minimum
 
-    def matches(self, message):
+    def matches(self, message, found_keywords=None):
         num_words = len(regex.findall(r"\w+", message.text, flags=regex.UNICODE | regex.V0))
         return num_words >= self.minimum
 
@@ -214,7 +347,7 @@ class GroupsTest(Test):
         group_names = [g.name for g in self.groups]
         return "contact belongs to %s %s" % (str(self.quantifier), ", ".join(group_names))
 
-    def matches(self, message):
+    def matches(self, message, found_keywords=None):
         contact_groups = set(message.contact.groups.all())
 
         def group_check(g):
@@ -224,6 +357,12 @@ class GroupsTest(Test):
 
         return self.quantifier.evaluate(checks)
 
+    def get_index_keys(self):
+        if self.quantifier == Quantifier.NONE or not self.groups:
+            return None
+
+        return [("group", g.pk) for g in self.groups]
+
     def __eq__(self, other):
         return (
             other and self.TYPE == other.TYPE and self.groups == other.groups and self.quantifier == other.quantifier
@@ -252,7 +391,7 @@ class FieldTest(Test):
         quoted_values = ['"%s"' % v for v in self.values]
         return "contact.%s is %s %s" % (self.key, Quantifier.ANY, ", ".join(quoted_values))
 
-    def matches(self, message):
+    def matches(self, message, found_keywords=None):
         if message.contact.fields:
             contact_value = normalize(message.contact.fields.get(self.key, ""))
 
@@ -261,6 +400,12 @@ class FieldTest(Test):
                     return True
         return False
 
+    def get_index_keys(self):
+        if "" in self.values:  # contacts without this field would match
+            return None
+
+        return [("field", self.key, v) for v in self.values]
+
     def __eq__(self, other):
         return other and self.TYPE == other.TYPE and self.key == other.key and self.values == other.values
 
@@ -330,14 +475,10 @@ class LabelAction(Action):
         return "apply label '%s'" % self.label.name
 
     def apply_to(self, org, messages):
-        for msg in messages:
-            msg.label(self.label)
+        Labelling.label_messages(self.label, messages)
 
         if self.label.is_synced:
-            try:
-                org.get_backend().label_messages(org, messages, self.label)
-            except Exception as e:
-                logger.exception(e)
+            BackendOp.queue(org, MessageAction.LABEL, messages, self.label)
 
     def __eq__(self, other):
         return self.TYPE == other.TYPE and self.label == other.label
@@ -366,10 +507,7 @@ class FlagAction(Action):
     def apply_to(self, org, messages):
         Message.objects.filter(pk__in=[m.pk for m in messages]).update(is_flagged=True)
 
-        try:
-            org.get_backend().flag_messages(org, messages)
-        except Exception as e:
-            logger.exception(e)
+        BackendOp.queue(org, MessageAction.FLAG, messages)
 
 
 class ArchiveAction(Action):
@@ -392,10 +530,7 @@ class ArchiveAction(Action):
     def apply_to(self, org, messages):
         Message.objects.filter(pk__in=[m.pk for m in messages]).update(is_archived=True)
 
-        try:
-            org.get_backend().archive_messages(org, messages)
-        except Exception as e:
-            logger.exception(e)
+        BackendOp.queue(org, MessageAction.ARCHIVE, messages)
 
 
 class Rule(models.Model):
@@ -411,12 +546,43 @@ class Rule(models.Model):
 
     @classmethod
     def create(cls, org, tests, actions):
-        return cls.objects.create(org=org, tests=json_encode(tests), actions=json_encode(actions))
+        rule = cls.objects.create(org=org, tests=json_encode(tests), actions=json_encode(actions))
+        cls.bump_version(org.pk)
+        return rule
 
     @classmethod
     def get_all(cls, org):
         return org.rules.all()
 
+    @classmethod
+    def get_compiled(cls, org):
+        """
+        Gets all rules for the given org as a RuleIndex. This is cached per-process until the org's rules version
+        changes so that in the steady state, loading rules doesn't require any database queries.
+        """
+        version = cls.get_version(org)
+        cached = COMPILED_RULES_BY_ORG.get(org.pk)
+
+        if cached and cached[0] == version:
+            return cached[1]
+
+        compiled = RuleIndex(cls.get_all(org).order_by("pk"))
+        COMPILED_RULES_BY_ORG[org.pk] = (version, compiled)
+        return compiled
+
+    @classmethod
+    def get_version(cls, org):
+        version = get_redis_connection().get(RULES_VERSION_KEY % org.pk)
+        return version.decode() if version else None
+
+    @classmethod
+    def bump_version(cls, org_id):
+        """
+        Changes the rules version for the given org, invalidating any compiled rules. Should be called whenever a rule,
+        or a label or group used by a rule, is changed.
+        """
+        get_redis_connection().set(RULES_VERSION_KEY % org_id, uuid4().hex)
+
     def get_tests(self):
         return get_obj_cacheable(self, "_tests", lambda: self._get_tests())
 
@@ -435,12 +601,12 @@ class Rule(models.Model):
     def get_actions_description(self):
         return _(" and ").join([a.get_description() for a in self.get_actions()])
 
-    def matches(self, message):
+    def matches(self, message, found_keywords=None):
         """
         Returns whether this rule matches the given message, i.e. all of its tests match the message
         """
         for test in self.get_tests():
-            if not test.matches(message):
+            if not test.matches(message, found_keywords):
                 return False
         return True
 
@@ -451,8 +617,12 @@ class Rule(models.Model):
         """
 
         def __init__(self, org, rules):
+            """
+            :param org: the org
+            :param rules: the rules to apply, either as a list or an already compiled RuleIndex
+            """
             self.org = org
-            self.rules = rules
+            self.index = rules if isinstance(rules, RuleIndex) else RuleIndex(rules)
             self.messages_by_action = defaultdict(set)
 
         def include_messages(self, *messages):
@@ -465,8 +635,10 @@ class Rule(models.Model):
             num_actions_deferred = 0
 
             for message in messages:
-                for rule in self.rules:
-                    if rule.matches(message):
+                found_keywords = self.index.keyword_matcher.find_all(message.text)
+
+                for rule in self.index.get_candidate_rules(message, found_keywords):
+                    if rule.matches(message, found_keywords):
                         num_rules_matched += 1
                         for action in rule.get_actions():
                             self.messages_by_action[action].add(message)
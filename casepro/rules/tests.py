@@ -2,8 +2,9 @@ from unittest.mock import call, patch
 
 from django.urls import reverse
 
-from casepro.msgs.models import Message
+from casepro.msgs.models import BackendOp, Message
 from casepro.test import BaseCasesTest
+from casepro.utils import normalize
 
 from .models import (
     Action,
@@ -13,6 +14,7 @@ from .models import (
     FieldTest,
     FlagAction,
     GroupsTest,
+    KeywordMatcher,
     LabelAction,
     Quantifier,
     Rule,
@@ -120,6 +122,30 @@ class TestsTest(BaseCasesTest):
         self.assertTest(test, self.bob, "Yes", False)
         self.assertTest(test, self.cat, "Yes", False)
 
+    def test_keyword_matcher(self):
+        matcher = KeywordMatcher(["aids", "hiv", "hiv aids", "kit-kat", "tú", "x.y", "aids"])
+
+        self.assertEqual(matcher.find_all(""), set())
+        self.assertEqual(matcher.find_all("I like barmaids"), set())
+        self.assertEqual(matcher.find_all("What is AIDS?"), {"aids"})
+        self.assertEqual(matcher.find_all("HIV  AIDS"), {"hiv", "hiv aids", "aids"})
+        self.assertEqual(matcher.find_all("hiv-aids"), {"hiv", "aids"})
+        self.assertEqual(matcher.find_all("a kit-kat bar"), {"kit-kat"})
+        self.assertEqual(matcher.find_all("kit-katty"), set())
+        self.assertEqual(matcher.find_all("¿Y TÚ?"), {normalize("tú")})
+        self.assertEqual(matcher.find_all("tútú"), set())
+        self.assertEqual(matcher.find_all("x.y"), {"x.y"})
+        self.assertEqual(matcher.find_all("xzy"), {"x.y"})  # not a valid keyword so searched for as a regex
+
+        # check results are same as testing each keyword individually
+        test = ContainsTest(["aids", "hiv aids", "tú"], Quantifier.ANY)
+        rule = self.create_rule(self.unicef, [test], [])
+        matcher = KeywordMatcher.for_rules([rule])
+
+        for text in ("Aids", "HIV aids!", "hiv\naids", "aidstú", "tú-aids", "x"):
+            msg = self.create_message(self.unicef, 900 + len(text), self.ann, text)
+            self.assertEqual(test.matches(msg, matcher.find_all(text)), test.matches(msg))
+
     def test_is_valid_keyword(self):
         self.assertTrue(ContainsTest.is_valid_keyword("tú"))
         self.assertTrue(ContainsTest.is_valid_keyword("kit"))
@@ -250,7 +276,7 @@ class ActionsTest(BaseCasesTest):
 
         self.assertEqual(set(msg.labels.all()), {self.aids})
 
-        # check that action completes even if backend errors
+        # check that action completes even if backend errors, and that the backend operation is retried later
         with patch("casepro.test.TestBackend.label_messages") as mock_label:
             mock_label.side_effect = ValueError("DOH")
 
@@ -259,6 +285,10 @@ class ActionsTest(BaseCasesTest):
 
             self.assertEqual(set(msg.labels.all()), {self.aids})
 
+            BackendOp.push(self.unicef)
+
+            self.assertEqual(BackendOp.objects.get(message=msg).attempts, 1)
+
     def test_flag(self):
         action = Action.from_json({"type": "flag"}, self.context)
         self.assertEqual(action.TYPE, "flag")
@@ -274,7 +304,7 @@ class ActionsTest(BaseCasesTest):
         msg.refresh_from_db()
         self.assertTrue(msg.is_flagged)
 
-        # check that action completes even if backend errors
+        # check that action completes even if backend errors, and that the backend operation is retried later
         with patch("casepro.test.TestBackend.flag_messages") as mock_flag:
             mock_flag.side_effect = ValueError("DOH")
 
@@ -284,6 +314,10 @@ class ActionsTest(BaseCasesTest):
             msg.refresh_from_db()
             self.assertTrue(msg.is_flagged)
 
+            BackendOp.push(self.unicef)
+
+            self.assertEqual(BackendOp.objects.get(message=msg).attempts, 1)
+
     def test_archive(self):
         action = Action.from_json({"type": "archive"}, self.context)
         self.assertEqual(action.TYPE, "archive")
@@ -299,7 +333,7 @@ class ActionsTest(BaseCasesTest):
         msg.refresh_from_db()
         self.assertTrue(msg.is_archived)
 
-        # check that action completes even if backend errors
+        # check that action completes even if backend errors, and that the backend operation is retried later
         with patch("casepro.test.TestBackend.archive_messages") as mock_archive:
             mock_archive.side_effect = ValueError("DOH")
 
@@ -309,6 +343,10 @@ class ActionsTest(BaseCasesTest):
             msg.refresh_from_db()
             self.assertTrue(msg.is_archived)
 
+            BackendOp.push(self.unicef)
+
+            self.assertEqual(BackendOp.objects.get(message=msg).attempts, 1)
+
 
 class RuleTest(BaseCasesTest):
     def setUp(self):
@@ -324,6 +362,74 @@ class RuleTest(BaseCasesTest):
         self.assertEqual(rules[1].get_tests(), [ContainsTest(["pregnant", "pregnancy"], Quantifier.ANY)])
         self.assertEqual(rules[1].get_actions(), [LabelAction(self.pregnancy)])
 
+    def test_get_compiled(self):
+        compiled = Rule.get_compiled(self.unicef)
+        self.assertEqual(compiled.rules, list(Rule.get_all(self.unicef).order_by("pk")))
+        self.assertEqual(compiled.rules[0].get_tests(), [ContainsTest(["aids", "hiv"], Quantifier.ANY)])
+
+        # compiled rules are re-used until something changes
+        with self.assertNumQueries(0):
+            self.assertIs(Rule.get_compiled(self.unicef), compiled)
+            self.assertEqual(compiled.rules[0].get_actions(), [LabelAction(self.aids)])
+
+        self.aids.update_tests([ContainsTest(["hiv"], Quantifier.ANY)])
+
+        compiled = Rule.get_compiled(self.unicef)
+        self.assertEqual(compiled.rules[0].get_tests(), [ContainsTest(["hiv"], Quantifier.ANY)])
+        self.assertIs(Rule.get_compiled(self.unicef), compiled)
+
+        self.pregnancy.release()
+
+        compiled = Rule.get_compiled(self.unicef)
+        self.assertEqual(len(compiled.rules), 2)
+
+        # renaming a label also invalidates compiled rules
+        self.aids.name = "HIV"
+        self.aids.save(update_fields=("name",))
+
+        compiled = Rule.get_compiled(self.unicef)
+        self.assertEqual(compiled.rules[0].get_actions()[0].label.name, "HIV")
+
+        # as does creating a new rule
+        rule = self.create_rule(self.unicef, [WordCountTest(2)], [FlagAction()])
+
+        self.assertEqual(Rule.get_compiled(self.unicef).rules[-1], rule)
+
+        # other orgs aren't affected
+        self.assertEqual(len(Rule.get_compiled(self.nyaruka).rules), 1)
+
+    def test_get_compiled_after_group_changes(self):
+        group = self.create_group(self.unicef, "G-101", "Youth")
+        self.create_rule(self.unicef, [GroupsTest([group], Quantifier.ANY)], [FlagAction()])
+
+        compiled = Rule.get_compiled(self.unicef)
+        self.assertEqual(compiled.rules[-1].get_tests()[0].groups[0].name, "Youth")
+
+        # renaming a group invalidates compiled rules
+        group.name = "Teens"
+        group.save(update_fields=("name",))
+
+        compiled = Rule.get_compiled(self.unicef)
+        self.assertEqual(compiled.rules[-1].get_tests()[0].groups[0].name, "Teens")
+
+        # as does releasing a group
+        group.is_active = False
+        group.save(update_fields=("is_active",))
+
+        self.assertIsNot(Rule.get_compiled(self.unicef), compiled)
+
+        # and creating one, e.g. when a rule refers to a group which hasn't been synced yet
+        compiled = Rule.get_compiled(self.unicef)
+        self.create_group(self.unicef, "G-102", "Adults")
+
+        self.assertIsNot(Rule.get_compiled(self.unicef), compiled)
+
+        # but groups in other orgs don't affect this org's rules
+        compiled = Rule.get_compiled(self.unicef)
+        self.create_group(self.nyaruka, "G-103", "Coders")
+
+        self.assertIs(Rule.get_compiled(self.unicef), compiled)
+
     def test_get_tests_description(self):
         rule = self.create_rule(
             self.unicef,
@@ -375,22 +481,63 @@ class RuleTest(BaseCasesTest):
 
         processor.apply_actions()
 
+        BackendOp.push(self.unicef)
+
         mock_label_messages.assert_has_calls(
-            [call(self.unicef, {msg1, msg3, msg4, msg6}, self.aids), call(self.unicef, {msg5, msg6}, self.pregnancy)],
+            [call(self.unicef, [msg1, msg3, msg4, msg6], self.aids), call(self.unicef, [msg5, msg6], self.pregnancy)],
             any_order=True,
         )
 
         self.assertEqual(set(self.aids.messages.all()), {msg1, msg3, msg4, msg6})
         self.assertEqual(set(self.pregnancy.messages.all()), {msg5, msg6})
 
-        mock_flag_messages.assert_called_once_with(self.unicef, {msg1, msg4, msg6})
+        mock_flag_messages.assert_called_once_with(self.unicef, [msg1, msg4, msg6])
 
         self.assertEqual(set(Message.objects.filter(is_flagged=True)), {msg1, msg4, msg6})
 
-        mock_archive_messages.assert_called_once_with(self.unicef, {msg3, msg4})
+        mock_archive_messages.assert_called_once_with(self.unicef, [msg3, msg4])
 
         self.assertEqual(set(Message.objects.filter(is_archived=True)), {msg3, msg4})
 
+    def test_batch_processor_candidate_rules(self):
+        bob = self.create_contact(self.unicef, "C-002", "Bob", [self.females, self.reporters], {"city": "Kigali"})
+
+        rule1 = self.create_rule(self.unicef, [ContainsTest(["aids", "hiv"], Quantifier.ANY)], [FlagAction()])
+        rule2 = self.create_rule(
+            self.unicef,
+            [WordCountTest(2), GroupsTest([self.reporters], Quantifier.ALL)],
+            [LabelAction(self.tea)],
+        )
+        rule3 = self.create_rule(self.unicef, [FieldTest("city", ["Kigali"])], [LabelAction(self.pregnancy)])
+        rule4 = self.create_rule(self.unicef, [ContainsTest(["sida"], Quantifier.NONE)], [ArchiveAction()])
+        rule5 = self.create_rule(self.unicef, [WordCountTest(3)], [LabelAction(self.aids)])
+
+        processor = Rule.BatchProcessor(self.unicef, [rule1, rule2, rule3, rule4, rule5])
+
+        self.assertEqual(processor.index.unindexed_rules, {3, 4})
+
+        msg1 = self.create_message(self.unicef, 101, self.ann, "What is AIDS?")
+        msg2 = self.create_message(self.unicef, 102, bob, "Hello there")
+        msg3 = self.create_message(self.unicef, 103, self.ann, "SIDA")
+
+        def candidates(msg):
+            return processor.index.get_candidate_rules(msg, processor.index.keyword_matcher.find_all(msg.text))
+
+        self.assertEqual(candidates(msg1), [rule1, rule4, rule5])
+        self.assertEqual(candidates(msg2), [rule2, rule3, rule4, rule5])
+        self.assertEqual(candidates(msg3), [rule4, rule5])
+
+        # only candidate rules are evaluated but results are the same as evaluating all rules
+        with patch.object(Rule, "matches", autospec=True, side_effect=Rule.matches) as mock_matches:
+            self.assertEqual(processor.include_messages(msg1, msg2, msg3), (6, 6))
+            self.assertEqual(mock_matches.call_count, 9)
+
+        self.assertEqual(processor.messages_by_action[FlagAction()], {msg1})
+        self.assertEqual(processor.messages_by_action[LabelAction(self.tea)], {msg2})
+        self.assertEqual(processor.messages_by_action[LabelAction(self.pregnancy)], {msg2})
+        self.assertEqual(processor.messages_by_action[ArchiveAction()], {msg1, msg2})
+        self.assertEqual(processor.messages_by_action[LabelAction(self.aids)], {msg1})
+
 
 class RuleCRUDLTest(BaseCasesTest):
     def test_list(self):
@@ -171,6 +171,12 @@ ORG_CONFIG_FIELDS = [
 # number of days after which incoming messages which don't belong to a case and haven't been labelled, can be deleted
 TRIM_OLD_MESSAGES_DAYS = None
 
+# number of days back which searches of messages by text are limited to, or None to search all messages
+SEARCH_BY_TEXT_DAYS = None
+
+# whether statistics counts are buffered in Redis and periodically flushed to the database, rather than written per event
+STATS_BUFFER_COUNTS = False
+
 INSTALLED_APPS = (
     "django.contrib.auth",
     "django.contrib.contenttypes",
@@ -446,6 +452,12 @@ CELERY_BEAT_SCHEDULE = {
         "schedule": timedelta(minutes=1),
         "args": ("casepro.msgs.tasks.handle_messages", "sync"),
     },
+    "backend-push": {
+        "task": "dash.orgs.tasks.trigger_org_task",
+        "schedule": timedelta(minutes=1),
+        "args": ("casepro.msgs.tasks.push_backend_ops", "sync"),
+    },
+    "flush-counts": {"task": "casepro.statistics.tasks.flush_counts", "schedule": timedelta(minutes=1)},
     "squash-counts": {"task": "casepro.statistics.tasks.squash_counts", "schedule": timedelta(minutes=5)},
     "send-notifications": {"task": "casepro.profiles.tasks.send_notifications", "schedule": timedelta(minutes=1)},
     "trim-old-messages": {"task": "casepro.msgs.tasks.trim_old_messages", "schedule": crontab(hour=22, minute=0)},
@@ -0,0 +1,40 @@
+from django.db import migrations, models
+
+# daily counts which are already squashed are rolled up now, and the rest as they are squashed
+SQL = """
+INSERT INTO statistics_monthlycount("month", "item_type", "scope", "count", "is_squashed")
+SELECT DATE_TRUNC('month', "day")::date, "item_type", "scope", SUM("count"), TRUE
+FROM statistics_dailycount WHERE "is_squashed" = TRUE GROUP BY 1, 2, 3;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("statistics", "0019_alter_dailycountexport_created_by_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MonthlyCount",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False)),
+                ("item_type", models.CharField(max_length=1)),
+                ("scope", models.CharField(max_length=32)),
+                ("count", models.IntegerField()),
+                ("is_squashed", models.BooleanField(default=False)),
+                ("month", models.DateField(help_text="The first day of the month this count is for")),
+            ],
+            options={
+                "indexes": [
+                    models.Index(fields=["item_type", "scope", "month"], name="stats_monthlycount_lookup"),
+                    models.Index(
+                        condition=models.Q(("is_squashed", False)),
+                        fields=["item_type", "scope", "month"],
+                        name="stats_monthlycount_unsquashed",
+                    ),
+                ],
+            },
+        ),
+        migrations.RunSQL(SQL, ""),
+    ]
@@ -1,18 +1,30 @@
+import heapq
+from collections import defaultdict, namedtuple
+from datetime import date
+from itertools import groupby
 from math import ceil
+from operator import itemgetter
 
 from dash.orgs.models import Org
+from django_redis import get_redis_connection
 
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import connection, models
+from django.db import connection, models, transaction
 from django.db.models import Index, Q, Sum
+from django.db.models.functions import TruncMonth
 from django.utils.functional import SimpleLazyObject
 from django.utils.translation import gettext_lazy as _
 
-from casepro.cases.models import CaseAction, Partner
+from casepro.cases.models import Partner
 from casepro.msgs.models import Label
 from casepro.utils import date_range
 from casepro.utils.export import BaseExport
 
+BUFFER_KEY = "stats:buffer:%s:%s"  # hash of buffered counts per model and item type
+BUFFER_ITEM_TYPES_KEY = "stats:buffer:%s:item_types"  # set of item types which have buffered counts per model
+BUFFER_FLUSH_LOCK_SECONDS = 5 * 60
+
 
 def datetime_to_date(dt, org):
     """
@@ -36,11 +48,19 @@ class BaseCount(models.Model):
     id = models.BigAutoField(auto_created=True, primary_key=True)
 
     squash_sql = """
-        WITH removed as (
-            DELETE FROM %(table_name)s WHERE %(delete_cond)s RETURNING "count"
+        WITH keys AS (
+            SELECT DISTINCT %(key_cols)s FROM %(table_name)s WHERE "is_squashed" = FALSE AND %(partition_cond)s LIMIT %%s
+        ),
+        removed AS (
+            DELETE FROM %(table_name)s c USING keys k WHERE %(join_cond)s RETURNING %(removed_cols)s, c."count"
+        ),
+        inserted AS (
+            INSERT INTO %(table_name)s(%(key_cols)s, "count", "is_squashed")
+            SELECT %(key_cols)s, GREATEST(0, SUM("count")), TRUE FROM removed GROUP BY %(key_cols)s RETURNING 1
         )
-        INSERT INTO %(table_name)s(%(insert_cols)s, "count", "is_squashed")
-        VALUES (%(insert_vals)s, GREATEST(0, (SELECT SUM("count") FROM removed)), TRUE);"""
+        SELECT (SELECT COUNT(*) FROM keys), (SELECT COUNT(*) FROM inserted);"""
+
+    squash_batch_size = 1000
 
     item_type = models.CharField(max_length=1)
 
@@ -50,6 +70,8 @@ class BaseCount(models.Model):
 
     is_squashed = models.BooleanField(default=False)
 
+    buffer_values = ("count",)
+
     @staticmethod
     def encode_scope(*args):
         types = []
@@ -72,47 +94,189 @@ class BaseCount(models.Model):
             raise ValueError("Unsupported scope: %s" % ",".join([t.__name__ for t in types]))
 
     @classmethod
-    def squash(cls):
+    def squash(cls, partition=0, num_partitions=1):
         """
-        Squashes counts so that there is a single count per item_type + scope combination
+        Squashes counts so that there is a single count per item_type + scope combination. Each statement squashes all
+        unsquashed rows for a batch of combinations, and we keep going until a statement finds no combinations left
+        (a batch can squash nothing if its rows were removed by a concurrent squash). Counts can be split into
+        partitions by a hash of their scope, so that separate workers can squash different partitions at the same time
+        without touching the same rows.
         """
-        unsquashed_values = cls.objects.filter(is_squashed=False)
-        unsquashed_values = unsquashed_values.values(*cls.squash_over).distinct(*cls.squash_over)
-
-        for unsquashed in unsquashed_values:
+        partition_cond = "TRUE"
+        params = []
+        if num_partitions > 1:
+            partition_cond = '(hashtext("scope") & 2147483647) %% %s = %s'
+            params = [num_partitions, partition]
+
+        sql = cls.squash_sql % {
+            "table_name": cls._meta.db_table,
+            "key_cols": ", ".join(['"%s"' % f for f in cls.squash_over]),
+            "partition_cond": partition_cond,
+            "join_cond": " AND ".join(['c."%s" = k."%s"' % (f, f) for f in cls.squash_over]),
+            "removed_cols": ", ".join(['c."%s"' % f for f in cls.squash_over]),
+        }
+
+        num_squashed = 0
+        while True:
             with connection.cursor() as cursor:
-                sql = cls.squash_sql % {
-                    "table_name": cls._meta.db_table,
-                    "delete_cond": " AND ".join(['"%s" = %%s' % f for f in cls.squash_over]),
-                    "insert_cols": ", ".join(['"%s"' % f for f in cls.squash_over]),
-                    "insert_vals": ", ".join(["%s"] * len(cls.squash_over)),
-                }
+                cursor.execute(sql, params + [cls.squash_batch_size])
+                num_keys, num_inserted = cursor.fetchone()
+                if not num_keys:
+                    break
+
+                num_squashed += num_inserted
+
+        return num_squashed
+
+    @classmethod
+    def _record(cls, **kwargs):
+        """
+        Records a count, either as a new row or, if counts are buffered, by adding it to the buffer in Redis once the
+        current transaction has committed
+        """
+        if settings.STATS_BUFFER_COUNTS:
+            transaction.on_commit(lambda: cls._add_to_buffer([kwargs]))
+        else:
+            cls.objects.create(**kwargs)
+
+    @classmethod
+    def _record_many(cls, counts):
+        """
+        Records multiple counts at once, either as new rows with a single insert or by adding them to the buffer
+        """
+        counts = [c for c in counts if c["count"]]
+        if not counts:
+            return
+
+        if settings.STATS_BUFFER_COUNTS:
+            transaction.on_commit(lambda: cls._add_to_buffer(counts))
+        else:
+            cls.objects.bulk_create([cls(**c) for c in counts])
+
+    @classmethod
+    def _get_buffer_key(cls, item_type):
+        return BUFFER_KEY % (cls._meta.model_name, item_type)
+
+    @classmethod
+    def _get_buffer_item_types(cls, r):
+        return sorted(t.decode() for t in r.smembers(BUFFER_ITEM_TYPES_KEY % cls._meta.model_name))
+
+    @classmethod
+    def _add_to_buffer(cls, counts):
+        with get_redis_connection().pipeline() as pipe:
+            for count in counts:
+                over = [str(count[f]) for f in cls.squash_over]
+
+                pipe.sadd(BUFFER_ITEM_TYPES_KEY % cls._meta.model_name, count["item_type"])
+                for value in cls.buffer_values:
+                    pipe.hincrby(cls._get_buffer_key(count["item_type"]), "|".join([value] + over), count[value])
+            pipe.execute()
+
+    @classmethod
+    def _decode_buffer(cls, *buffers):
+        """
+        Decodes and sums the given buffer hashes into a list of dicts of field values, one per count
+        """
+        decoded = defaultdict(lambda: dict.fromkeys(cls.buffer_values, 0))
+        for buffer in buffers:
+            for field, value in buffer.items():
+                value_name, *over = field.decode().split("|", len(cls.squash_over))
+                decoded[tuple(over)][value_name] += int(value)
+
+        counts = []
+        for over, values in decoded.items():
+            count = dict(zip(cls.squash_over, over), **values)
+            if "day" in count:
+                count["day"] = date.fromisoformat(count["day"])
+            counts.append(count)
+        return counts
+
+    @classmethod
+    def get_buffered(cls, item_type=None):
+        """
+        Gets the buffered counts of the given item type, or all item types, which haven't yet been flushed to the
+        database, including any being flushed now
+        """
+        if not settings.STATS_BUFFER_COUNTS:
+            return []
+
+        r = get_redis_connection()
+        item_types = [item_type] if item_type else cls._get_buffer_item_types(r)
+
+        with r.pipeline() as pipe:
+            for t in item_types:
+                pipe.hgetall(cls._get_buffer_key(t))
+                pipe.hgetall(cls._get_buffer_key(t) + ":flushing")
+            return cls._decode_buffer(*pipe.execute())
+
+    @classmethod
+    def flush_buffer(cls):
+        """
+        Flushes buffered counts to the database as a single row per count
+        """
+        r = get_redis_connection()
+        return sum(cls._flush_buffer_key(r, cls._get_buffer_key(t)) for t in cls._get_buffer_item_types(r))
+
+    @classmethod
+    def _flush_buffer_key(cls, r, key):
+        flushing_key = key + ":flushing"
+
+        with r.lock(key + ":lock", timeout=BUFFER_FLUSH_LOCK_SECONDS):
+            # new increments go to a fresh hash while we flush, unless we're retrying a previous failed flush
+            if not r.exists(flushing_key):
+                if not r.exists(key):
+                    return 0
+                r.rename(key, flushing_key)
+
+            counts = [c for c in cls._decode_buffer(r.hgetall(flushing_key)) if any(c[v] for v in cls.buffer_values)]
+
+            # the flushed counts are only removed from Redis once they've been committed, so a flush which fails
+            # before then is retried, and one which fails after then can't insert them again
+            with transaction.atomic():
+                cls.objects.bulk_create([cls(**c) for c in counts])
+
+                transaction.on_commit(lambda: r.delete(flushing_key))
+
+        return len(counts)
 
-                params = [unsquashed[f] for f in cls.squash_over]
-                cursor.execute(sql, params + params)
+    @classmethod
+    def _filter_buffered(cls, item_type, scopes, since=None, until=None):
+        buffered = cls.get_buffered(item_type)
+        if scopes:
+            buffered = [c for c in buffered if c["scope"] in scopes]
+        if since:
+            buffered = [c for c in buffered if c["day"] >= since]
+        if until:
+            buffered = [c for c in buffered if c["day"] < until]
+        return buffered
 
     class CountSet(object):
         """
-        A queryset of counts which can be aggregated in different ways
+        A queryset of counts which can be aggregated in different ways. Any buffered counts which haven't yet been
+        flushed to the database are included in the aggregates.
         """
 
-        def __init__(self, counts, scopes):
+        def __init__(self, counts, scopes, buffered=()):
             self.counts = counts
             self.scopes = scopes
+            self.buffered = buffered
 
         def total(self):
             """
             Calculates the overall total over a set of counts
             """
             total = self.counts.aggregate(total=Sum("count"))
-            return total["total"] if total["total"] is not None else 0
+            total = total["total"] if total["total"] is not None else 0
+            return total + sum(c["count"] for c in self.buffered)
 
         def scope_totals(self):
             """
             Calculates per-scope totals over a set of counts
             """
             totals = list(self.counts.values_list("scope").annotate(replies=Sum("count")))
-            total_by_encoded_scope = {t[0]: t[1] for t in totals}
+            total_by_encoded_scope = defaultdict(int, {t[0]: t[1] for t in totals})
+            for c in self.buffered:
+                total_by_encoded_scope[c["scope"]] += c["count"]
 
             total_by_scope = {}
             for encoded_scope, scope in self.scopes.items():
@@ -120,6 +284,38 @@ class BaseCount(models.Model):
 
             return total_by_scope
 
+        def _merge_buffered(self, totals, key_fn, num_values):
+            """
+            Merges buffered counts into a list of totals which are tuples of a key followed by the summed values
+            """
+            merged = {t[0]: list(t[1:]) for t in totals}
+            for c in self.buffered:
+                values = merged.setdefault(key_fn(c), [0] * num_values)
+                for v, value_name in enumerate(("count", "seconds")[:num_values]):
+                    values[v] += c[value_name]
+
+            return [(key, *values) for key, values in sorted(merged.items())]
+
+        def _pivot_by_day(self, totals, num_values):
+            """
+            Pivots totals which are tuples of day, encoded scope and the summed values, in order of day, into tuples of
+            day and dict of scope to values for that day. Buffered counts are merged in as days are produced.
+            """
+            value_names = ("count", "seconds")[:num_values]
+            buffered = sorted((c["day"], c["scope"], *[c[v] for v in value_names]) for c in self.buffered)
+
+            for day, rows in groupby(heapq.merge(totals, buffered, key=itemgetter(0)), key=itemgetter(0)):
+                values_by_scope = defaultdict(lambda: [0] * num_values)
+                for row in rows:
+                    if row[1] not in self.scopes:
+                        continue
+
+                    values = values_by_scope[self.scopes[row[1]]]
+                    for v in range(num_values):
+                        values[v] += row[2 + v]
+
+                yield day, {s: (v[0] if num_values == 1 else tuple(v)) for s, v in values_by_scope.items()}
+
     class Meta:
         abstract = True
 
@@ -133,19 +329,24 @@ class BaseSecondTotal(BaseCount):
     TYPE_TILL_CLOSED = "C"
 
     squash_sql = """
-        WITH removed as (
-            DELETE FROM %(table_name)s WHERE %(delete_cond)s RETURNING "count", "seconds"
+        WITH keys AS (
+            SELECT DISTINCT %(key_cols)s FROM %(table_name)s WHERE "is_squashed" = FALSE AND %(partition_cond)s LIMIT %%s
+        ),
+        removed AS (
+            DELETE FROM %(table_name)s c USING keys k WHERE %(join_cond)s
+            RETURNING %(removed_cols)s, c."count", c."seconds"
+        ),
+        inserted AS (
+            INSERT INTO %(table_name)s(%(key_cols)s, "count", "seconds", "is_squashed")
+            SELECT %(key_cols)s, GREATEST(0, SUM("count")), COALESCE(SUM("seconds"), 0), TRUE
+            FROM removed GROUP BY %(key_cols)s RETURNING 1
         )
-        INSERT INTO %(table_name)s(%(insert_cols)s, "count", "seconds", "is_squashed")
-        VALUES (
-            %(insert_vals)s,
-            GREATEST(0, (SELECT SUM("count") FROM removed)),
-            COALESCE((SELECT SUM("seconds") FROM removed), 0),
-            TRUE
-        );"""
+        SELECT (SELECT COUNT(*) FROM keys), (SELECT COUNT(*) FROM inserted);"""
 
     seconds = models.BigIntegerField()
 
+    buffer_values = ("count", "seconds")
+
     class CountSet(BaseCount.CountSet):
         """
         A queryset of counts which can be aggregated in different ways
@@ -156,10 +357,12 @@ class BaseSecondTotal(BaseCount):
             Calculates the overall total over a set of counts
             """
             totals = self.counts.aggregate(total=Sum("count"), seconds=Sum("seconds"))
-            if totals["seconds"] is None or totals["total"] is None:
+            total = (totals["total"] or 0) + sum(c["count"] for c in self.buffered)
+            seconds = (totals["seconds"] or 0) + sum(c["seconds"] for c in self.buffered)
+            if not total:
                 return 0
 
-            average = float(totals["seconds"]) / totals["total"]
+            average = float(seconds) / total
             return average
 
         def seconds(self):
@@ -167,14 +370,16 @@ class BaseSecondTotal(BaseCount):
             Calculates the overall total of seconds over a set of counts
             """
             total = self.counts.aggregate(total_seconds=Sum("seconds"))
-            return total["total_seconds"] if total["total_seconds"] is not None else 0
+            total = total["total_seconds"] if total["total_seconds"] is not None else 0
+            return total + sum(c["seconds"] for c in self.buffered)
 
         def scope_averages(self):
             """
             Calculates per-scope averages over a set of counts
             """
-            totals = list(self.counts.values("scope").annotate(cases=Sum("count"), seconds=Sum("seconds")))
-            total_by_encoded_scope = {t["scope"]: (t["cases"], t["seconds"]) for t in totals}
+            totals = list(self.counts.values_list("scope").annotate(cases=Sum("count"), seconds=Sum("seconds")))
+            totals = self._merge_buffered(totals, lambda c: c["scope"], 2)
+            total_by_encoded_scope = {t[0]: (t[1], t[2]) for t in totals}
 
             average_by_scope = {}
             for encoded_scope, scope in self.scopes.items():
@@ -187,18 +392,27 @@ class BaseSecondTotal(BaseCount):
             """
             Calculates per-day totals over a set of counts
             """
-            return list(
+            totals = (
                 self.counts.values_list("day").annotate(cases=Sum("count"), seconds=Sum("seconds")).order_by("day")
             )
+            return self._merge_buffered(totals, lambda c: c["day"], 2)
+
+        def scope_day_totals(self):
+            """
+            Calculates per-scope totals and seconds for each day over a set of counts with a single query, as a
+            generator of tuples of day and dict of scope to (total, seconds), in order of day
+            """
+            totals = self.counts.values_list("day", "scope").annotate(cases=Sum("count"), seconds=Sum("seconds"))
+            return self._pivot_by_day(totals.order_by("day").iterator(), 2)
 
         def month_totals(self):
             """
-            Calculates per-month totals over a set of counts
+            Calculates per-month totals over a set of counts, as tuples of the first day of the month, the total and
+            the seconds
             """
-            counts = self.counts.extra(select={"month": 'EXTRACT(month FROM "day")'})
-            return list(
-                counts.values_list("month").annotate(cases=Sum("count"), seconds=Sum("seconds")).order_by("month")
-            )
+            counts = self.counts.annotate(month=TruncMonth("day"))
+            totals = counts.values_list("month").annotate(cases=Sum("count"), seconds=Sum("seconds")).order_by("month")
+            return self._merge_buffered(totals, lambda c: c["day"].replace(day=1), 2)
 
     class Meta:
         abstract = True
@@ -213,7 +427,7 @@ class TotalCount(BaseCount):
 
     @classmethod
     def record_item(cls, item_type, *scope_args):
-        cls.objects.create(item_type=item_type, scope=cls.encode_scope(*scope_args), count=1)
+        cls._record(item_type=item_type, scope=cls.encode_scope(*scope_args), count=1)
 
     @classmethod
     def get_by_org(cls, orgs, item_type):
@@ -236,7 +450,7 @@ class TotalCount(BaseCount):
         counts = cls.objects.filter(item_type=item_type)
         if scopes:
             counts = counts.filter(scope__in=scopes.keys())
-        return BaseCount.CountSet(counts, scopes)
+        return BaseCount.CountSet(counts, scopes, cls._filter_buffered(item_type, scopes))
 
     class Meta:
         index_together = ("item_type", "scope")
@@ -252,15 +466,64 @@ class DailyCount(BaseCount):
 
     day = models.DateField(help_text=_("The day this count is for"))
 
+    # as well as squashing, rolls the change in each day's total up into the monthly count for that day's month
+    squash_sql = """
+        WITH keys AS (
+            SELECT DISTINCT %(key_cols)s FROM %(table_name)s WHERE "is_squashed" = FALSE AND %(partition_cond)s LIMIT %%s
+        ),
+        removed AS (
+            DELETE FROM %(table_name)s c USING keys k WHERE %(join_cond)s
+            RETURNING %(removed_cols)s, c."count", c."is_squashed"
+        ),
+        squashed AS (
+            SELECT %(key_cols)s,
+                GREATEST(0, SUM("count")) AS "count",
+                COALESCE(SUM("count") FILTER (WHERE "is_squashed"), 0) AS "previous"
+            FROM removed GROUP BY %(key_cols)s
+        ),
+        rolled_up AS (
+            INSERT INTO statistics_monthlycount("month", "item_type", "scope", "count", "is_squashed")
+            SELECT DATE_TRUNC('month', "day")::date, "item_type", "scope", SUM("count" - "previous"), FALSE
+            FROM squashed GROUP BY 1, 2, 3 HAVING SUM("count" - "previous") <> 0
+        ),
+        inserted AS (
+            INSERT INTO %(table_name)s(%(key_cols)s, "count", "is_squashed")
+            SELECT %(key_cols)s, "count", TRUE FROM squashed RETURNING 1
+        )
+        SELECT (SELECT COUNT(*) FROM keys), (SELECT COUNT(*) FROM inserted);"""
+
     squash_over = ("day", "item_type", "scope")
 
     @classmethod
     def record_item(cls, day, item_type, *scope_args):
-        cls.objects.create(day=day, item_type=item_type, scope=cls.encode_scope(*scope_args), count=1)
+        cls._record(day=day, item_type=item_type, scope=cls.encode_scope(*scope_args), count=1)
 
     @classmethod
     def record_removal(cls, day, item_type, *scope_args):
-        cls.objects.create(day=day, item_type=item_type, scope=cls.encode_scope(*scope_args), count=-1)
+        cls._record(day=day, item_type=item_type, scope=cls.encode_scope(*scope_args), count=-1)
+
+    @classmethod
+    def record_items(cls, item_type, counts_by_day, *scope_args):
+        """
+        Records multiple items at once as a single count row per day
+        """
+        scope = cls.encode_scope(*scope_args)
+        cls._record_many(
+            [dict(day=day, item_type=item_type, scope=scope, count=count) for day, count in counts_by_day.items()]
+        )
+
+    @classmethod
+    def record_removals(cls, item_type, counts_by_day_and_scope):
+        """
+        Records multiple removals at once as a single negative count row per day and scope
+        :param counts_by_day_and_scope: dict of (day, scope object) tuples to number of items removed
+        """
+        cls._record_many(
+            [
+                dict(day=day, item_type=item_type, scope=cls.encode_scope(scope), count=-count)
+                for (day, scope), count in counts_by_day_and_scope.items()
+            ]
+        )
 
     @classmethod
     def get_by_org(cls, orgs, item_type, since=None, until=None):
@@ -287,7 +550,7 @@ class DailyCount(BaseCount):
             counts = counts.filter(day__gte=since)
         if until:
             counts = counts.filter(day__lt=until)
-        return DailyCount.CountSet(counts, scopes)
+        return DailyCount.CountSet(counts, scopes, cls._filter_buffered(item_type, scopes, since, until))
 
     class CountSet(BaseCount.CountSet):
         """
@@ -298,14 +561,24 @@ class DailyCount(BaseCount):
             """
             Calculates per-day totals over a set of counts
             """
-            return list(self.counts.values_list("day").annotate(total=Sum("count")).order_by("day"))
+            totals = self.counts.values_list("day").annotate(total=Sum("count")).order_by("day")
+            return self._merge_buffered(totals, lambda c: c["day"], 1)
+
+        def scope_day_totals(self):
+            """
+            Calculates per-scope totals for each day over a set of counts with a single query, as a generator of
+            tuples of day and dict of scope to total, in order of day
+            """
+            totals = self.counts.values_list("day", "scope").annotate(total=Sum("count")).order_by("day")
+            return self._pivot_by_day(totals.iterator(), 1)
 
         def month_totals(self):
             """
-            Calculates per-month totals over a set of counts
+            Calculates per-month totals over a set of counts, as tuples of the first day of the month and the total
             """
-            counts = self.counts.extra(select={"month": 'EXTRACT(month FROM "day")'})
-            return list(counts.values_list("month").annotate(replies=Sum("count")).order_by("month"))
+            counts = self.counts.annotate(month=TruncMonth("day"))
+            totals = counts.values_list("month").annotate(replies=Sum("count")).order_by("month")
+            return self._merge_buffered(totals, lambda c: c["day"].replace(day=1), 1)
 
     class Meta:
         index_together = ("item_type", "scope", "day")
@@ -318,6 +591,163 @@ class DailyCount(BaseCount):
         ]
 
 
+class MonthlyCount(BaseCount):
+    """
+    Tracks per-month counts of different items (e.g. replies, cases opened) in different scopes (e.g. org, user). These
+    are rolled up from daily counts as those are squashed, so per-month charts don't have to aggregate daily counts.
+    """
+
+    month = models.DateField(help_text=_("The first day of the month this count is for"))
+
+    squash_over = ("month", "item_type", "scope")
+
+    @classmethod
+    def get_by_org(cls, orgs, item_type, since=None):
+        return cls._get_count_set(item_type, {cls.encode_scope(o): o for o in orgs}, since)
+
+    @classmethod
+    def get_by_partner(cls, partners, item_type, since=None):
+        return cls._get_count_set(item_type, {cls.encode_scope(p): p for p in partners}, since)
+
+    @classmethod
+    def get_by_user(cls, org, users, item_type, since=None):
+        return cls._get_count_set(item_type, {cls.encode_scope(org, u): u for u in users}, since)
+
+    @classmethod
+    def _get_count_set(cls, item_type, scopes, since):
+        counts = cls.objects.filter(item_type=item_type, scope__in=scopes.keys())
+        if since:
+            counts = counts.filter(month__gte=since)
+
+        # daily counts which haven't been squashed yet haven't been rolled up either
+        unsquashed = DailyCount.objects.filter(item_type=item_type, scope__in=scopes.keys(), is_squashed=False)
+        if since:
+            unsquashed = unsquashed.filter(day__gte=since)
+        unsquashed = unsquashed.annotate(month=TruncMonth("day")).values("month").annotate(count=Sum("count"))
+
+        pending = [{"day": c["month"], "count": c["count"]} for c in unsquashed]
+        pending += DailyCount._filter_buffered(item_type, scopes, since)
+
+        return MonthlyCount.CountSet(counts, scopes, pending)
+
+    class CountSet(BaseCount.CountSet):
+        """
+        A queryset of counts which can be aggregated in different ways
+        """
+
+        def month_totals(self):
+            """
+            Calculates per-month totals over a set of counts, as tuples of the first day of the month and the total
+            """
+            totals = self.counts.values_list("month").annotate(total=Sum("count")).order_by("month")
+            return self._merge_buffered(totals, lambda c: c["day"].replace(day=1), 1)
+
+    class Meta:
+        indexes = [
+            Index(name="stats_monthlycount_lookup", fields=("item_type", "scope", "month")),
+            Index(
+                name="stats_monthlycount_unsquashed",
+                fields=("item_type", "scope", "month"),
+                condition=Q(is_squashed=False),
+            ),
+        ]
+
+
+class CountQuery(object):
+    """
+    Fetches several metrics for the same set of scopes, e.g. a list of partners. Metrics are counts of an item type in
+    one of the count tables, optionally over a window of days, and are answered with a single query per table which
+    aggregates each metric conditionally on its item type and window.
+    """
+
+    Metric = namedtuple("Metric", ("name", "model", "item_type", "since", "until", "is_average"))
+
+    def __init__(self, scopes):
+        self.scopes = scopes
+        self.metrics = []
+
+    @classmethod
+    def for_partners(cls, partners):
+        return cls({BaseCount.encode_scope(p): p for p in partners})
+
+    @classmethod
+    def for_users(cls, org, users):
+        return cls({BaseCount.encode_scope(org, u): u for u in users})
+
+    def total(self, name, model, item_type, since=None, until=None):
+        """
+        Adds a metric which is the total count per scope
+        """
+        self.metrics.append(self.Metric(name, model, item_type, since, until, False))
+        return self
+
+    def average(self, name, model, item_type, since=None, until=None):
+        """
+        Adds a metric which is the average seconds per scope, for second total counts
+        """
+        self.metrics.append(self.Metric(name, model, item_type, since, until, True))
+        return self
+
+    def fetch(self):
+        """
+        Fetches all metrics as a dict of metric name to dict of scope to value
+        """
+        results = {}
+        by_model = defaultdict(list)
+        for metric in self.metrics:
+            by_model[metric.model].append(metric)
+
+        for model, metrics in by_model.items():
+            results.update(self._fetch_for_model(model, metrics))
+
+        return results
+
+    def _fetch_for_model(self, model, metrics):
+        if not self.scopes:
+            return {m.name: {} for m in metrics}
+
+        counts = model.objects.filter(scope__in=self.scopes.keys(), item_type__in={m.item_type for m in metrics})
+
+        # if all metrics are windowed, we only need counts from the start of the earliest window
+        if all(m.since for m in metrics):
+            counts = counts.filter(day__gte=min(m.since for m in metrics))
+
+        aggregates = {}
+        for m, metric in enumerate(metrics):
+            condition = Q(item_type=metric.item_type)
+            if metric.since:
+                condition &= Q(day__gte=metric.since)
+            if metric.until:
+                condition &= Q(day__lt=metric.until)
+
+            aggregates["m%d_count" % m] = Sum("count", filter=condition)
+            if metric.is_average:
+                aggregates["m%d_seconds" % m] = Sum("seconds", filter=condition)
+
+        values_by_scope = {row["scope"]: row for row in counts.values("scope").annotate(**aggregates).order_by()}
+
+        results = {}
+        for m, metric in enumerate(metrics):
+            totals = defaultdict(lambda: [0, 0])
+            for encoded_scope, values in values_by_scope.items():
+                totals[encoded_scope][0] += values["m%d_count" % m] or 0
+                totals[encoded_scope][1] += values.get("m%d_seconds" % m) or 0
+
+            for c in model._filter_buffered(metric.item_type, self.scopes, metric.since, metric.until):
+                totals[c["scope"]][0] += c["count"]
+                totals[c["scope"]][1] += c.get("seconds", 0)
+
+            results[metric.name] = {}
+            for encoded_scope, scope in self.scopes.items():
+                count, seconds = totals.get(encoded_scope, (0, 0))
+                if metric.is_average:
+                    results[metric.name][scope] = float(seconds) / count if count else 0
+                else:
+                    results[metric.name][scope] = count
+
+        return results
+
+
 class DailyCountExport(BaseExport):
     """
     Exports based on daily counts. Each row is date and columns are different scopes.
@@ -342,120 +772,82 @@ class DailyCountExport(BaseExport):
 
     def render_book(self, book):
         if self.type == self.TYPE_LABEL:
-            sheet = book.add_sheet(str(_("Incoming Messages")))
-
             labels = list(Label.get_all(self.org).order_by("name"))
+            label_names = [l.name for l in labels]
 
-            # get each label's day counts and organise by label and day
-            totals_by_label = {}
-            for label in labels:
-                totals = DailyCount.get_by_label(
-                    [label], DailyCount.TYPE_INCOMING, self.since, self.until
-                ).day_totals()
-                totals_by_label[label] = {t[0]: t[1] for t in totals}
+            incoming = DailyCount.get_by_label(labels, DailyCount.TYPE_INCOMING, self.since, self.until)
 
-            self.write_row(sheet, 0, ["Date"] + [l.name for l in labels])
-
-            row = 1
-            for day in date_range(self.since, self.until):
-                totals = [totals_by_label.get(l, {}).get(day, 0) for l in labels]
-                self.write_row(sheet, row, [day] + totals)
-                row += 1
+            self.write_day_sheet(book.add_sheet(str(_("Incoming Messages"))), label_names, labels, incoming)
 
         elif self.type == self.TYPE_USER:
+            users = list(self.org.get_org_users().order_by("profile__full_name"))
+            user_names = [u.get_full_name() for u in users]
+
+            def get_by_user(item_type):
+                return DailyCount.get_by_user(self.org, users, item_type, self.since, self.until)
+
             replies_sheet = book.add_sheet(str(_("Replies Sent")))
             cases_opened_sheet = book.add_sheet(str(_("Cases Opened")))
             cases_closed_sheet = book.add_sheet(str(_("Cases Closed")))
 
-            users = self.org.get_org_users().order_by("profile__full_name")
-
-            replies_totals_by_user = {}
-            cases_opened_by_user = {}
-            cases_closed_by_user = {}
-            for user in users:
-                replies_totals = DailyCount.get_by_user(
-                    self.org, [user], DailyCount.TYPE_REPLIES, self.since, self.until
-                ).day_totals()
-                cases_opened_totals = DailyCount.get_by_user(
-                    self.org, [user], DailyCount.TYPE_CASE_OPENED, self.since, self.until
-                ).day_totals()
-                cases_closed_totals = DailyCount.get_by_user(
-                    self.org, [user], DailyCount.TYPE_CASE_CLOSED, self.since, self.until
-                ).day_totals()
-                replies_totals_by_user[user] = {t[0]: t[1] for t in replies_totals}
-                cases_opened_by_user[user] = {t[0]: t[1] for t in cases_opened_totals}
-                cases_closed_by_user[user] = {t[0]: t[1] for t in cases_closed_totals}
-
-            self.write_row(replies_sheet, 0, ["Date"] + [u.get_full_name() for u in users])
-            self.write_row(cases_opened_sheet, 0, ["Date"] + [u.get_full_name() for u in users])
-            self.write_row(cases_closed_sheet, 0, ["Date"] + [u.get_full_name() for u in users])
-
-            row = 1
-            for day in date_range(self.since, self.until):
-                replies_totals = [replies_totals_by_user.get(u, {}).get(day, 0) for u in users]
-                cases_opened_totals = [cases_opened_by_user.get(u, {}).get(day, 0) for u in users]
-                cases_closed_totals = [cases_closed_by_user.get(u, {}).get(day, 0) for u in users]
-                self.write_row(replies_sheet, row, [day] + replies_totals)
-                self.write_row(cases_opened_sheet, row, [day] + cases_opened_totals)
-                self.write_row(cases_closed_sheet, row, [day] + cases_closed_totals)
-                row += 1
+            self.write_day_sheet(replies_sheet, user_names, users, get_by_user(DailyCount.TYPE_REPLIES))
+            self.write_day_sheet(cases_opened_sheet, user_names, users, get_by_user(DailyCount.TYPE_CASE_OPENED))
+            self.write_day_sheet(cases_closed_sheet, user_names, users, get_by_user(DailyCount.TYPE_CASE_CLOSED))
 
         elif self.type == self.TYPE_PARTNER:
+            partners = list(Partner.get_all(self.org).order_by("name"))
+            partner_names = [p.name for p in partners]
+
+            def get_by_partner(model, item_type):
+                return model.get_by_partner(partners, item_type, self.since, self.until)
+
+            def average(totals):
+                cases, seconds = totals
+                return float(seconds) / cases
+
             replies_sheet = book.add_sheet(str(_("Replies Sent")))
             ave_sheet = book.add_sheet(str(_("Average Reply Time")))
             ave_closed_sheet = book.add_sheet(str(_("Average Closed Time")))
             cases_opened_sheet = book.add_sheet(str(_("Cases Opened")))
             cases_closed_sheet = book.add_sheet(str(_("Cases Closed")))
 
-            partners = list(Partner.get_all(self.org).order_by("name"))
+            replied = get_by_partner(DailySecondTotalCount, DailySecondTotalCount.TYPE_TILL_REPLIED)
+            closed = get_by_partner(DailySecondTotalCount, DailySecondTotalCount.TYPE_TILL_CLOSED)
+
+            self.write_day_sheet(
+                replies_sheet, partner_names, partners, get_by_partner(DailyCount, DailyCount.TYPE_REPLIES)
+            )
+            self.write_day_sheet(ave_sheet, partner_names, partners, replied, average)
+            self.write_day_sheet(ave_closed_sheet, partner_names, partners, closed, average)
+            self.write_day_sheet(
+                cases_opened_sheet, partner_names, partners, get_by_partner(DailyCount, DailyCount.TYPE_CASE_OPENED)
+            )
+            self.write_day_sheet(
+                cases_closed_sheet, partner_names, partners, get_by_partner(DailyCount, DailyCount.TYPE_CASE_CLOSED)
+            )
+
+    def write_day_sheet(self, sheet, headers, scopes, count_set, value_fn=None):
+        """
+        Writes a sheet with a row for each day and a column for each scope, pivoting the per-scope day totals of the
+        given count set as they are fetched
+        """
+        self.write_row(sheet, 0, ["Date"] + headers)
+
+        day_totals = count_set.scope_day_totals()
+        next_day, next_totals = next(day_totals, (None, None))
 
-            # get each partner's day counts and organise by partner and day
-            replies_totals_by_partner = {}
-            cases_opened_by_partner = {}
-            cases_closed_by_partner = {}
-            replied_averages_by_partner = {}
-            closed_averages_by_partner = {}
-            for partner in partners:
-                replies_totals = DailyCount.get_by_partner(
-                    [partner], DailyCount.TYPE_REPLIES, self.since, self.until
-                ).day_totals()
-                cases_opened_totals = DailyCount.get_by_partner(
-                    [partner], DailyCount.TYPE_CASE_OPENED, self.since, self.until
-                ).day_totals()
-                cases_closed_totals = DailyCount.get_by_partner(
-                    [partner], DailyCount.TYPE_CASE_CLOSED, self.since, self.until
-                ).day_totals()
-                replies_totals_by_partner[partner] = {t[0]: t[1] for t in replies_totals}
-                cases_opened_by_partner[partner] = {t[0]: t[1] for t in cases_opened_totals}
-                cases_closed_by_partner[partner] = {t[0]: t[1] for t in cases_closed_totals}
-                replied_second_totals = DailySecondTotalCount.get_by_partner(
-                    [partner], DailySecondTotalCount.TYPE_TILL_REPLIED, self.since, self.until
-                ).day_totals()
-                replied_averages_by_partner[partner] = {t[0]: (float(t[2]) / t[1]) for t in replied_second_totals}
-                closed_second_totals = DailySecondTotalCount.get_by_partner(
-                    [partner], DailySecondTotalCount.TYPE_TILL_CLOSED, self.since, self.until
-                ).day_totals()
-                closed_averages_by_partner[partner] = {t[0]: (float(t[2]) / t[1]) for t in closed_second_totals}
-
-            self.write_row(replies_sheet, 0, ["Date"] + [p.name for p in partners])
-            self.write_row(cases_opened_sheet, 0, ["Date"] + [p.name for p in partners])
-            self.write_row(cases_closed_sheet, 0, ["Date"] + [p.name for p in partners])
-            self.write_row(ave_sheet, 0, ["Date"] + [p.name for p in partners])
-            self.write_row(ave_closed_sheet, 0, ["Date"] + [p.name for p in partners])
-
-            row = 1
-            for day in date_range(self.since, self.until):
-                replies_totals = [replies_totals_by_partner.get(l, {}).get(day, 0) for l in partners]
-                cases_opened_totals = [cases_opened_by_partner.get(l, {}).get(day, 0) for l in partners]
-                cases_closed_totals = [cases_closed_by_partner.get(l, {}).get(day, 0) for l in partners]
-                replied_averages = [replied_averages_by_partner.get(l, {}).get(day, 0) for l in partners]
-                closed_averages = [closed_averages_by_partner.get(l, {}).get(day, 0) for l in partners]
-                self.write_row(replies_sheet, row, [day] + replies_totals)
-                self.write_row(cases_opened_sheet, row, [day] + cases_opened_totals)
-                self.write_row(cases_closed_sheet, row, [day] + cases_closed_totals)
-                self.write_row(ave_sheet, row, [day] + replied_averages)
-                self.write_row(ave_closed_sheet, row, [day] + closed_averages)
-                row += 1
+        for row, day in enumerate(date_range(self.since, self.until), start=1):
+            totals = {}
+            if day == next_day:
+                totals = next_totals
+                next_day, next_totals = next(day_totals, (None, None))
+
+            values = []
+            for scope in scopes:
+                value = totals.get(scope)
+                values.append((value_fn(value) if value_fn else value) if value is not None else 0)
+
+            self.write_row(sheet, row, [day] + values)
 
 
 class DailySecondTotalCount(BaseSecondTotal):
@@ -469,7 +861,7 @@ class DailySecondTotalCount(BaseSecondTotal):
 
     @classmethod
     def record_item(cls, day, seconds, item_type, *scope_args):
-        cls.objects.create(day=day, item_type=item_type, scope=cls.encode_scope(*scope_args), count=1, seconds=seconds)
+        cls._record(day=day, item_type=item_type, scope=cls.encode_scope(*scope_args), count=1, seconds=seconds)
 
     @classmethod
     def get_by_org(cls, orgs, item_type, since=None, until=None):
@@ -492,29 +884,45 @@ class DailySecondTotalCount(BaseSecondTotal):
             counts = counts.filter(day__gte=since)
         if until:
             counts = counts.filter(day__lt=until)
-        return DailySecondTotalCount.CountSet(counts, scopes)
+        return DailySecondTotalCount.CountSet(counts, scopes, cls._filter_buffered(item_type, scopes, since, until))
+
+
+def record_case_reply_time(case, reply, is_first, is_first_by_assignee):
+    org = case.org
+    partner = reply.partner
+
+    day = datetime_to_date(reply.created_on, org)
+
+    # count the very first response on an org level
+    if is_first:
+        td = reply.created_on - case.opened_on
+        seconds_since_open = ceil(td.total_seconds())
+        DailySecondTotalCount.record_item(day, seconds_since_open, DailySecondTotalCount.TYPE_TILL_REPLIED, org)
+
+    # count the first response by the assigned partner, but not for self-assigned cases
+    if is_first_by_assignee and case.opened_by_partner_id != partner.id:
+        # only count the time since this case was (re)assigned to this partner
+        start_date = case.reassigned_on or case.opened_on
+
+        td = reply.created_on - start_date
+        seconds_since_open = ceil(td.total_seconds())
+        DailySecondTotalCount.record_item(day, seconds_since_open, DailySecondTotalCount.TYPE_TILL_REPLIED, partner)
 
 
-def record_case_closed_time(close_action):
-    org = close_action.case.org
-    user = close_action.created_by
-    partner = close_action.case.assignee
-    case = close_action.case
+def record_case_closed_time(case, close_action, by_assignee):
+    org = case.org
+    partner = case.assignee
 
-    day = datetime_to_date(close_action.created_on, close_action.case.org)
+    day = datetime_to_date(close_action.created_on, org)
     # count the time to close on an org level
     td = close_action.created_on - case.opened_on
     seconds_since_open = ceil(td.total_seconds())
     DailySecondTotalCount.record_item(day, seconds_since_open, DailySecondTotalCount.TYPE_TILL_CLOSED, org)
 
-    # count the time since case was last assigned to this partner till it was closed
-    if user.partners.filter(id=partner.id).exists():
+    # count the time since case was last assigned to this partner till it was closed by someone in that partner
+    if by_assignee:
         # count the time since this case was (re)assigned to this partner
-        try:
-            action = case.actions.filter(action=CaseAction.REASSIGN, assignee=partner).latest("created_on")
-            start_date = action.created_on
-        except CaseAction.DoesNotExist:
-            start_date = case.opened_on
+        start_date = case.reassigned_on or case.opened_on
 
         td = close_action.created_on - start_date
         seconds_since_open = ceil(td.total_seconds())
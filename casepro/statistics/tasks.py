@@ -5,15 +5,28 @@ logger = get_task_logger(__name__)
 
 
 @shared_task
-def squash_counts():
+def flush_counts():
     """
-    Task to squash all daily counts
+    Task to flush buffered counts to the database
     """
     from .models import DailyCount, DailySecondTotalCount, TotalCount
 
-    TotalCount.squash()
-    DailyCount.squash()
-    DailySecondTotalCount.squash()
+    TotalCount.flush_buffer()
+    DailyCount.flush_buffer()
+    DailySecondTotalCount.flush_buffer()
+
+
+@shared_task
+def squash_counts(partition=0, num_partitions=1):
+    """
+    Task to squash all daily counts, or only those in the given partition of scopes
+    """
+    from .models import DailyCount, DailySecondTotalCount, MonthlyCount, TotalCount
+
+    TotalCount.squash(partition, num_partitions)
+    DailyCount.squash(partition, num_partitions)
+    MonthlyCount.squash(partition, num_partitions)
+    DailySecondTotalCount.squash(partition, num_partitions)
 
 
 @shared_task
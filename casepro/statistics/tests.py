@@ -1,10 +1,17 @@
 import random
 import zoneinfo
-from datetime import date, datetime, time
+from datetime import date, datetime, time, timedelta
+from io import StringIO
 from unittest.mock import patch
 
 from dash.orgs.models import Org
+from django_redis import get_redis_connection
+from redis.client import Pipeline
 
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Sum
 from django.test.utils import override_settings
 from django.urls import reverse
 from django.utils import timezone
@@ -14,8 +21,17 @@ from casepro.msgs.models import Outgoing
 from casepro.test import BaseCasesTest
 from casepro.utils import date_to_milliseconds
 
-from .models import DailyCount, DailyCountExport, DailySecondTotalCount, TotalCount
-from .tasks import squash_counts
+from .models import (
+    BUFFER_ITEM_TYPES_KEY,
+    BUFFER_KEY,
+    CountQuery,
+    DailyCount,
+    DailyCountExport,
+    DailySecondTotalCount,
+    MonthlyCount,
+    TotalCount,
+)
+from .tasks import flush_counts, squash_counts
 
 
 class BaseStatsTest(BaseCasesTest):
@@ -136,9 +152,14 @@ class DailyCountsTest(BaseStatsTest):
             )
 
             # check monthly totals
-            self.assertEqual(DailyCount.get_by_org([self.unicef], "R").month_totals(), [(1, 7), (2, 4), (3, 1)])
-            self.assertEqual(DailyCount.get_by_partner([self.moh], "R").month_totals(), [(1, 4)])
-            self.assertEqual(DailyCount.get_by_user(self.unicef, [self.admin], "R").month_totals(), [(1, 2)])
+            self.assertEqual(
+                DailyCount.get_by_org([self.unicef], "R").month_totals(),
+                [(date(2015, 1, 1), 7), (date(2015, 2, 1), 4), (date(2015, 3, 1), 1)],
+            )
+            self.assertEqual(DailyCount.get_by_partner([self.moh], "R").month_totals(), [(date(2015, 1, 1), 4)])
+            self.assertEqual(
+                DailyCount.get_by_user(self.unicef, [self.admin], "R").month_totals(), [(date(2015, 1, 1), 2)]
+            )
 
             # check org totals
             self.assertEqual(
@@ -186,6 +207,112 @@ class DailyCountsTest(BaseStatsTest):
         self.assertEqual(DailyCount.objects.count(), 26)
         self.assertEqual(DailyCount.get_by_org([self.unicef], "R").total(), 13)
 
+    @patch("casepro.statistics.models.DailyCount.squash_batch_size", 4)
+    def test_squash_in_batches_and_partitions(self):
+        self.new_outgoing(self.admin, date(2015, 1, 1), 2)
+        self.new_outgoing(self.user1, date(2015, 1, 1), 3)
+        self.new_outgoing(self.user1, date(2015, 1, 2), 1)
+        self.new_outgoing(self.user3, date(2015, 1, 2), 2)
+
+        num_unsquashed = DailyCount.objects.filter(is_squashed=False).count()
+        num_keys = DailyCount.objects.values("day", "item_type", "scope").distinct().count()
+
+        # squash each partition separately, which between them cover every count
+        squashed = [DailyCount.squash(partition=p, num_partitions=3) for p in range(3)]
+
+        self.assertEqual(sum(squashed), num_keys)
+        self.assertEqual(DailyCount.objects.filter(is_squashed=False).count(), 0)
+        self.assertEqual(DailyCount.objects.count(), num_keys)
+        self.assertLess(num_keys, num_unsquashed)
+
+        self.assertEqual(DailyCount.get_by_org([self.unicef], "R").total(), 8)
+        self.assertEqual(
+            DailyCount.get_by_user(self.unicef, self.unicef.get_users(), "R").scope_totals(),
+            {self.admin: 2, self.user1: 4, self.user2: 0, self.user3: 2},
+        )
+
+        # squashing again finds nothing to do
+        self.assertEqual(DailyCount.squash(), 0)
+        self.assertEqual(DailyCount.objects.count(), num_keys)
+
+    def test_squash_continues_past_empty_batches(self):
+        self.new_outgoing(self.admin, date(2015, 1, 1), 2)
+        self.new_outgoing(self.user1, date(2015, 1, 2), 3)
+
+        num_keys = DailyCount.objects.values("day", "item_type", "scope").distinct().count()
+        num_batches = 0
+
+        # a batch whose keys were all squashed by someone else in the meantime doesn't end squashing
+        def concurrently_squashed_first(execute, sql, params, many, context):
+            nonlocal num_batches
+            num_batches += 1
+            if num_batches == 1:
+                return execute("SELECT 1, 0", (), many, context)
+            return execute(sql, params, many, context)
+
+        with patch.object(DailyCount, "squash_batch_size", 2):
+            with connection.execute_wrapper(concurrently_squashed_first):
+                self.assertEqual(DailyCount.squash(), num_keys)
+
+        self.assertEqual(DailyCount.objects.filter(is_squashed=False).count(), 0)
+        self.assertGreater(num_batches, 2)
+
+    def test_scope_day_totals(self):
+        self.new_outgoing(self.admin, date(2015, 1, 1), 2)
+        self.new_outgoing(self.user1, date(2015, 1, 1), 1)
+        self.new_outgoing(self.user1, date(2015, 1, 3), 2)
+        self.new_outgoing(self.user3, date(2015, 1, 3), 1)
+
+        with self.assertNumQueries(1):
+            totals = list(
+                DailyCount.get_by_user(self.unicef, [self.admin, self.user1, self.user2], "R").scope_day_totals()
+            )
+
+        self.assertEqual(
+            totals, [(date(2015, 1, 1), {self.admin: 2, self.user1: 1}), (date(2015, 1, 3), {self.user1: 2})]
+        )
+
+    def test_monthly_rollup(self):
+        self.new_outgoing(self.admin, date(2015, 1, 1), 2)
+        self.new_outgoing(self.user1, date(2015, 1, 20), 1)
+        self.new_outgoing(self.user1, date(2016, 1, 5), 3)
+
+        def check_totals():
+            # same month in different years are separate buckets
+            self.assertEqual(
+                MonthlyCount.get_by_org([self.unicef], "R").month_totals(),
+                [(date(2015, 1, 1), 3), (date(2016, 1, 1), 3)],
+            )
+            self.assertEqual(
+                MonthlyCount.get_by_user(self.unicef, [self.user1], "R", since=date(2016, 1, 1)).month_totals(),
+                [(date(2016, 1, 1), 3)],
+            )
+            self.assertEqual(
+                DailyCount.get_by_org([self.unicef], "R").month_totals(),
+                [(date(2015, 1, 1), 3), (date(2016, 1, 1), 3)],
+            )
+
+        # nothing rolled up yet but unsquashed daily counts are included
+        self.assertEqual(MonthlyCount.objects.count(), 0)
+        check_totals()
+
+        squash_counts()
+
+        self.assertEqual(MonthlyCount.objects.filter(scope="org:%d" % self.unicef.pk).count(), 2)
+        check_totals()
+
+        # new counts on a day which is already squashed are rolled up as the change in that day's total
+        self.new_outgoing(self.admin, date(2015, 1, 1), 1)
+        squash_counts()
+
+        self.assertEqual(
+            MonthlyCount.get_by_org([self.unicef], "R").month_totals(), [(date(2015, 1, 1), 4), (date(2016, 1, 1), 3)]
+        )
+        self.assertEqual(
+            MonthlyCount.get_by_partner([self.moh], "R").month_totals(), [(date(2015, 1, 1), 1), (date(2016, 1, 1), 3)]
+        )
+        self.assertEqual(MonthlyCount.objects.filter(is_squashed=False).count(), 0)
+
     def test_incoming_counts(self):
         self.new_messages(date(2015, 1, 1), 2)
         self.new_messages(date(2015, 1, 2), 1)
@@ -305,6 +432,160 @@ class DailyCountsTest(BaseStatsTest):
             self.assertEqual(TotalCount.get_by_user(self.unicef, [self.user1], DailyCount.TYPE_CASE_CLOSED).total(), 1)
 
 
+@override_settings(STATS_BUFFER_COUNTS=True)
+class BufferedCountsTest(BaseStatsTest):
+    def setUp(self):
+        super(BufferedCountsTest, self).setUp()
+
+        r = get_redis_connection()
+        for key in r.scan_iter(BUFFER_ITEM_TYPES_KEY % "*"):
+            r.delete(key)
+
+    def flush_buffer(self, model):
+        # flushed counts are only removed from the buffer once the flush has committed
+        with self.captureOnCommitCallbacks(execute=True):
+            return model.flush_buffer()
+
+    def test_buffered_counts(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.new_outgoing(self.user1, date(2015, 1, 1), 2)
+            self.new_outgoing(self.user1, date(2015, 1, 2), 1)
+            self.new_outgoing(self.user3, date(2015, 2, 1), 1)
+
+        # nothing written to the database yet, but counts include buffered values
+        self.assertEqual(TotalCount.objects.filter(item_type="R").count(), 0)
+        self.assertEqual(DailyCount.objects.filter(item_type="R").count(), 0)
+
+        def check_counts():
+            self.assertEqual(TotalCount.get_by_org([self.unicef], "R").total(), 4)
+            self.assertEqual(
+                TotalCount.get_by_partner([self.moh, self.who, self.klab], "R").scope_totals(),
+                {self.moh: 3, self.who: 1, self.klab: 0},
+            )
+            self.assertEqual(DailyCount.get_by_user(self.unicef, [self.user1], "R").total(), 3)
+            self.assertEqual(DailyCount.get_by_org([self.unicef], "R", date(2015, 1, 2)).total(), 2)
+            self.assertEqual(
+                DailyCount.get_by_org([self.unicef], "R").day_totals(),
+                [(date(2015, 1, 1), 2), (date(2015, 1, 2), 1), (date(2015, 2, 1), 1)],
+            )
+            self.assertEqual(
+                DailyCount.get_by_org([self.unicef], "R").month_totals(),
+                [(date(2015, 1, 1), 3), (date(2015, 2, 1), 1)],
+            )
+
+        check_counts()
+
+        # flushing writes a single row per count
+        with self.assertNumQueries(3):  # savepoint, insert, release
+            self.assertEqual(self.flush_buffer(DailyCount), 9)
+
+        self.assertEqual(DailyCount.objects.filter(item_type="R").count(), 9)
+        self.assertEqual(self.flush_buffer(DailyCount), 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            flush_counts()
+
+        self.assertEqual(TotalCount.objects.filter(item_type="R").count(), 5)
+
+        # counts are the same once flushed
+        check_counts()
+
+        # counts recorded in a transaction which is rolled back aren't buffered
+        with self.captureOnCommitCallbacks(execute=False):
+            self.new_outgoing(self.user1, date(2015, 1, 1), 1)
+
+        self.assertEqual(TotalCount.get_by_org([self.unicef], "R").total(), 4)
+
+    def test_buffered_second_totals(self):
+        DailySecondTotalCount.objects.create(
+            day=date(2015, 1, 1),
+            item_type="A",
+            scope=DailySecondTotalCount.encode_scope(self.moh),
+            count=1,
+            seconds=20,
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            DailySecondTotalCount.record_item(date(2015, 1, 1), 40, "A", self.moh)
+            DailySecondTotalCount.record_item(date(2015, 1, 2), 30, "A", self.moh)
+            DailySecondTotalCount.record_item(date(2015, 1, 2), 10, "A", self.who)
+
+        counts = DailySecondTotalCount.get_by_partner([self.moh, self.who], "A")
+        self.assertEqual(counts.total(), 4)
+        self.assertEqual(counts.seconds(), 100)
+        self.assertEqual(counts.average(), 25)
+        self.assertEqual(counts.scope_averages(), {self.moh: 30, self.who: 10})
+        self.assertEqual(counts.day_totals(), [(date(2015, 1, 1), 2, 60), (date(2015, 1, 2), 2, 40)])
+
+        self.assertEqual(self.flush_buffer(DailySecondTotalCount), 3)
+        self.assertEqual(DailySecondTotalCount.objects.aggregate(seconds=Sum("seconds"))["seconds"], 100)
+
+    def test_flush_retries_previous_failure(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            TotalCount.record_item("R", self.unicef)
+
+        with patch("casepro.statistics.models.TotalCount.objects.bulk_create") as mock_bulk_create:
+            mock_bulk_create.side_effect = ValueError("DOH")
+
+            self.assertRaises(ValueError, TotalCount.flush_buffer)
+
+        # counts being flushed are still included, as are new ones recorded since
+        with self.captureOnCommitCallbacks(execute=True):
+            TotalCount.record_item("R", self.unicef)
+
+        self.assertEqual(TotalCount.get_by_org([self.unicef], "R").total(), 2)
+
+        # next flush finishes the failed one, leaving the new count buffered
+        self.assertEqual(self.flush_buffer(TotalCount), 1)
+        self.assertEqual(TotalCount.get_by_org([self.unicef], "R").total(), 2)
+        self.assertEqual(self.flush_buffer(TotalCount), 1)
+        self.assertEqual(TotalCount.objects.filter(item_type="R").count(), 2)
+
+    def test_flush_not_repeated_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            TotalCount.record_item("R", self.unicef)
+
+        # a flush which is rolled back leaves its counts to be flushed again
+        with self.captureOnCommitCallbacks(execute=False):
+            self.assertEqual(TotalCount.flush_buffer(), 1)
+
+        TotalCount.objects.filter(item_type="R").delete()
+        self.assertEqual(TotalCount.get_by_org([self.unicef], "R").total(), 1)
+
+        # but once committed they're removed from the buffer, so can't be inserted again
+        self.assertEqual(self.flush_buffer(TotalCount), 1)
+        self.assertEqual(self.flush_buffer(TotalCount), 0)
+        self.assertEqual(TotalCount.objects.filter(item_type="R").count(), 1)
+
+    def test_bulk_counts_are_buffered(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            DailyCount.record_items("I", {date(2015, 1, 1): 3, date(2015, 1, 2): 0}, self.unicef)
+            DailyCount.record_removals("I", {(date(2015, 1, 1), self.unicef): 1})
+
+        self.assertEqual(DailyCount.objects.filter(item_type="I").count(), 0)
+        self.assertEqual(DailyCount.get_by_org([self.unicef], "I").day_totals(), [(date(2015, 1, 1), 2)])
+
+        self.assertEqual(self.flush_buffer(DailyCount), 1)
+        self.assertEqual(DailyCount.get_by_org([self.unicef], "I").day_totals(), [(date(2015, 1, 1), 2)])
+
+    def test_buffered_per_item_type(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            TotalCount.record_item("R", self.unicef)
+            TotalCount.record_item("C", self.unicef)
+
+        # reading counts of one item type only fetches that item type's buffer
+        with patch.object(Pipeline, "hgetall", autospec=True, side_effect=Pipeline.hgetall) as mock_hgetall:
+            self.assertEqual(TotalCount.get_by_org([self.unicef], "R").total(), 1)
+
+        self.assertEqual(
+            [c.args[1] for c in mock_hgetall.call_args_list],
+            [BUFFER_KEY % ("totalcount", "R"), BUFFER_KEY % ("totalcount", "R") + ":flushing"],
+        )
+
+        self.assertEqual(len(TotalCount.get_buffered()), 2)
+        self.assertEqual(self.flush_buffer(TotalCount), 2)
+
+
 class DailyCountExportTest(BaseStatsTest):
     @override_settings(CELERY_TASK_ALWAYS_EAGER=True, CELERY_TASK_EAGER_PROPAGATES=True)
     def test_label_export(self):
@@ -573,7 +854,7 @@ class ChartsTest(BaseStatsTest):
         self.login(self.user3)
 
         # simulate making requests in April
-        with patch.object(timezone, "now", return_value=datetime(2016, 4, 20, 9, 0, tzinfo=timezone.utc)):
+        with patch.object(timezone, "now", return_value=datetime(2020, 4, 20, 9, 0, tzinfo=timezone.utc)):
             response = self.url_get("unicef", opened_url)
 
             self.assertEqual(
@@ -668,10 +949,13 @@ class SecondTotalCountsTest(BaseStatsTest):
         msg4 = self.create_message(self.nyaruka, 456, self.ned, "Hello 4", [self.code])
         msg5 = self.create_message(self.unicef, 789, self.ann, "Hello 5", [self.code])
 
-        case1 = self.create_case(self.unicef, self.ann, self.moh, msg1, [self.aids])
-        case2 = self.create_case(self.unicef, self.ned, self.moh, msg2, [self.aids, self.pregnancy])
-        case3 = self.create_case(self.unicef, self.ann, self.who, msg3, [self.pregnancy])
-        case4 = self.create_case(self.unicef, self.ned, self.who, msg4, [self.code])
+        # cases opened by their assigned partners
+        case1 = self.create_case(self.unicef, self.ann, self.moh, msg1, [self.aids], opened_by_partner=self.moh)
+        case2 = self.create_case(
+            self.unicef, self.ned, self.moh, msg2, [self.aids, self.pregnancy], opened_by_partner=self.moh
+        )
+        case3 = self.create_case(self.unicef, self.ann, self.who, msg3, [self.pregnancy], opened_by_partner=self.who)
+        case4 = self.create_case(self.unicef, self.ned, self.who, msg4, [self.code], opened_by_partner=self.who)
 
         # create a case by "WHO" user and assign it to "WHO" partner
         case5 = Case.get_or_open(self.unicef, self.user3, msg5, "Hello", self.who)
@@ -750,11 +1034,8 @@ class SecondTotalCountsTest(BaseStatsTest):
         self.assertEqual(DailySecondTotalCount.get_by_partner([self.moh], "C").seconds(), 1)
 
         # check month totals
-        today = datetime.today()
-        current_month = today.month
-        self.assertEqual(
-            DailySecondTotalCount.get_by_partner([self.moh], "C").month_totals(), [(float(current_month), 1, 1)]
-        )
+        this_month = timezone.now().astimezone(self.unicef.timezone).date().replace(day=1)
+        self.assertEqual(DailySecondTotalCount.get_by_partner([self.moh], "C").month_totals(), [(this_month, 1, 1)])
 
         # check user totals are empty as we are recording those
         self.assertEqual(DailySecondTotalCount.get_by_user(self.unicef, [self.user1], "C").total(), 0)
@@ -765,3 +1046,151 @@ class SecondTotalCountsTest(BaseStatsTest):
         self.assertEqual(DailySecondTotalCount.objects.count(), 8)
         squash_counts()
         self.assertEqual(DailySecondTotalCount.objects.count(), 3)
+
+        # the same month in different years isn't merged
+        DailySecondTotalCount.record_item(this_month.replace(year=this_month.year - 1), 5, "C", self.moh)
+        self.assertEqual(
+            DailySecondTotalCount.get_by_partner([self.moh], "C").month_totals(),
+            [(this_month.replace(year=this_month.year - 1), 1, 5), (this_month, 1, 1)],
+        )
+
+    def test_case_closed_counts_by_other_partner(self):
+        msg = self.create_message(self.unicef, 123, self.ann, "Hello", [self.aids])
+        case = self.create_case(self.unicef, self.ann, self.moh, msg, [self.aids])
+
+        # the closing user's partner is looked up once, for both the access check and the partner count
+        with patch.object(User, "get_partner", autospec=True, side_effect=User.get_partner) as mock_get_partner:
+            case.close(self.admin)
+
+        self.assertEqual(mock_get_partner.call_count, 1)
+
+        # closed by someone outside the assigned partner so only counted on an org level
+        self.assertEqual(DailySecondTotalCount.get_by_org([self.unicef], "C").total(), 1)
+        self.assertEqual(DailySecondTotalCount.get_by_partner([self.moh], "C").total(), 0)
+
+
+class CountQueryTest(BaseStatsTest):
+    def test_fetch(self):
+        moh, who = self.encode_scope(self.moh), self.encode_scope(self.who)
+
+        TotalCount.objects.create(item_type="R", scope=moh, count=10)
+        TotalCount.objects.create(item_type="C", scope=who, count=3)
+        DailyCount.objects.create(day=date(2016, 1, 31), item_type="R", scope=moh, count=2)
+        DailyCount.objects.create(day=date(2016, 2, 1), item_type="R", scope=moh, count=4)
+        DailyCount.objects.create(day=date(2016, 2, 3), item_type="R", scope=who, count=1)
+        DailyCount.objects.create(day=date(2016, 2, 3), item_type="C", scope=who, count=5)
+        DailySecondTotalCount.objects.create(day=date(2016, 2, 2), item_type="A", scope=who, count=2, seconds=30)
+        DailySecondTotalCount.objects.create(day=date(2016, 2, 5), item_type="A", scope=who, count=1, seconds=15)
+
+        partners = [self.moh, self.who, self.klab]
+
+        # one query per count table
+        with self.assertNumQueries(3):
+            stats = (
+                CountQuery.for_partners(partners)
+                .total("replies_total", TotalCount, "R")
+                .total("cases_total", TotalCount, "C")
+                .total("replies_feb", DailyCount, "R", date(2016, 2, 1), date(2016, 3, 1))
+                .total("replies_jan", DailyCount, "R", date(2016, 1, 1), date(2016, 2, 1))
+                .total("opened_feb", DailyCount, "C", date(2016, 2, 1), date(2016, 3, 1))
+                .average("replied_feb", DailySecondTotalCount, "A", date(2016, 2, 1), date(2016, 3, 1))
+                .fetch()
+            )
+
+        self.assertEqual(
+            stats,
+            {
+                "replies_total": {self.moh: 10, self.who: 0, self.klab: 0},
+                "cases_total": {self.moh: 0, self.who: 3, self.klab: 0},
+                "replies_feb": {self.moh: 4, self.who: 1, self.klab: 0},
+                "replies_jan": {self.moh: 2, self.who: 0, self.klab: 0},
+                "opened_feb": {self.moh: 0, self.who: 5, self.klab: 0},
+                "replied_feb": {self.moh: 0, self.who: 15.0, self.klab: 0},
+            },
+        )
+
+        # no scopes means no queries
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                CountQuery.for_users(self.unicef, []).total("replies", TotalCount, "R").fetch(), {"replies": {}}
+            )
+
+    @staticmethod
+    def encode_scope(*args):
+        return TotalCount.encode_scope(*args)
+
+
+class RebuildCountsTest(BaseStatsTest):
+    def test_rebuild(self):
+        tz = zoneinfo.ZoneInfo("Africa/Kampala")
+        d1 = datetime(2016, 1, 5, 10, 0, tzinfo=tz)
+        d2 = datetime(2016, 1, 6, 10, 0, tzinfo=tz)
+        d3 = datetime(2016, 1, 9, 10, 0, tzinfo=tz)
+
+        self.create_message(self.unicef, 301, self.ann, "Hi", [self.aids], created_on=d1)
+        msg = self.create_message(self.unicef, 302, self.ann, "Help", [self.aids, self.pregnancy], created_on=d1)
+
+        with patch.object(timezone, "now", return_value=d1):
+            case = Case.get_or_open(self.unicef, self.user3, msg, "Summary", self.moh)
+
+        self.create_outgoing(self.unicef, self.user1, 401, "C", "Hello", self.ann, case=case, created_on=d2)
+
+        with patch.object(timezone, "now", return_value=d2 + timedelta(hours=1)):
+            case.reassign(self.user1, self.who)
+
+        self.create_outgoing(self.unicef, self.user3, 402, "C", "Hi", self.ann, case=case, created_on=d3)
+        self.create_outgoing(self.unicef, self.user1, 403, "B", "Bulk", self.ann, created_on=d3)
+
+        with patch.object(timezone, "now", return_value=d3 + timedelta(hours=1)):
+            case.close(self.user3)
+
+        def get_counts():
+            squash_counts()
+            return {
+                "daily": set(
+                    DailyCount.objects.filter(day__year=2016)
+                    .exclude(count=0)
+                    .values_list("day", "item_type", "scope", "count")
+                ),
+                "seconds": set(
+                    DailySecondTotalCount.objects.values_list("day", "item_type", "scope", "count", "seconds")
+                ),
+                "totals": set(TotalCount.objects.values_list("item_type", "scope", "count")),
+            }
+
+        counts = get_counts()
+
+        # mess up some counts
+        DailyCount.objects.filter(item_type="R").delete()
+        TotalCount.objects.filter(item_type="R").delete()
+        DailyCount.objects.create(day=date(2016, 1, 7), item_type="I", scope="label:%d" % self.aids.pk, count=3)
+        DailySecondTotalCount.objects.filter(item_type="C").delete()
+        TotalCount.objects.create(item_type="D", scope="partner:%d" % self.who.pk, count=2)
+
+        def rebuild(*args):
+            out = StringIO()
+            call_command(
+                "rebuild_counts",
+                self.unicef.pk,
+                "--since=2016-01-01",
+                "--until=2016-02-01",
+                "--workers=1",
+                *args,
+                stdout=out,
+            )
+            return out.getvalue()
+
+        output = rebuild("--dry-run")
+        self.assertIn("daily R in org:%d: 0 counted, 3 rebuilt (2 days differ)" % self.unicef.pk, output)
+        self.assertIn("daily I in label:%d: 5 counted, 2 rebuilt (1 days differ)" % self.aids.pk, output)
+        self.assertIn("Dry run so no counts were updated", output)
+
+        # total count drift from outside the days being rebuilt is left alone
+        output = rebuild()
+        TotalCount.objects.create(item_type="D", scope="partner:%d" % self.who.pk, count=-2)
+
+        self.assertIn("Updated counts in", output)
+        self.assertEqual(get_counts(), counts)
+
+        # nothing differs after rebuilding
+        self.assertIn("0 days differ across 0 scopes", rebuild("--dry-run"))
@@ -15,7 +15,7 @@ from casepro.msgs.models import Label
 from casepro.utils import JSONEncoder, date_to_milliseconds, month_range
 from casepro.utils.export import BaseDownloadView
 
-from .models import DailyCount, DailyCountExport, datetime_to_date
+from .models import DailyCount, DailyCountExport, MonthlyCount, datetime_to_date
 from .tasks import daily_count_export
 
 MONTH_NAMES = (
@@ -77,28 +77,23 @@ class BasePerMonthChart(BaseChart):
     num_months = 12
 
     def get_data(self, request):
-        now = timezone.now()
-
-        since = month_range(-(self.num_months - 1))[0]  # last X months including this month
+        since = month_range(-(self.num_months - 1))[0].date()  # last X months including this month
         totals = self.get_month_totals(request, since)
         totals_by_month = {t[0]: t[1] for t in totals}
 
         # generate category labels and series over last X months
         categories = []
         series = []
-        this_month = now.date().month
-        for m in reversed(range(0, -self.num_months, -1)):
-            month = this_month + m
-            if month < 1:
-                month += 12
-            categories.append(str(MONTH_NAMES[month - 1]))
+        for m in range(self.num_months):
+            month = since + relativedelta(months=m)
+            categories.append(str(MONTH_NAMES[month.month - 1]))
             series.append(totals_by_month.get(month, 0))
 
         return {"categories": categories, "series": series}
 
     def get_month_totals(self, request, since):
         """
-        Subclasses override this to provide a list of month/value tuples
+        Subclasses override this to provide a list of month/value tuples, where months are their first day
         """
 
 
@@ -128,12 +123,12 @@ class RepliesPerMonthChart(BasePerMonthChart):
 
         if partner_id:
             partner = Partner.objects.get(org=request.org, pk=partner_id)
-            return DailyCount.get_by_partner([partner], DailyCount.TYPE_REPLIES, since).month_totals()
+            return MonthlyCount.get_by_partner([partner], MonthlyCount.TYPE_REPLIES, since).month_totals()
         elif user_id:
             user = request.org.get_users().get(pk=user_id)
-            return DailyCount.get_by_user(self.request.org, [user], DailyCount.TYPE_REPLIES, since).month_totals()
+            return MonthlyCount.get_by_user(self.request.org, [user], MonthlyCount.TYPE_REPLIES, since).month_totals()
         else:
-            return DailyCount.get_by_org([self.request.org], DailyCount.TYPE_REPLIES, since).month_totals()
+            return MonthlyCount.get_by_org([self.request.org], MonthlyCount.TYPE_REPLIES, since).month_totals()
 
 
 class CasesOpenedPerMonthChart(BasePerMonthChart):
@@ -142,7 +137,7 @@ class CasesOpenedPerMonthChart(BasePerMonthChart):
     """
 
     def get_month_totals(self, request, since):
-        return DailyCount.get_by_org([self.request.org], DailyCount.TYPE_CASE_OPENED, since).month_totals()
+        return MonthlyCount.get_by_org([self.request.org], MonthlyCount.TYPE_CASE_OPENED, since).month_totals()
 
 
 class CasesClosedPerMonthChart(BasePerMonthChart):
@@ -151,7 +146,7 @@ class CasesClosedPerMonthChart(BasePerMonthChart):
     """
 
     def get_month_totals(self, request, since):
-        return DailyCount.get_by_org([self.request.org], DailyCount.TYPE_CASE_CLOSED, since).month_totals()
+        return MonthlyCount.get_by_org([self.request.org], MonthlyCount.TYPE_CASE_CLOSED, since).month_totals()
 
 
 class MostUsedLabelsChart(BaseChart):
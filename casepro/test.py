@@ -161,7 +161,7 @@ class BaseCasesTest(DashTest):
         return msg
 
     def create_outgoing(self, org, user, broadcast_id, activity, text, contact, **kwargs):
-        return Outgoing.objects.create(
+        outgoing = Outgoing(
             org=org,
             partner=user.get_partner(org),
             backend_broadcast_id=broadcast_id,
@@ -171,6 +171,11 @@ class BaseCasesTest(DashTest):
             created_by=user,
             **kwargs,
         )
+        if outgoing.case:
+            outgoing.case.record_reply(outgoing)
+
+        outgoing.save()
+        return outgoing
 
     def create_case(self, org, contact, assignee, message, labels=(), user_assignee=None, **kwargs):
         case = Case.objects.create(
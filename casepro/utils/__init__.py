@@ -1,3 +1,4 @@
+import base64
 import calendar
 import json
 import re
@@ -11,6 +12,7 @@ import pytz
 from dateutil.relativedelta import relativedelta
 from temba_client.utils import format_iso8601
 
+from django.db.models import Q
 from django.utils import timezone
 from django.utils.timesince import timeuntil
 
@@ -132,6 +134,48 @@ def microseconds_to_datetime(ms):
     return datetime.utcfromtimestamp(ms / 1000000.0).replace(tzinfo=pytz.utc)
 
 
+def encode_cursor(dt, pk):
+    """
+    Encodes the ordering value and id of the last item of a page as an opaque cursor for fetching the next page
+    """
+    return base64.urlsafe_b64encode(b"%d:%d" % (datetime_to_microseconds(dt), pk)).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor into the ordering value and id of the last item of the previous page, or None if it's empty
+    """
+    if not cursor:
+        return None
+
+    try:
+        ms, pk = base64.urlsafe_b64decode(cursor.encode("ascii")).split(b":")
+        return microseconds_to_datetime(int(ms)), int(pk)
+    except (ValueError, UnicodeEncodeError):
+        raise ValueError("Invalid cursor: %s" % cursor)
+
+
+def after_cursor(queryset, cursor, field, id_field="id"):
+    """
+    Filters a queryset ordered by the given field and id descending to the items after the given cursor. The range
+    condition on the field alone is kept separate so that indexes ordered by that field can be used.
+    """
+    value, pk = cursor
+    return queryset.filter(Q(**{f"{field}__lte": value}), Q(**{f"{field}__lt": value}) | Q(**{f"{id_field}__lt": pk}))
+
+
+def cursor_page(queryset, page_size, field):
+    """
+    Fetches a page of items from a queryset which has been ordered by the given field and id descending
+    :return: the items, whether there are more items, and the cursor of the next page
+    """
+    items = list(queryset[: page_size + 1])
+    has_more = len(items) > page_size
+    items = items[:page_size]
+    next_cursor = encode_cursor(getattr(items[-1], field), items[-1].pk) if has_more else None
+    return items, has_more, next_cursor
+
+
 def month_range(offset, now=None):
     """
     Gets the UTC start and end (exclusive) of a month
@@ -15,6 +15,8 @@ from . import (
     date_range,
     date_to_milliseconds,
     datetime_to_microseconds,
+    decode_cursor,
+    encode_cursor,
     get_language_name,
     humanize_seconds,
     is_valid_language_code,
@@ -82,6 +84,16 @@ class UtilsTest(BaseCasesTest):
         d2 = microseconds_to_datetime(ms)
         self.assertEqual(d2, datetime(2015, 10, 9, 14, 48, 30, 123456, tzinfo=pytz.utc))
 
+    def test_cursors(self):
+        d1 = datetime(2015, 10, 9, 14, 48, 30, 123456, tzinfo=pytz.utc)
+        cursor = encode_cursor(d1, 123)
+
+        self.assertEqual(decode_cursor(cursor), (d1, 123))
+        self.assertIsNone(decode_cursor(""))
+        self.assertIsNone(decode_cursor(None))
+        self.assertRaises(ValueError, decode_cursor, "xyz")
+        self.assertRaises(ValueError, decode_cursor, "☃")
+
     def test_json_encode(self):
         class MyEnum(Enum):
             bar = 1
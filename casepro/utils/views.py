@@ -1,5 +1,9 @@
 from smartmin.views import SmartTemplateView
 
+from django.http import HttpResponseBadRequest
+
+from . import decode_cursor
+
 
 class PartialTemplate(SmartTemplateView):
     """
@@ -12,3 +16,23 @@ class PartialTemplate(SmartTemplateView):
 
     def get_template_names(self):
         return "partials/%s.haml" % self.template
+
+
+class CursorPagingMixin(object):
+    """
+    Mixin for search views which are paged with an opaque cursor, which responds with a 400 if the cursor is invalid.
+    Must come before OrgPermsMixin in a view's bases because dash's OrgPermsMixin.pre_process doesn't call super, so
+    this pre_process would never run if it came after. This one calls super first so the org checks still happen.
+    """
+
+    def pre_process(self, request, *args, **kwargs):
+        response = super().pre_process(request, *args, **kwargs)
+        if response:
+            return response
+
+        try:
+            self.cursor = decode_cursor(request.GET.get("cursor"))
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+
+        return None